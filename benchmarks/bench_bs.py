@@ -0,0 +1,36 @@
+import saber
+
+from .common import HINDCAST_REACHES
+from .common import SCALES
+from .common import load
+
+
+class TimeBootstrapTable:
+    """Reassign every gauged reach to a different gauge for bootstrap validation"""
+    params = SCALES
+    param_names = ['reaches']
+    timeout = 3600
+
+    def setup(self, reaches):
+        load(reaches)
+        assign_df = saber.table.init(cache=False)
+        assign_df = saber.table.mp_prop_gauges(assign_df)
+        self.assign_df = saber.table.mp_prop_regulated(assign_df)
+
+    def time_mp_table(self, reaches):
+        saber.bs.mp_table(self.assign_df)
+
+
+class TimeBootstrapMetrics:
+    """Correct each gauged reach with its bootstrap assignment and compute the validation metrics"""
+    timeout = 3600
+
+    def setup(self):
+        load(HINDCAST_REACHES, write_hindcast=True)
+        assign_df = saber.table.init(cache=False)
+        assign_df = saber.table.mp_prop_gauges(assign_df)
+        assign_df = saber.table.mp_prop_regulated(assign_df)
+        self.bs_df = saber.bs.mp_table(assign_df)
+
+    def time_mp_metrics(self):
+        saber.bs.mp_metrics(self.bs_df)
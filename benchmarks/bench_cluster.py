@@ -0,0 +1,33 @@
+import saber
+
+from .common import SCALES
+from .common import load
+
+
+class TimeClustering:
+    """Train the k-means models on the FDCs in cluster_data and summarize the fits"""
+    params = SCALES
+    param_names = ['reaches']
+    timeout = 3600
+
+    def setup(self, reaches):
+        load(reaches)
+        self.x = saber.io.read_table('cluster_data').values
+
+    def time_generate(self, reaches):
+        saber.cluster.generate(x=self.x)
+
+
+class TimePredictLabels:
+    """Label every reach with a trained k-means model"""
+    params = SCALES
+    param_names = ['reaches']
+    timeout = 3600
+
+    def setup(self, reaches):
+        load(reaches)
+        self.x = saber.io.read_table('cluster_data')
+        saber.cluster.generate(x=self.x.values, max_clusters=5)
+
+    def time_predict_labels(self, reaches):
+        saber.cluster.predict_labels(n_clusters=5, x=self.x)
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import saber
+from saber.saber import fdc_mapping
+from saber.saber import sfdc_mapping
+
+from .common import HINDCAST_REACHES
+from .common import load
+
+
+class TimeFlowDurationCurves:
+    """Compute flow duration curves and scalar fdc mappings for single river series"""
+    params = [10, 20, 30]
+    param_names = ['years']
+    timeout = 300
+
+    def setup(self, years):
+        load(HINDCAST_REACHES, write_hindcast=True)
+        gauge_df = saber.io.read_table('gauge_table')
+        with xr.open_zarr(saber.io.get_state('hindcast_zarr')) as ds:
+            rivids = ds['rivid'].values
+            times = pd.to_datetime(ds['time'].values)
+            keep = times < times[0] + pd.DateOffset(years=years)
+            gauge_mid = int(gauge_df[saber.io.COL_MID].values[0])
+            sims = ds['Qout'].isel(time=np.flatnonzero(keep), rivid=[
+                np.flatnonzero(rivids == gauge_mid)[0], 0
+            ]).values
+        self.sim_a = pd.DataFrame(sims[:, 0], index=times[keep], columns=[saber.io.COL_QSIM])
+        self.sim_b = pd.DataFrame(sims[:, 1], index=times[keep], columns=[saber.io.COL_QSIM])
+        self.obs = self.sim_a * np.random.default_rng(0).uniform(0.5, 1.5, size=(len(self.sim_a), 1))
+
+    def time_fdc(self, years):
+        saber.fdc.fdc(self.sim_a.values)
+
+    def time_fdc_mapping(self, years):
+        fdc_mapping(self.sim_a, self.obs)
+
+    def time_sfdc_mapping(self, years):
+        sfdc_mapping(
+            self.sim_a, self.obs, self.sim_b,
+            use_log=True,
+            drop_outliers=True, outlier_threshold=3,
+            fit_gumbel=True, fit_range=(5, 95),
+        )
@@ -0,0 +1,29 @@
+# each timeraw benchmark runs in a fresh interpreter so the measured time includes every dependency it imports
+
+
+def timeraw_import_saber():
+    return 'import saber'
+
+
+def timeraw_import_io():
+    return 'import saber.io'
+
+
+def timeraw_import_correction_worker():
+    return 'import saber.saber'
+
+
+def timeraw_import_bootstrap_worker():
+    return 'import saber.bs'
+
+
+def timeraw_import_table():
+    return 'import saber.table'
+
+
+def timeraw_import_cluster():
+    return 'import saber.cluster'
+
+
+def timeraw_import_all():
+    return 'import saber.pipeline; import saber.gis'
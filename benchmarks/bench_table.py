@@ -0,0 +1,40 @@
+import saber
+
+from .common import SCALES
+from .common import load
+
+
+class TimePropagation:
+    """Create the assign table and propagate assignments from gauges and regulatory structures"""
+    params = SCALES
+    param_names = ['reaches']
+    timeout = 3600
+
+    def setup(self, reaches):
+        load(reaches)
+        self.assign_df = saber.table.init(cache=False)
+
+    def time_init(self, reaches):
+        saber.table.init(cache=False)
+
+    def time_prop_gauges(self, reaches):
+        saber.table.mp_prop_gauges(self.assign_df.copy())
+
+    def time_prop_regulated(self, reaches):
+        saber.table.mp_prop_regulated(self.assign_df.copy())
+
+
+class TimeAssignment:
+    """Assign gauges to every ungauged reach"""
+    params = SCALES
+    param_names = ['reaches']
+    timeout = 3600
+
+    def setup(self, reaches):
+        load(reaches)
+        assign_df = saber.table.init(cache=False)
+        assign_df = saber.table.mp_prop_gauges(assign_df)
+        self.assign_df = saber.table.mp_prop_regulated(assign_df)
+
+    def time_assign(self, reaches):
+        saber.assign.mp_assign(self.assign_df.copy())
@@ -0,0 +1,46 @@
+import os
+import tempfile
+
+import saber
+
+# number of reaches in the synthetic networks used to time the table, assignment and clustering stages
+SCALES = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+
+# size of the synthetic project with a hindcast zarr and gauge data used to time the discharge stages
+HINDCAST_REACHES = 1_000
+HINDCAST_YEARS = 30
+
+BENCH_DIR = os.environ.get('SABER_BENCH_DIR', os.path.join(tempfile.gettempdir(), 'saber-benchmarks'))
+
+
+def project(n_reaches: int, write_hindcast: bool = False) -> str:
+    """
+    Get the config file of a synthetic project, generating it the first time it is requested
+
+    Args:
+        n_reaches: number of reaches in the drainage network
+        write_hindcast: whether the project needs a hindcast zarr and gauge data
+
+    Returns:
+        path to the config file
+    """
+    path = os.path.join(BENCH_DIR, f'reaches-{n_reaches}{"-hindcast" if write_hindcast else ""}')
+    config = os.path.join(path, 'config.yml')
+    if not os.path.exists(config):
+        saber.synthetic.make_project(path, n_reaches=n_reaches, write_hindcast=write_hindcast,
+                                     n_years=HINDCAST_YEARS)
+    return config
+
+
+def load(n_reaches: int, write_hindcast: bool = False) -> None:
+    """
+    Read the config of a synthetic project so the saber functions use it as the workdir
+
+    Args:
+        n_reaches: number of reaches in the drainage network
+        write_hindcast: whether the project needs a hindcast zarr and gauge data
+
+    Returns:
+        None
+    """
+    saber.io.read_config(project(n_reaches, write_hindcast))
@@ -0,0 +1,57 @@
+"""
+Load test of the SABER correction service. Start the service first, e.g. "saber serve config.yml", then run
+"python service_load_test.py --clients 16 --seconds 30" to report the throughput and latency of concurrent requests.
+"""
+import argparse
+import json
+import random
+import statistics
+import threading
+import time
+import urllib.request
+
+
+def get(url: str) -> dict:
+    with urllib.request.urlopen(url, timeout=60) as response:
+        return json.loads(response.read())
+
+
+def client(url: str, model_ids: list, rivers: int, seconds: float, latencies: list, errors: list) -> None:
+    stop = time.monotonic() + seconds
+    while time.monotonic() < stop:
+        year = random.randint(1980, 1990)
+        query = f'model_id={",".join(random.sample(model_ids, rivers))}&start={year}-01-01&end={year}-12-31'
+        start = time.perf_counter()
+        try:
+            get(f'{url}/correct?{query}')
+            latencies.append(time.perf_counter() - start)
+        except Exception as e:
+            errors.append(str(e))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='load test the SABER correction service')
+    parser.add_argument('--url', default='http://127.0.0.1:8080', help='address of the service')
+    parser.add_argument('--clients', type=int, default=8, help='number of concurrent clients')
+    parser.add_argument('--rivers', type=int, default=1, help='rivers per request')
+    parser.add_argument('--seconds', type=float, default=10, help='duration of the test')
+    args = parser.parse_args()
+
+    model_ids = get(f'{args.url}/rivers')['model_id']
+    latencies = []
+    errors = []
+    threads = [threading.Thread(target=client, args=(args.url, model_ids, args.rivers, args.seconds, latencies, errors))
+               for _ in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies = sorted(latencies)
+    if latencies:
+        quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        print(f'{len(latencies)} requests in {args.seconds:.0f} s: {len(latencies) / args.seconds:.1f} requests/s')
+        print(f'latency ms: p50 {quantiles[49] * 1000:.1f}, p95 {quantiles[94] * 1000:.1f}, '
+              f'p99 {quantiles[98] * 1000:.1f}, max {latencies[-1] * 1000:.1f}')
+    print(f'{len(errors)} errors{": " + errors[0] if errors else ""}')
+    print(json.dumps(get(f'{args.url}/stats'), indent=2))
@@ -1,17 +1,23 @@
-import saber.assign
-import saber.bs
-import saber.cluster
-import saber.fdc
-import saber.gis
-import saber.io
-import saber.saber
-import saber.table
+import importlib
 
 __all__ = [
-    'io', 'table', 'cluster', 'assign', 'gis', 'saber', 'bs',
+    'io', 'table', 'cluster', 'assign', 'fdc', 'gis', 'saber', 'bs', 'synthetic', 'pipeline', 'cli', 'shard',
+    'executor', 'topology', 'progress', 'trace', 'cache', 'forecast', 'lut', 'service',
 ]
 
 __author__ = 'Riley C. Hales'
 __url__ = 'https://saber.hales.app'
 __version__ = '0.9.0'
 __license__ = 'BSD 3 Clause Clear'
+
+
+def __getattr__(name: str):
+    # submodules are imported on first access so that "import saber" and multiprocessing workers only pay for the
+    # modules (and their heavy dependencies) they actually use
+    if name in __all__:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -1,9 +1,9 @@
 import logging
-from multiprocessing import Pool
 
 import numpy as np
 import pandas as pd
 
+from .executor import get_executor
 from .io import COL_ASN_GID
 from .io import COL_ASN_MID
 from .io import COL_ASN_REASON
@@ -17,6 +17,7 @@ from .io import COL_X
 from .io import COL_Y
 from .io import get_state
 from .io import read_table
+from .table import _split_packets
 
 __all__ = ['mp_assign', 'assign_gauged', 'mp_assign_ungauged', ]
 
@@ -36,7 +37,7 @@ def mp_assign(df: pd.DataFrame = None) -> pd.DataFrame:
     if df is None:
         df = read_table('assign_table')
     df = assign_gauged(df)
-    df = mp_assign_ungauged(df, get_state('n_processes'))
+    df = mp_assign_ungauged(df)
     return df
 
 
@@ -59,6 +60,8 @@ def assign_gauged(df: pd.DataFrame) -> pd.DataFrame:
 
 def mp_assign_ungauged(df: pd.DataFrame) -> pd.DataFrame:
     """
+    Assigns a gauge to each unassigned stream. Drainage basins are grouped into packets which are assigned in parallel
+    so each worker only receives the rows of its own basins and the table of gauged streams.
 
     Args:
         df: the assignments table dataframe with the clustering labels already applied
@@ -66,21 +69,35 @@ def mp_assign_ungauged(df: pd.DataFrame) -> pd.DataFrame:
     Returns:
         pd.DataFrame
     """
-    with Pool(get_state('n_processes')) as p:
-        logger.info('Assign Basins within Clusters')
-        for cluster_number in range(df[COL_CID].max() + 1):
-            logger.info(f'Assigning basins in cluster {cluster_number}')
-            # filter assign dataframe to only gauged basins within the cluster
-            c_df = df[df[COL_CID] == cluster_number]
-            c_df = c_df[c_df[COL_GID].notna()]
-            # keep a list of the unassigned basins in the cluster
-            mids = c_df[c_df[COL_ASN_REASON] == 'unassigned'][COL_MID].values
-            df = pd.concat([
-                pd.concat(p.starmap(_map_assign_ungauged, [(df, c_df, x) for x in mids])),
-                df[~df[COL_MID].isin(mids)]
-            ]).reset_index(drop=True)
+    gauges_df = df[df[COL_GID].notna()]
+    packets = [
+        packet for packet in _split_packets(df, get_state('n_processes'))
+        if np.any(packet[COL_ASN_REASON] == 'unassigned')
+    ]
+    if not packets:
+        return df
 
-    return df
+    with get_executor() as p:
+        logger.info(f'Assign Basins within Clusters in {len(packets)} packets of basins')
+        assigned_df = pd.concat(p.starmap(_map_assign_packet, [(packet, gauges_df) for packet in packets]))
+
+    mids = pd.concat([packet[packet[COL_ASN_REASON] == 'unassigned'][COL_MID] for packet in packets])
+    return pd.concat([assigned_df, df[~df[COL_MID].isin(mids)]]).reset_index(drop=True)
+
+
+def _map_assign_packet(packet_df: pd.DataFrame, gauges_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Assigns every unassigned stream in a packet of drainage basins
+
+    Args:
+        packet_df: the rows of the assignments table in the packet's basins
+        gauges_df: a subset of the assignments dataframe containing the gauges
+
+    Returns:
+        pd.DataFrame of the assigned rows
+    """
+    mids = packet_df[packet_df[COL_ASN_REASON] == 'unassigned'][COL_MID].values
+    return pd.concat([_map_assign_ungauged(packet_df, gauges_df, x) for x in mids])
 
 
 def _map_assign_ungauged(assign_df: pd.DataFrame, gauges_df: pd.DataFrame, mid: str) -> pd.DataFrame:
@@ -106,13 +123,13 @@ def _map_assign_ungauged(assign_df: pd.DataFrame, gauges_df: pd.DataFrame, mid:
         # if the stream contains or is downstream of a regulatory structure check is reg structure contains a gauge
         # check is separate from gauge prop, so it are assigned even during bootstrapping
         # todo check if there is a closer gauge *between* the stream and the reg structure
-        if new_row[COL_RPROP].values[0] != '' or new_row[COL_RID].values[0] is not None:
+        if new_row[COL_RPROP].values[0] != '' or pd.notna(new_row[COL_RID].values[0]):
             if new_row[COL_RPROP].values[0]:
-                potential_mid = new_row[COL_RPROP].values[0].split('-')[-1]  # Find the MID of the reg structure
+                potential_mid = new_row[COL_RPROP].values[0]  # the MID of the reg structure
             else:
                 potential_mid = new_row[COL_MID].values[0]  # use current row because it has the reg structure
             potential_gid = assign_df[assign_df[COL_MID] == potential_mid][COL_GID].values[0]
-            if potential_gid != '':
+            if pd.notna(potential_gid) and potential_gid != '':
                 new_row[COL_ASN_MID] = potential_mid
                 new_row[COL_ASN_GID] = potential_gid
                 new_row[COL_ASN_REASON] = 'regulatory'
@@ -120,7 +137,7 @@ def _map_assign_ungauged(assign_df: pd.DataFrame, gauges_df: pd.DataFrame, mid:
 
         # if the stream is near a gauge, assign that gauge
         if new_row[COL_GPROP].values[0] != '':
-            new_row[COL_ASN_MID] = new_row[COL_GPROP].values[0].split('-')[-1]
+            new_row[COL_ASN_MID] = new_row[COL_GPROP].values[0]
             new_row[COL_ASN_GID] = assign_df[assign_df[COL_MID] == new_row[COL_ASN_MID].values[0]][COL_GID].values[0]
             new_row[COL_ASN_REASON] = 'near_gauge'
             return new_row
@@ -1,37 +1,75 @@
+import functools
+import itertools
 import logging
 import os
 import warnings
-from multiprocessing import Pool
+import zlib
+from typing import TYPE_CHECKING
 
-import geopandas as gpd
-import hydrostats as hs
 import numpy as np
 import pandas as pd
-import seaborn as sns
-from matplotlib import pyplot as plt
 
 from .assign import _map_assign_ungauged
+from .cache import cached_gauge_data
+from .cache import cached_hindcast
+from .cache import prefetch
+from .executor import get_executor
 from .io import COL_ASN_GID
 from .io import COL_ASN_MID
+from .io import COL_ASN_REASON
+from .io import COL_CID
 from .io import COL_GID
+from .io import COL_GPROP
 from .io import COL_MID
+from .io import COL_OUTLET
 from .io import COL_QMOD
 from .io import COL_QOBS
 from .io import COL_QSIM
+from .io import COL_RPROP
+from .io import COL_X
+from .io import COL_Y
 from .io import get_dir
 from .io import get_state
 from .io import read_gis
 from .io import read_table
 from .io import write_gis
 from .io import write_table
-from .saber import map_saber
-
-__all__ = ['mp_table', 'metrics', 'mp_metrics', 'histograms', 'postprocess_metrics', 'pie_charts']
+from .progress import Progress
+from .saber import APPLY_PARAMS
+from .saber import CURVE_PARAMS
+from .saber import SFDC_PARAMS
+from .saber import _gauge_groups
+from .saber import _read_group
+from .saber import _select
+from .saber import fdc_mapping
+from .saber import map_saber_group
+from .saber import sfdc_apply
+from .saber import sfdc_curves
+from .shard import shard_table
+from .shard import write_part
+from .table import _split_packets
+from .trace import span
+
+if TYPE_CHECKING:
+    import geopandas as gpd
+
+__all__ = ['mp_table', 'metrics', 'mp_metrics', 'resample_metrics', 'sweep', 'mp_sweep', 'parameter_sets', 'cv_folds',
+           'cv_table', 'mp_cross_validate', 'histograms', 'postprocess_metrics', 'pie_charts']
 
 logger = logging.getLogger(__name__)
 
 warnings.filterwarnings('ignore')
 
+# the confidence level of the intervals of the resampled metrics and the most values resampled in one batch of arrays
+CI_LEVEL = 0.95
+RESAMPLE_BATCH_VALUES = 2 ** 20
+
+# the most rows of the assignment table validated by one task of mp_metrics
+METRICS_TASK_ROWS = 16
+
+# the column of the assignment table which blocks the gauges of spatially blocked cross validation folds
+CV_BLOCKS = {'random': None, 'outlet': COL_OUTLET, 'cluster': COL_CID}
+
 
 def mp_table(assign_df: pd.DataFrame) -> pd.DataFrame:
     """
@@ -49,29 +87,33 @@ def mp_table(assign_df: pd.DataFrame) -> pd.DataFrame:
     # subset the assign dataframe to only rows which contain gauges - possible options to be assigned
     gauges_df = assign_df[assign_df[COL_GID].notna()].copy()
 
-    with Pool(get_state('n_processes')) as p:
-        bs_df = pd.concat(
-            p.starmap(_map_mp_table, [[assign_df, gauges_df, row_idx] for row_idx in gauges_df.index])
-        )
+    # each packet holds whole drainage basins so the streams a gauge can be assigned from by propagation are included
+    packets = [
+        packet for packet in _split_packets(assign_df, get_state('n_processes')) if packet[COL_GID].notna().any()
+    ]
+    with get_executor() as p:
+        bs_df = pd.concat(p.starmap(_map_mp_table, [[packet, gauges_df] for packet in packets]))
 
     write_table(bs_df, 'assign_table_bootstrap')
     return bs_df
 
 
-def _map_mp_table(assign_df: pd.DataFrame, gauge_df: pd.DataFrame, row_idx: int) -> pd.DataFrame:
+def _map_mp_table(assign_df: pd.DataFrame, gauge_df: pd.DataFrame) -> pd.DataFrame:
     """
-    Helper function for mp_table which assigns a single row of the assignment table to a different gauged stream.
+    Helper function for mp_table which assigns each gauged row in a packet of basins to a different gauged stream.
     Separate function so it can be pickled for multiprocessing.
 
     Args:
-        assign_df: pandas.DataFrame of the assignment table
+        assign_df: pandas.DataFrame of the rows of the assignment table in a packet of drainage basins
         gauge_df: pandas.DataFrame of the assignment table subset to only rows which contain gauges
-        row_idx: the row number of the table to assign
 
     Returns:
-        pandas.DataFrame of the row with the new assignment
+        pandas.DataFrame of the rows with the new assignments
     """
-    return _map_assign_ungauged(assign_df, gauge_df.drop(row_idx), gauge_df.loc[row_idx][COL_MID])
+    return pd.concat([
+        _map_assign_ungauged(assign_df, gauge_df.drop(row_idx), assign_df.loc[row_idx, COL_MID])
+        for row_idx in assign_df.index[assign_df[COL_GID].notna()]
+    ])
 
 
 def metrics(row_idx: int, assign_df: pd.DataFrame, gauge_data: str, hindcast_zarr: str) -> pd.DataFrame | None:
@@ -87,10 +129,45 @@ def metrics(row_idx: int, assign_df: pd.DataFrame, gauge_data: str, hindcast_zar
     Returns:
         None
     """
-    row = assign_df.loc[row_idx]
+    return _row_metrics(assign_df.loc[row_idx], gauge_data, hindcast_zarr)
+
+
+def _map_metrics_rows(rows_df: pd.DataFrame, gauge_data: str, hindcast_zarr: str) -> list:
+    """
+    Helper function for mp_metrics which performs bootstrap validation of some rows of the assignment table. The data
+    of the next rows are read in the background while a row is corrected. Separate function so it can be pickled for
+    multiprocessing.
+
+    Returns:
+        list of the metrics table of each row, or None for the rows which failed
+    """
+    rows = [row for _, row in rows_df.iterrows()]
+    loaders = [functools.partial(_read_row, row, gauge_data, hindcast_zarr) for row in rows]
+    # a failed read is repeated by _row_metrics which handles the error
+    return [_row_metrics(row, gauge_data, hindcast_zarr, None if data.exception() else data.result())
+            for row, data in zip(rows, prefetch(loaders))]
+
+
+def _read_row(row: pd.Series, gauge_data: str, hindcast_zarr: str) -> tuple:
+    """
+    Reads the data map_saber_group corrects a gauged row of the assignment table with, and the observed discharge at
+    the row's own gauge
+    """
+    data = _read_group([row[COL_MID], ], row[COL_ASN_MID], row[COL_ASN_GID], hindcast_zarr, gauge_data)
+    with span('read_gauge_csv', 'io', gauge_id=row[COL_GID]):
+        obs_df = cached_gauge_data(gauge_data, row[COL_GID])
+    return data, obs_df
+
 
+def _row_metrics(row: pd.Series, gauge_data: str, hindcast_zarr: str, data: tuple = None) -> pd.DataFrame | None:
+    """
+    Performs bootstrap validation of a gauged row of the assignment table with the data from _read_row, which are read
+    when not given
+    """
     try:
-        corrected_df = map_saber(row[COL_MID], row[COL_ASN_MID], row[COL_ASN_GID], hindcast_zarr, gauge_data)
+        group_data, obs_df = (None, None) if data is None else data
+        corrected_df = map_saber_group([row[COL_MID], ], row[COL_ASN_MID], row[COL_ASN_GID], hindcast_zarr,
+                                       gauge_data, group_data)[0]
 
         if corrected_df is None:
             logger.warning(f'No corrected data for {row[COL_MID]}')
@@ -99,59 +176,172 @@ def metrics(row_idx: int, assign_df: pd.DataFrame, gauge_data: str, hindcast_zar
             logger.warning(f'Missing adjusted and simulated columns')
             return None
 
-        # create a dataframe of original and corrected streamflow that can be used for calculating metrics
-        metrics_df = pd.read_csv(os.path.join(gauge_data, f'{row[COL_GID]}.csv'), index_col=0)
-        metrics_df.columns = [COL_QOBS, ]
-        metrics_df.index = pd.to_datetime(metrics_df.index)
-        metrics_df = pd.merge(corrected_df, metrics_df, how='inner', left_index=True, right_index=True)
-
-        # drop rows with inf or nan values
-        metrics_df = metrics_df.replace([np.inf, -np.inf], np.nan).dropna()
-
-        # if the dataframe is empty (dates did not align or all rows were inf or NaN), return None
-        if metrics_df.empty:
-            logger.warning(f'Empty dataframe for {row[COL_MID]}')
-            return None
-
-        obs_values = metrics_df[COL_QOBS].values.flatten()
-        sim_values = metrics_df[COL_QSIM].values.flatten()
-        mod_values = np.squeeze(metrics_df[COL_QMOD].values.flatten())
-
-        if mod_values.dtype == np.dtype('O'):
-            mod_values = np.array(mod_values.tolist()).astype(np.float64).flatten()
-
-        diff_sim = sim_values - obs_values
-        diff_corr = mod_values - obs_values
-
-        return pd.DataFrame({
-            'me_sim': np.mean(diff_sim),
-            'mae_sim': np.mean(np.abs(diff_sim)),
-            'rmse_sim': np.sqrt(np.mean(diff_sim ** 2)),
-            'nse_sim': hs.nse(sim_values, obs_values),
-            'kge_sim': hs.kge_2012(sim_values, obs_values),
-
-            'me_corr': np.mean(diff_corr),
-            'mae_corr': np.mean(np.abs(diff_corr)),
-            'rmse_corr': np.sqrt(np.mean(diff_corr ** 2)),
-            'nse_corr': hs.nse(mod_values, obs_values),
-            'kge_corr': hs.kge_2012(mod_values, sim_values),
-
-            'reach_id': row[COL_MID],
-            'gauge_id': row[COL_GID],
-            'asgn_reach_id': row[COL_ASN_MID],
-        }, index=[0, ])
+        if obs_df is None:
+            with span('read_gauge_csv', 'io', gauge_id=row[COL_GID]):
+                obs_df = cached_gauge_data(gauge_data, row[COL_GID])
+        return _metrics_table(corrected_df, obs_df, row)
     except Exception as e:
         logger.error(e)
         logger.error(f'Failed bootstrap validation for {row[COL_MID]}')
         return None
 
 
-def mp_metrics(assign_df: pd.DataFrame = None) -> pd.DataFrame:
+def _metrics_table(corrected_df: pd.DataFrame, obs_df: pd.DataFrame, row: pd.Series,
+                   resamples: int = None) -> pd.DataFrame | None:
+    """
+    Computes the error metrics of the simulated and corrected discharge of a gauged row of the assignment table and
+    their confidence intervals
+
+    Args:
+        corrected_df: the corrected and simulated discharge of the gauged river from map_saber
+        obs_df: the observed discharge at the gauge
+        row: the row of the assignment table of the gauged river
+        resamples: the number of block bootstrap resamples for the confidence intervals. Defaults to
+            bootstrap_resamples in the config. 0 skips the confidence intervals
+
+    Returns:
+        pandas.DataFrame with one row of metrics, or None if the corrected and observed discharge have no valid dates
+        in common
+    """
+    import hydrostats as hs
+
+    # create a dataframe of original and corrected streamflow that can be used for calculating metrics
+    metrics_df = obs_df.set_axis([COL_QOBS, ], axis=1)
+    metrics_df = pd.merge(corrected_df, metrics_df, how='inner', left_index=True, right_index=True)
+
+    # drop rows with inf or nan values
+    metrics_df = metrics_df.replace([np.inf, -np.inf], np.nan).dropna()
+
+    # if the dataframe is empty (dates did not align or all rows were inf or NaN), return None
+    if metrics_df.empty:
+        logger.warning(f'Empty dataframe for {row[COL_MID]}')
+        return None
+
+    obs_values = metrics_df[COL_QOBS].values.flatten()
+    sim_values = metrics_df[COL_QSIM].values.flatten()
+    mod_values = np.squeeze(metrics_df[COL_QMOD].values.flatten())
+
+    if mod_values.dtype == np.dtype('O'):
+        mod_values = np.array(mod_values.tolist()).astype(np.float64).flatten()
+
+    diff_sim = sim_values - obs_values
+    diff_corr = mod_values - obs_values
+
+    return pd.DataFrame({
+        'me_sim': np.mean(diff_sim),
+        'mae_sim': np.mean(np.abs(diff_sim)),
+        'rmse_sim': np.sqrt(np.mean(diff_sim ** 2)),
+        'nse_sim': hs.nse(sim_values, obs_values),
+        'kge_sim': hs.kge_2012(sim_values, obs_values),
+
+        'me_corr': np.mean(diff_corr),
+        'mae_corr': np.mean(np.abs(diff_corr)),
+        'rmse_corr': np.sqrt(np.mean(diff_corr ** 2)),
+        'nse_corr': hs.nse(mod_values, obs_values),
+        'kge_corr': hs.kge_2012(mod_values, obs_values),
+
+        **resample_metrics(obs_values, sim_values, mod_values, resamples=resamples,
+                           seed=zlib.crc32(str(row[COL_MID]).encode())),
+
+        'reach_id': row[COL_MID],
+        'gauge_id': row[COL_GID],
+        'asgn_reach_id': row[COL_ASN_MID],
+    }, index=[0, ])
+
+
+def resample_metrics(obs: np.ndarray, sim: np.ndarray, mod: np.ndarray, resamples: int = None,
+                     block_days: int = None, seed: int = 0) -> dict:
+    """
+    Confidence intervals of the error metrics of the simulated and corrected discharge from a circular block bootstrap.
+    Each resample joins randomly placed blocks of block_days consecutive values of the aligned series so the
+    autocorrelation and seasonality of streamflow are kept within each block. The resamples are drawn as arrays of
+    positions and the metrics of every resample are computed together with array operations.
+
+    Args:
+        obs: the observed discharge
+        sim: the simulated discharge on the same dates
+        mod: the corrected discharge on the same dates
+        resamples: the number of resamples. Defaults to bootstrap_resamples in the config. 0 skips the resampling
+        block_days: the number of consecutive values in each block. Defaults to bootstrap_block_days in the config
+        seed: seed of the random number generator so the intervals of a gauge are the same in every run
+
+    Returns:
+        dict of the lower ({metric}_lo) and upper ({metric}_hi) bounds of the CI_LEVEL confidence interval of each
+        metric, such as nse_corr_lo and nse_corr_hi. Empty if resamples is 0
+    """
+    resamples = int(get_state('bootstrap_resamples') or 0) if resamples is None else int(resamples)
+    block_days = int(get_state('bootstrap_block_days') or 1) if block_days is None else int(block_days)
+    n = len(obs)
+    if resamples <= 0 or n < 2:
+        return {}
+    block_days = min(max(block_days, 1), n)
+
+    obs, sim, mod = (np.asarray(values, dtype=np.float64) for values in (obs, sim, mod))
+    rng = np.random.default_rng(seed)
+    n_blocks = -(-n // block_days)
+    batch = max(RESAMPLE_BATCH_VALUES // n, 1)
+    results = {}
+    for start in range(0, resamples, batch):
+        size = min(batch, resamples - start)
+        # positions of each resample: consecutive blocks wrapped around the end of the series, trimmed to n values
+        starts = rng.integers(0, n, size=(size, n_blocks, 1))
+        positions = ((starts + np.arange(block_days)) % n).reshape(size, -1)[:, :n]
+        for name, metric in _resampled_metrics(obs[positions], sim=sim[positions], corr=mod[positions]).items():
+            results.setdefault(name, []).append(metric)
+
+    tail = (1 - CI_LEVEL) / 2 * 100
+    intervals = {}
+    for name, metric in results.items():
+        metric = np.concatenate(metric)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            intervals[f'{name}_lo'], intervals[f'{name}_hi'] = np.nanpercentile(metric, [tail, 100 - tail])
+    return intervals
+
+
+def _resampled_metrics(obs: np.ndarray, **preds: np.ndarray) -> dict:
+    """
+    Error metrics of each row of 2D arrays of predicted values compared to observed values. Same formulas as hydrostats.
+
+    Args:
+        obs: array (resamples, values) of observed discharge
+        **preds: arrays (resamples, values) of simulated or corrected discharge, named by the suffix of their metrics
+
+    Returns:
+        dict of the name of each metric, such as nse_sim, to an array of its value for each resample
+    """
+    n = obs.shape[1]
+    obs_mean = obs.mean(axis=1)
+    obs_anom = obs - obs_mean[:, None]
+    obs_ss = np.sum(obs_anom ** 2, axis=1)
+
+    metrics = {}
+    for kind, pred in preds.items():
+        diff = pred - obs
+        pred_mean = pred.mean(axis=1)
+        pred_anom = pred - pred_mean[:, None]
+        pred_ss = np.sum(pred_anom ** 2, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = np.sum(obs_anom * pred_anom, axis=1) / (np.sqrt(obs_ss) * np.sqrt(pred_ss))
+            beta = pred_mean / obs_mean
+            gamma = (np.sqrt(pred_ss / n) / pred_mean) / (np.sqrt(obs_ss / n) / obs_mean)
+            metrics[f'me_{kind}'] = diff.mean(axis=1)
+            metrics[f'mae_{kind}'] = np.abs(diff).mean(axis=1)
+            metrics[f'rmse_{kind}'] = np.sqrt(np.mean(diff ** 2, axis=1))
+            metrics[f'nse_{kind}'] = 1 - np.sum(diff ** 2, axis=1) / obs_ss
+            metrics[f'kge_{kind}'] = 1 - np.sqrt((r - 1) ** 2 + (gamma - 1) ** 2 + (beta - 1) ** 2)
+    return metrics
+
+
+def mp_metrics(assign_df: pd.DataFrame = None, shard: str or tuple = None, shard_by: str = 'outlet') -> pd.DataFrame:
     """
     Performs bootstrap validation using multiprocessing.
 
     Args:
         assign_df: pandas.DataFrame of the assignment table
+        shard: string 'i/N' or tuple (i, N) to only validate the gauges in one shard and write a part of the metrics
+            table. Combine the parts with saber.shard.merge_parts('bootstrap_metrics') after every shard finishes
+        shard_by: how to partition the gauges into shards, see saber.shard.shard_table
 
     Returns:
         None
@@ -166,21 +356,334 @@ def mp_metrics(assign_df: pd.DataFrame = None) -> pd.DataFrame:
 
     # subset the assign dataframe to only rows which contain gauges & reset the index
     assign_df = assign_df[assign_df[COL_GID].notna()].reset_index(drop=True)
+    if shard is not None:
+        assign_df = shard_table(assign_df, shard, by=shard_by).reset_index(drop=True)
+
+    # each task validates a batch of rows so the data of the next row is read while the current one is corrected
+    tasks = [[assign_df.iloc[i:i + METRICS_TASK_ROWS], gauge_data_dir, hindcast_zarr]
+             for i in range(0, len(assign_df), METRICS_TASK_ROWS)]
+    metrics_df = []
+    with get_executor() as p, Progress(len(assign_df), 'bootstrap_metrics', p) as progress:
+        for batch in p.istarmap(_map_metrics_rows, tasks):
+            for df in batch:
+                progress.update(df is not None)
+            metrics_df.extend(batch)
+    metrics_df = [df for df in metrics_df if df is not None]
+    if metrics_df:
+        metrics_df = pd.concat(metrics_df)
+    else:
+        metrics_df = pd.DataFrame(columns=['reach_id', 'gauge_id', 'asgn_reach_id'])
+
+    if shard is None:
+        write_table(metrics_df, 'bootstrap_metrics')
+    else:
+        write_part(metrics_df, 'bootstrap_metrics', shard)
+
+    return metrics_df
 
-    with Pool(get_state('n_processes')) as p:
-        metrics_df = pd.concat(
-            p.starmap(
-                metrics,
-                [[idx, assign_df, gauge_data_dir, hindcast_zarr] for idx in assign_df.index]
-            )
-        )
 
-    write_table(metrics_df, 'bootstrap_metrics')
+def parameter_sets(param_grid: dict or list) -> list:
+    """
+    Lists the sfdc_mapping parameter sets of a sweep. Parameters which are not given keep the values used by map_saber.
+
+    Args:
+        param_grid: dict of parameter names to a list of values to try, which makes a set for every combination of the
+            values, or a list of dicts of parameters, one per set
+
+    Returns:
+        list of dicts of the sfdc_mapping parameters of each set
+
+    Raises:
+        ValueError: if a parameter is not a setting of sfdc_mapping, or use_log is set with fix_seasonally True
+    """
+    if isinstance(param_grid, dict):
+        names = list(param_grid)
+        param_grid = [dict(zip(names, values)) for values in itertools.product(*param_grid.values())]
+    unknown = {name for params in param_grid for name in params} - set(CURVE_PARAMS) - set(APPLY_PARAMS)
+    if unknown:
+        raise ValueError(f'Unknown sfdc_mapping parameters: {", ".join(sorted(unknown))}. '
+                         f'Options: {", ".join(sorted(set(CURVE_PARAMS) | set(APPLY_PARAMS)))}')
+    # the monthly curves of fix_seasonally (the default of sfdc_mapping) are never log transformed, so every value of
+    # use_log would give the same metrics
+    if any('use_log' in params and params.get('fix_seasonally', True) for params in param_grid):
+        raise ValueError('use_log only changes the correction when fix_seasonally is False. '
+                         'Sweep use_log together with fix_seasonally: [False]')
+    return [{**SFDC_PARAMS, **params} for params in param_grid]
+
+
+def sweep(row: pd.Series, param_sets: list, gauge_data: str, hindcast_zarr: str) -> pd.DataFrame | None:
+    """
+    Performs bootstrap validation of one gauged river with each of a list of sfdc_mapping parameter sets. The data are
+    read once and the scalar flow duration curves of the assigned gauge are only recomputed for parameter sets which
+    change them.
 
+    Args:
+        row: the row of the bootstrap assignment table of the gauged river
+        param_sets: list of dicts of sfdc_mapping parameters, see parameter_sets
+        gauge_data: string path to the directory of observed data
+        hindcast_zarr: string path to the hindcast streamflow dataset
+
+    Returns:
+        pandas.DataFrame of the metrics of each parameter set which succeeded with its number in the param_set column,
+        or None if none did
+    """
+    mid = str(row[COL_MID])
+    asgn_mid = str(row[COL_ASN_MID])
+    try:
+        with span('read_gauge_csv', 'io', gauge_id=row[COL_ASN_GID]):
+            asgn_obs_df = cached_gauge_data(gauge_data, row[COL_ASN_GID])
+            obs_df = cached_gauge_data(gauge_data, row[COL_GID])
+        with span('read_hindcast', 'io', model_id=mid):
+            sim_df = cached_hindcast(hindcast_zarr, list(dict.fromkeys([asgn_mid, mid])))
+    except Exception as e:
+        logger.error(e)
+        logger.error(f'Failed bootstrap validation for {mid}')
+        return None
+    asgn_sim_df = sim_df[[asgn_mid]].set_axis([COL_QSIM], axis=1)
+
+    curves = {}
+    results = []
+    for param_set, params in enumerate(param_sets):
+        try:
+            if asgn_mid == mid:
+                corrected_df = fdc_mapping(asgn_sim_df, asgn_obs_df)
+            else:
+                curve_params = _select(params, CURVE_PARAMS)
+                key = repr(sorted(curve_params.items()))
+                if key not in curves:
+                    with span('sfdc_curves', 'fdc', gauge_id=row[COL_ASN_GID]):
+                        curves[key] = sfdc_curves(asgn_sim_df, asgn_obs_df, **curve_params)
+                with span('sfdc_apply', 'fdc', model_id=mid, param_set=param_set):
+                    corrected_df = sfdc_apply(curves[key], sim_df[[mid]], **_select(params, APPLY_PARAMS))[0]
+            if corrected_df is None:
+                continue
+            metrics_df = _metrics_table(corrected_df, obs_df, row, resamples=0)
+            if metrics_df is not None:
+                results.append(metrics_df.assign(param_set=param_set))
+        except Exception as e:
+            logger.error(e)
+            logger.error(f'Failed bootstrap validation for {mid} with parameter set {param_set}')
+    return pd.concat(results) if results else None
+
+
+def mp_sweep(param_grid: dict or list, assign_df: pd.DataFrame = None, shard: str or tuple = None,
+             shard_by: str = 'outlet') -> pd.DataFrame:
+    """
+    Performs bootstrap validation with every sfdc_mapping parameter set of a sweep in one pass over the gauges, so a
+    sweep costs little more than mp_metrics. Writes the bootstrap_sweep table: the metrics of every gauge and parameter
+    set with the parameters of the set in the columns after param_set.
+
+    Args:
+        param_grid: the parameters to sweep, see parameter_sets. For example
+            {'outlier_threshold': [2.5, 3], 'fit_range': [(5, 95), (10, 90)]}
+        assign_df: pandas.DataFrame of the bootstrap assignment table
+        shard: string 'i/N' or tuple (i, N) to only validate the gauges in one shard and write a part of the sweep
+            table. Combine the parts with saber.shard.merge_parts('bootstrap_sweep') after every shard finishes
+        shard_by: how to partition the gauges into shards, see saber.shard.shard_table
+
+    Returns:
+        pandas.DataFrame of the sweep table
+    """
+    param_sets = parameter_sets(param_grid)
+    logger.info(f'Collecting Performance Metrics of {len(param_sets)} parameter sets')
+
+    if assign_df is None:
+        assign_df = read_table('assign_table_bootstrap')
+
+    gauge_data_dir = get_state('gauge_data')
+    hindcast_zarr = get_state('hindcast_zarr')
+
+    assign_df = assign_df[assign_df[COL_GID].notna()].reset_index(drop=True)
+    if shard is not None:
+        assign_df = shard_table(assign_df, shard, by=shard_by).reset_index(drop=True)
+
+    with get_executor() as p, Progress(len(assign_df), 'bootstrap_sweep', p) as progress:
+        sweep_df = list(progress.track(p.istarmap(
+            sweep,
+            [[row, param_sets, gauge_data_dir, hindcast_zarr] for _, row in assign_df.iterrows()]
+        )))
+    sweep_df = [df for df in sweep_df if df is not None]
+    sweep_df = pd.concat(sweep_df) if sweep_df else pd.DataFrame(columns=['reach_id', 'gauge_id', 'asgn_reach_id'])
+
+    params_df = pd.DataFrame(param_sets).astype(str).rename_axis('param_set').reset_index()
+    sweep_df = pd.merge(params_df, sweep_df, on='param_set', how='right') if 'param_set' in sweep_df else sweep_df
+    sweep_df = sweep_df.sort_values(['param_set', 'reach_id'], kind='stable') if len(sweep_df) else sweep_df
+
+    if shard is None:
+        write_table(sweep_df, 'bootstrap_sweep')
+    else:
+        write_part(sweep_df, 'bootstrap_sweep', shard)
+
+    return sweep_df
+
+
+def cv_folds(gauges_df: pd.DataFrame, k: int = 10, by: str = 'random', seed: int = 0) -> pd.Series:
+    """
+    Splits the gauged rows of the assignment table into k folds for cross validation. Spatially blocked folds keep
+    every gauge of a drainage basin (by='outlet') or of a cluster (by='cluster') in the same fold, so no gauge is
+    validated with a gauge from its own basin or cluster. Blocks are added largest first to the fold with the fewest
+    gauges.
+
+    Args:
+        gauges_df: the gauged rows of the assignment table
+        k: the number of folds. Blocked folds use fewer folds if there are fewer blocks
+        by: 'random', 'outlet', or 'cluster'
+        seed: seed of the random order of the gauges or blocks
+
+    Returns:
+        pd.Series of the fold number (0 to k - 1) of each row, with the index of gauges_df
+
+    Raises:
+        ValueError: if by is not an option or there are fewer than 2 folds
+    """
+    if by not in CV_BLOCKS:
+        raise ValueError(f'Invalid cross validation blocks: {by}. Options: {", ".join(CV_BLOCKS)}')
+    rng = np.random.default_rng(seed)
+
+    if by == 'random':
+        blocks = pd.Series(np.arange(len(gauges_df)), index=gauges_df.index)
+    else:
+        blocks = gauges_df[CV_BLOCKS[by]].astype(str)
+    sizes = blocks.value_counts()
+    sizes = sizes.iloc[rng.permutation(len(sizes))].sort_values(ascending=False, kind='stable')
+    if len(sizes) < k:
+        logger.warning(f'Only {len(sizes)} blocks by {by}, using {len(sizes)} folds instead of {k}')
+        k = len(sizes)
+    if k < 2:
+        raise ValueError('Cross validation needs at least 2 folds')
+
+    counts = np.zeros(k, dtype=int)
+    block_folds = {}
+    for block, size in sizes.items():
+        block_folds[block] = int(np.argmin(counts))
+        counts[block_folds[block]] += size
+    return blocks.map(block_folds).rename('fold')
+
+
+def cv_table(assign_df: pd.DataFrame, folds: pd.Series) -> pd.DataFrame:
+    """
+    Assigns each gauged river a gauge from outside its fold following the same rules as mp_table: the gauge of a
+    regulatory structure, then a gauge propagated along the network, then the nearest gauge in the same cluster, or
+    of any cluster if the cluster has no gauge outside the fold. The nearest gauges of every river of a fold are found
+    at once from a masked matrix of distances.
+
+    Args:
+        assign_df: pandas.DataFrame of the assignment table
+        folds: the fold number of each gauged row of the assignment table, see cv_folds
+
+    Returns:
+        pandas.DataFrame of the gauged rows with their new assignments and a fold column
+    """
+    gauges_df = assign_df[assign_df[COL_GID].notna()].copy()
+    gauges_df['fold'] = folds.reindex(gauges_df.index).values
+    gauges_df[COL_ASN_REASON] = gauges_df[COL_ASN_REASON].astype(object)
+    gauge_mids = gauges_df[COL_MID].astype(str).values
+    xy = gauges_df[[COL_X, COL_Y]].to_numpy(dtype=np.float64)
+    clusters = gauges_df[COL_CID].to_numpy()
+
+    for fold in sorted(gauges_df['fold'].dropna().unique()):
+        test = (gauges_df['fold'] == fold).to_numpy()
+        test_idx = gauges_df.index[test]
+        train_df = gauges_df[~test]
+        train_mids = pd.Series(np.arange(len(train_df)), index=gauge_mids[~test])
+        train_mids = train_mids[~train_mids.index.duplicated()]
+
+        # the gauges of regulatory structures and of propagation along the network, when they are outside the fold
+        rprop = gauges_df.loc[test_idx, COL_RPROP].fillna('').astype(str)
+        gprop = gauges_df.loc[test_idx, COL_GPROP].fillna('').astype(str)
+        regulatory = rprop.isin(train_mids.index).to_numpy()
+        near = ~regulatory & gprop.isin(train_mids.index).to_numpy()
+        chosen = np.where(regulatory, train_mids.reindex(rprop).to_numpy(), train_mids.reindex(gprop).to_numpy())
+        reasons = np.where(regulatory, 'regulatory', 'near_gauge').astype(object)
+
+        # the nearest gauge of the same cluster, or of any cluster when all of the cluster's gauges are in the fold
+        rest = ~(regulatory | near)
+        if rest.any():
+            distances = np.sqrt(((xy[test][rest, None, :] - xy[~test][None, :, :]) ** 2).sum(axis=2))
+            same_cluster = clusters[test][rest, None] == clusters[~test][None, :]
+            mask = same_cluster | ~same_cluster.any(axis=1, keepdims=True)
+            chosen[rest] = np.argmin(np.where(mask, distances, np.inf), axis=1)
+            reasons[rest] = [f'nearest_cluster_{cluster}' for cluster in clusters[test][rest]]
+
+        chosen = chosen.astype(int)
+        gauges_df.loc[test_idx, COL_ASN_MID] = train_df[COL_MID].values[chosen]
+        gauges_df.loc[test_idx, COL_ASN_GID] = train_df[COL_GID].values[chosen]
+        gauges_df.loc[test_idx, COL_ASN_REASON] = reasons
+
+    return gauges_df
+
+
+def mp_cross_validate(k: int = 10, by: str = 'random', assign_df: pd.DataFrame = None, seed: int = 0) -> pd.DataFrame:
+    """
+    K-fold cross validation of the bias correction. Each gauge is held out once with the rest of its fold, assigned a
+    gauge from the other folds with cv_table, corrected, and compared with its observed data. The rivers of every fold
+    are grouped by their assigned gauge, so the scalar flow duration curves of each gauge are computed once for all
+    folds and k folds cost about as much as mp_metrics. Writes the bootstrap_cv table: the metrics of each gauge with
+    its fold.
+
+    Args:
+        k: the number of folds
+        by: 'random' folds, or folds blocked by basin ('outlet') or by cluster ('cluster'), see cv_folds
+        assign_df: pandas.DataFrame of the assignment table. Defaults to the assign_table in the workdir
+        seed: seed of the random order of the gauges or blocks
+
+    Returns:
+        pandas.DataFrame of the cross validation metrics
+    """
+    logger.info(f'Collecting Performance Metrics of {k}-fold cross validation by {by}')
+
+    if assign_df is None:
+        assign_df = read_table('assign_table')
+    gauge_data_dir = get_state('gauge_data')
+    hindcast_zarr = get_state('hindcast_zarr')
+
+    gauged_df = assign_df[assign_df[COL_GID].notna()]
+    cv_df = cv_table(assign_df, cv_folds(gauged_df, k, by, seed)).reset_index(drop=True)
+    tasks = [[cv_df[cv_df[COL_MID].isin(mids)], asgn_mid, asgn_gid, gauge_data_dir, hindcast_zarr]
+             for mids, asgn_mid, asgn_gid in _gauge_groups(cv_df)]
+
+    metrics_df = []
+    with get_executor() as p, Progress(len(cv_df), 'bootstrap_cv', p) as progress:
+        for results in p.istarmap(_map_cv_group, tasks):
+            for result in results:
+                progress.update(result is not None)
+            metrics_df.extend(result for result in results if result is not None)
+    if metrics_df:
+        metrics_df = pd.concat(metrics_df)
+    else:
+        metrics_df = pd.DataFrame(columns=['reach_id', 'gauge_id', 'asgn_reach_id'])
+    metrics_df = metrics_df.sort_values(['fold', 'reach_id'], kind='stable') if len(metrics_df) else metrics_df
+
+    write_table(metrics_df, 'bootstrap_cv')
     return metrics_df
 
 
-def postprocess_metrics(bdf: pd.DataFrame = pd.DataFrame or None, gauge_gdf: gpd.GeoDataFrame = None) -> None:
+def _map_cv_group(rows_df: pd.DataFrame, asgn_mid: str, asgn_gid: str, gauge_data: str, hindcast_zarr: str) -> list:
+    """
+    Helper function for mp_cross_validate which corrects the held out rivers assigned to the same gauge together and
+    computes their metrics. Separate function so it can be pickled for multiprocessing.
+
+    Returns:
+        list of a pandas.DataFrame of the metrics of each row, or None for the rows which failed
+    """
+    corrected = map_saber_group(rows_df[COL_MID].tolist(), asgn_mid, asgn_gid, hindcast_zarr, gauge_data)
+    results = []
+    for (_, row), corrected_df in zip(rows_df.iterrows(), corrected):
+        try:
+            if corrected_df is None:
+                logger.warning(f'No corrected data for {row[COL_MID]}')
+                results.append(None)
+                continue
+            metrics_df = _metrics_table(corrected_df, cached_gauge_data(gauge_data, row[COL_GID]), row)
+            results.append(None if metrics_df is None else metrics_df.assign(fold=row['fold']))
+        except Exception as e:
+            logger.error(e)
+            logger.error(f'Failed cross validation for {row[COL_MID]}')
+            results.append(None)
+    return results
+
+
+def postprocess_metrics(bdf: pd.DataFrame = pd.DataFrame or None, gauge_gdf: 'gpd.GeoDataFrame' = None) -> None:
     """
     Creates a geopackge of the gauge locations with added attributes for metrics calculated during the bootstrap
     validation.
@@ -233,6 +736,9 @@ def histograms(bdf: pd.DataFrame = None) -> None:
     Returns:
         None
     """
+    import seaborn as sns
+    from matplotlib import pyplot as plt
+
     if bdf is None:
         bdf = read_table('bootstrap_metrics')
 
@@ -295,6 +801,8 @@ def pie_charts(bdf: pd.DataFrame = None) -> None:
     Returns:
         None
     """
+    from matplotlib import pyplot as plt
+
     if bdf is None:
         bdf = read_table('bootstrap_metrics')
 
@@ -0,0 +1,275 @@
+import collections
+import concurrent.futures
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from .executor import parse_memory
+from .io import get_state
+from .io import read_hindcast
+from .trace import counter
+
+__all__ = ['LRUCache', 'get_cache', 'cache_stats', 'cached_hindcast', 'cached_gauge_data', 'prefetch', ]
+
+logger = logging.getLogger(__name__)
+
+# seconds between the reports of the cache statistics of each process
+STATS_INTERVAL = 60
+
+# the most reads run ahead of the computation of each process by prefetch
+PREFETCH_DEPTH = 2
+
+# the most values of each object column of a large DataFrame measured to estimate its size
+NBYTES_SAMPLE = 1000
+
+# the cache of this process and the times of the hindcast periods read by it
+_cache = None
+_hindcast_times = {}
+
+
+class LRUCache:
+    """
+    Least recently used cache of arrays and DataFrames which holds at most max_bytes. The least recently used values are
+    dropped to make room for new ones. Counts hits, misses, and evictions so the budget can be sized from the hit rate.
+
+    Args:
+        max_bytes: the most bytes of values to keep. 0 keeps nothing
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = int(max_bytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._values = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._reported = time.monotonic()
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def get(self, key, default=None):
+        """
+        Finds a value in the cache and marks it as the most recently used
+
+        Args:
+            key: the key of the value
+            default: returned if the key is not in the cache
+
+        Returns:
+            the cached value or default
+        """
+        with self._lock:
+            if key in self._values:
+                self._values.move_to_end(key)
+                self.hits += 1
+                value = self._values[key][0]
+            else:
+                self.misses += 1
+                value = default
+        self._report()
+        return value
+
+    def put(self, key, value) -> None:
+        """
+        Adds a value to the cache, dropping the least recently used values until it fits in the budget. Values larger
+        than the budget are not kept.
+
+        Args:
+            key: the key of the value
+            value: a numpy array, pandas DataFrame, or pandas Series
+
+        Returns:
+            None
+        """
+        nbytes = _nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._values:
+                self.nbytes -= self._values.pop(key)[1]
+            while self._values and self.nbytes + nbytes > self.max_bytes:
+                self.nbytes -= self._values.popitem(last=False)[1][1]
+                self.evictions += 1
+            self._values[key] = (value, nbytes)
+            self.nbytes += nbytes
+        return
+
+    def clear(self) -> None:
+        """
+        Removes every value from the cache and resets the statistics
+        """
+        with self._lock:
+            self._values.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+        return
+
+    def stats(self) -> dict:
+        """
+        Statistics of the cache: hits, misses, hit_rate, evictions, entries, mb used, and max_mb budget
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+                'entries': len(self._values),
+                'mb': round(self.nbytes / 1024 ** 2, 1),
+                'max_mb': round(self.max_bytes / 1024 ** 2, 1),
+            }
+
+    def _report(self) -> None:
+        # each worker process has its own cache so each one logs its statistics
+        if time.monotonic() - self._reported < STATS_INTERVAL:
+            return
+        self._reported = time.monotonic()
+        stats = self.stats()
+        counter('cache', 'cache', hits=stats['hits'], misses=stats['misses'], mb=stats['mb'])
+        logger.info(f'Cache of process {os.getpid()}: {stats["hits"]} hits, {stats["misses"]} misses, '
+                    f'{stats["evictions"]} evictions, {stats["mb"]:.0f} of {stats["max_mb"]:.0f} MB used')
+        return
+
+
+def get_cache() -> LRUCache:
+    """
+    The cache of river and gauge series and tables of this process, sized by cache_size in the config. Every worker
+    process has its own cache which lasts as long as the process, so a persistent executor keeps the cache warm between
+    stages.
+
+    Returns:
+        LRUCache
+    """
+    global _cache
+    max_bytes = int((parse_memory(get_state('cache_size')) or 0) * 1024 ** 2)
+    if _cache is None or _cache.max_bytes != max_bytes:
+        _cache = LRUCache(max_bytes)
+    return _cache
+
+
+def cache_stats() -> dict:
+    """
+    Hit, miss, eviction, and size statistics of the cache of this process. See LRUCache.stats
+    """
+    return get_cache().stats()
+
+
+def cached_hindcast(hindcast_zarr: str, model_ids: list, keep: list = None) -> pd.DataFrame:
+    """
+    Reads the simulated discharge of some rivers within the correction period like saber.io.read_hindcast, using the
+    series in the cache and reading the rest from the hindcast zarr in one request
+
+    Args:
+        hindcast_zarr: path to the hindcast streamflow zarr
+        model_ids: the model ids of the rivers to read
+        keep: the model ids whose series are added to the cache when they are read. Defaults to all of them. Rivers
+            which are only read once, such as most of the rivers corrected with one gauge, can be left out so they do
+            not push more useful series out of the cache.
+
+    Returns:
+        pd.DataFrame with a datetime index and a column of discharge per model id, named by the model id as a string
+    """
+    model_ids = [str(mid) for mid in model_ids]
+    keep = model_ids if keep is None else [str(mid) for mid in keep]
+    cache = get_cache()
+    period = (hindcast_zarr, get_state('start_date'), get_state('end_date'))
+    columns = {mid: cache.get(('hindcast', *period, mid)) for mid in model_ids}
+
+    missing = [mid for mid, values in columns.items() if values is None]
+    if missing:
+        read_df = read_hindcast(hindcast_zarr, missing)
+        _hindcast_times.setdefault(period, read_df.index)
+        for mid in missing:
+            columns[mid] = read_df[mid].to_numpy(copy=True)
+            if mid in keep:
+                cache.put(('hindcast', *period, mid), columns[mid])
+    elif period not in _hindcast_times:
+        return read_hindcast(hindcast_zarr, model_ids)
+
+    return pd.DataFrame(np.column_stack(list(columns.values())), index=_hindcast_times[period], columns=model_ids)
+
+
+def cached_gauge_data(gauge_data: str, gauge_id: str) -> pd.DataFrame:
+    """
+    Reads the observed discharge csv of a gauge, using the cache when it has already been read
+
+    Args:
+        gauge_data: path to the directory of observed data
+        gauge_id: the gauge id
+
+    Returns:
+        pd.DataFrame with a datetime index and a column of discharge
+    """
+    key = ('gauge', gauge_data, str(gauge_id))
+    cache = get_cache()
+    obs_df = cache.get(key)
+    if obs_df is None:
+        obs_df = pd.read_csv(os.path.join(gauge_data, f'{gauge_id}.csv'), index_col=0)
+        obs_df.index = pd.to_datetime(obs_df.index)
+        cache.put(key, obs_df)
+    # copies so callers may change the DataFrame without changing the cached one
+    return obs_df.copy()
+
+
+def prefetch(loaders, depth: int = PREFETCH_DEPTH):
+    """
+    Reads the data of the next items in a background thread while the caller processes the current item, so reading
+    from disk overlaps with computing. At most depth reads run or wait ahead of the caller, which bounds the memory
+    held by data which has been read but not used.
+
+    Args:
+        loaders: iterable of callables without arguments which read the data of each item, in the order it is used
+        depth: the most reads ahead of the caller. 0 reads each item when the caller asks for it
+
+    Yields:
+        concurrent.futures.Future of the result of each loader, in order. result() returns the data or raises the
+        error of the read
+    """
+    loaders = iter(loaders)
+    if depth < 1:
+        for loader in loaders:
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(loader())
+            except Exception as e:
+                future.set_exception(e)
+            yield future
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='saber-prefetch') as pool:
+        pending = collections.deque(pool.submit(loader) for loader in itertools.islice(loaders, depth))
+        while pending:
+            future = pending.popleft()
+            pending.extend(pool.submit(loader) for loader in itertools.islice(loaders, 1))
+            yield future
+
+
+def _nbytes(value) -> int:
+    if isinstance(value, pd.Series):
+        value = value.to_frame()
+    if not isinstance(value, pd.DataFrame):
+        return int(getattr(value, 'nbytes', 0))
+    if len(value) <= NBYTES_SAMPLE:
+        return int(np.sum(value.memory_usage(index=True, deep=True)))
+    # measuring every string of a large table takes about as long as reading it, so the strings of each object column
+    # are estimated from evenly spaced values
+    nbytes = int(np.sum(value.memory_usage(index=True, deep=False)))
+    step = len(value) // NBYTES_SAMPLE
+    for name in value.columns[value.dtypes == object]:
+        sample = value[name].values[::step]
+        nbytes += int(sum(map(sys.getsizeof, sample)) * len(value) / len(sample))
+    return nbytes
@@ -0,0 +1,80 @@
+import argparse
+import logging
+
+from .io import read_config
+from .pipeline import STAGES
+from .pipeline import merge
+from .pipeline import run
+from .pipeline import status
+from .service import serve
+
+__all__ = ['main', ]
+
+
+def main(args: list = None) -> None:
+    """
+    Command line interface to the SABER workflow
+
+    Args:
+        args: list of command line arguments. Defaults to sys.argv
+
+    Returns:
+        None
+    """
+    stage_names = [s.name for s in STAGES]
+
+    parser = argparse.ArgumentParser(prog='saber', description='SABER hydrologic bias correction')
+    parser.add_argument('--log-level', default='INFO', help='python logging level (default INFO)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='run every stage of the workflow which is out of date')
+    run_parser.add_argument('config', help='path to the config file')
+    run_parser.add_argument('--stages', nargs='+', choices=stage_names, metavar='STAGE',
+                            help=f'only run these stages and their upstream stages. Options: {", ".join(stage_names)}')
+    run_parser.add_argument('--force', nargs='*', choices=stage_names, metavar='STAGE',
+                            help='rerun these stages (or every selected stage if none are listed) even if up to date')
+    run_parser.add_argument('--dry-run', action='store_true', help='list the stages which would run and exit')
+    run_parser.add_argument('--shard', metavar='i/N',
+                            help='only run the i-th of N parts of the shardable stages (bootstrap_metrics, '
+                                 'gauge_sfdcs, correction). Run "saber merge" after every shard finishes')
+    run_parser.add_argument('--shard-by', default='outlet', choices=['outlet', 'chunk'],
+                            help='partition shards by basin outlet or by hindcast zarr chunk (default outlet)')
+
+    merge_parser = subparsers.add_parser('merge', help='combine the outputs written by each shard')
+    merge_parser.add_argument('config', help='path to the config file')
+    merge_parser.add_argument('--stages', nargs='+', choices=stage_names, metavar='STAGE',
+                              help='only merge these stages')
+
+    status_parser = subparsers.add_parser('status', help='report which stages of the workflow are out of date')
+    status_parser.add_argument('config', help='path to the config file')
+
+    serve_parser = subparsers.add_parser('serve', help='serve corrected discharge over HTTP from the compiled tables')
+    serve_parser.add_argument('config', help='path to the config file')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default 127.0.0.1)')
+    serve_parser.add_argument('--port', type=int, default=8080, help='port to listen on (default 8080)')
+    serve_parser.add_argument('--preload', action='store_true',
+                              help='correct every river before serving so no request waits for the hindcast')
+
+    args = parser.parse_args(args)
+
+    logging.basicConfig(
+        level=args.log_level.upper(),
+        datefmt='%Y-%m-%d %X',
+        format='%(asctime)s: [%(name)s:%(lineno)d] %(levelname)s - %(message)s'
+    )
+
+    if args.command == 'run':
+        force = True if args.force == [] else (args.force or False)
+        ran = run(args.config, stages=args.stages, force=force, dry_run=args.dry_run,
+                  shard=args.shard, shard_by=args.shard_by)
+        print(f'{"Stale" if args.dry_run else "Ran"} stages: {", ".join(ran) if ran else "none"}')
+    elif args.command == 'merge':
+        merged = merge(args.config, stages=args.stages)
+        print(f'Merged stages: {", ".join(merged) if merged else "none"}')
+    elif args.command == 'status':
+        for name, stage_status in status(args.config).items():
+            print(f'{name:<24}{stage_status}')
+    elif args.command == 'serve':
+        read_config(args.config)
+        serve(args.host, args.port, preload=args.preload)
+    return
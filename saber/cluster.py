@@ -1,29 +1,29 @@
 import glob
+import json
 import logging
 import math
 import os
 from collections.abc import Iterable
 
 import joblib
-import matplotlib.cm as cm
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from kneed import KneeLocator
 from natsort import natsorted
-from sklearn.cluster import MiniBatchKMeans
-from sklearn.metrics import silhouette_samples
 
+from .io import CLUSTER_COUNT_JSON
+from .io import CLUSTER_PCA_PICKLE
 from .io import COL_CID
 from .io import COL_MID
+from .io import _get_table_path
 from .io import get_dir
+from .io import get_state
 from .io import list_cluster_files
 from .io import read_table
 from .io import write_table
 
 __all__ = [
     'cluster',
-    'generate',
+    'generate', 'generate_chunked', 'search', 'best_cluster_count',
     'summarize_fit', 'calc_silhouette',
     'plot_fit_metrics', 'plot_centers', 'plot_clusters', 'plot_silhouettes',
     'predict_labels'
@@ -31,6 +31,18 @@ __all__ = [
 
 logger = logging.getLogger(__name__)
 
+# the rows of each partial_fit step when the models are trained on chunks of cluster_data, and the rows sampled from
+# the chunks to fit the initial centers of the models
+BATCH_ROWS = 1024
+INIT_ROWS = 20_000
+
+# the automatic search of the number of clusters: the spacing of the coarse grid of numbers, the n_init of the cheap
+# models trained on SEARCH_ROWS sampled rows, and the rows sampled to compute their silhouette scores
+COARSE_STEP = 3
+COARSE_N_INIT = 3
+SEARCH_ROWS = 200_000
+SILHOUETTE_ROWS = 10_000
+
 
 def cluster(plot: bool = False) -> None:
     """
@@ -44,13 +56,29 @@ def cluster(plot: bool = False) -> None:
     """
     logger.info('Generate Clusters')
 
-    x_fdc_train = read_table("cluster_data").values
-    generate(x=x_fdc_train)
-    summarize_fit()
-    # calc_silhouette(workdir, x=x_fdc_train, n_clusters=range(2, 10))
-
-    if not plot:
-        return
+    chunk_rows = get_state('cluster_chunk_rows')
+    method = get_state('cluster_search')
+    if chunk_rows:
+        # cluster_data is streamed so it is only read into memory for the plots
+        if method:
+            search(method=method, chunk_rows=int(chunk_rows), pca=get_state('cluster_pca'))
+        else:
+            generate(chunk_rows=int(chunk_rows), pca=get_state('cluster_pca'))
+        summarize_fit()
+        if not plot:
+            return
+        x_fdc_train = read_table('cluster_data').values
+    else:
+        x_fdc_train = read_table("cluster_data").values
+        if method:
+            search(x=x_fdc_train, method=method, pca=get_state('cluster_pca'))
+        else:
+            generate(x=x_fdc_train, pca=get_state('cluster_pca'))
+        summarize_fit()
+        # calc_silhouette(workdir, x=x_fdc_train, n_clusters=range(2, 10))
+
+        if not plot:
+            return
 
     logger.info('Create Plots')
     plot_clusters(x=x_fdc_train)
@@ -60,22 +88,37 @@ def cluster(plot: bool = False) -> None:
     return
 
 
-def generate(x: np.ndarray = None, max_clusters: int = 13) -> None:
+def generate(x: np.ndarray = None, max_clusters: int = 13, chunk_rows: int = None,
+             pca: int or float = None, n_clusters: Iterable = None) -> None:
     """
     Trains scikit-learn MiniBatchKMeans models and saves as pickle
 
     Args:
         x: a numpy array of the prepared FDC data
         max_clusters: maximum number of clusters to train
+        chunk_rows: train every model at once from chunks of about this many rows of x, or of the parquet row groups of
+            cluster_data when x is not given, so the FDC data are never in memory at once. See generate_chunked
+        pca: project the FDC data onto this many principal components, or as many as keep this fraction of the
+            variance if it is less than 1, before training. The projection is saved with the models and used by
+            predict_labels and calc_silhouette. None trains on the FDC data
+        n_clusters: the numbers of clusters to train. Defaults to every number from 2 to max_clusters
 
     Returns:
         None
     """
+    from sklearn.cluster import MiniBatchKMeans
+
+    _remove_search_result()
+    if chunk_rows:
+        return generate_chunked(x, max_clusters, chunk_rows, pca, n_clusters)
+
     if x is None:
         x = read_table('cluster_data').values
+    x = _project(x, _fit_projection(x, pca))
 
     # build the kmeans model for a range of cluster numbers
-    for n_clusters in range(2, max_clusters + 1):
+    counts = range(2, max_clusters + 1) if n_clusters is None else n_clusters
+    for n_clusters in counts:
         logger.info(f'Clustering n={n_clusters}')
         kmeans = MiniBatchKMeans(n_clusters=n_clusters, init='k-means++', n_init=100)
         kmeans.fit_predict(x)
@@ -83,6 +126,274 @@ def generate(x: np.ndarray = None, max_clusters: int = 13) -> None:
     return
 
 
+def generate_chunked(x: np.ndarray = None, max_clusters: int = 13, chunk_rows: int = 100_000,
+                     pca: int or float = None, n_clusters: Iterable = None) -> None:
+    """
+    Trains scikit-learn MiniBatchKMeans models with partial_fit on chunks of the FDC data and saves as pickle. The
+    initial centers of each model are fit to a sample of INIT_ROWS rows drawn from every chunk, so data sorted by region
+    does not start every center in the first region. Then every model is updated with each chunk in one pass over the
+    data, in steps of BATCH_ROWS rows, and a last pass computes the labels and inertia of each model. The memory used is
+    one chunk, the sample, and the labels of every row.
+
+    Args:
+        x: a numpy array of the prepared FDC data. Defaults to reading cluster_data in chunks
+        max_clusters: maximum number of clusters to train
+        chunk_rows: the most rows in memory at once. Parquet row groups larger than this are read in parts
+        pca: the principal components to project the FDC data onto, see generate. Fit to the sample of INIT_ROWS rows
+        n_clusters: the numbers of clusters to train. Defaults to every number from 2 to max_clusters
+
+    Returns:
+        None
+    """
+    from sklearn.cluster import KMeans
+    from sklearn.cluster import MiniBatchKMeans
+
+    _remove_search_result()
+    sample = _sample_rows(x, INIT_ROWS, chunk_rows)
+    projection = _fit_projection(sample, pca)
+    sample = _project(sample, projection)
+
+    models = {}
+    counts = range(2, max_clusters + 1) if n_clusters is None else n_clusters
+    for n_clusters in counts:
+        init = KMeans(n_clusters=n_clusters, init='k-means++', n_init=10).fit(sample).cluster_centers_
+        # centers are not moved to random rows when few rows were assigned to them, which happens to every center of
+        # the regions later in the data when it is sorted
+        models[n_clusters] = MiniBatchKMeans(n_clusters=n_clusters, init=init, n_init=1, compute_labels=False,
+                                             reassignment_ratio=0)
+
+    logger.info(f'Clustering n={min(models)} to n={max(models)} in chunks of {chunk_rows} of {_count_rows(x)} rows')
+    for chunk in _chunks(x, chunk_rows):
+        chunk = _project(chunk, projection)
+        for start in range(0, len(chunk), BATCH_ROWS):
+            batch = chunk[start:start + BATCH_ROWS]
+            for kmeans in models.values():
+                kmeans.partial_fit(batch)
+
+    labels = {n_clusters: [] for n_clusters in models}
+    inertia = dict.fromkeys(models, 0.0)
+    for chunk in _chunks(x, chunk_rows):
+        chunk = _project(chunk, projection)
+        for n_clusters, kmeans in models.items():
+            chunk_labels = kmeans.predict(chunk)
+            labels[n_clusters].append(chunk_labels.astype(np.int32))
+            inertia[n_clusters] += float(np.sum((chunk - kmeans.cluster_centers_[chunk_labels]) ** 2, dtype=np.float64))
+
+    for n_clusters, kmeans in models.items():
+        # the attributes fit sets which summarize_fit, calc_silhouette and plot_clusters use
+        kmeans.labels_ = np.concatenate(labels[n_clusters])
+        kmeans.inertia_ = inertia[n_clusters]
+        kmeans.n_iter_ = 1
+        joblib.dump(kmeans, os.path.join(get_dir('clusters'), f'kmeans-{n_clusters}.pickle'))
+    return
+
+
+def search(x: np.ndarray = None, max_clusters: int = 13, method: str = 'knee', chunk_rows: int = None,
+           pca: int or float = None) -> int:
+    """
+    Chooses the number of clusters without training a full model for every number. Cheap models with COARSE_N_INIT
+    initializations are trained on a sample of SEARCH_ROWS rows for every COARSE_STEP-th number of clusters, then for
+    the numbers around the best of those, and the best number is chosen from the knee of their inertia or their highest
+    silhouette score. Full models are trained for the chosen number and its neighbors with generate, replacing the
+    models of other numbers, and the search is written to best-fit-cluster-count.json in the clusters directory.
+
+    Args:
+        x: a numpy array of the prepared FDC data. Defaults to cluster_data
+        max_clusters: maximum number of clusters to consider
+        method: 'knee' of the inertia or 'silhouette' score. The silhouette is used when the inertia has no knee
+        chunk_rows: train the full models from chunks of this many rows, see generate
+        pca: the principal components to project the FDC data onto, see generate
+
+    Returns:
+        int: the chosen number of clusters
+
+    Raises:
+        ValueError: if method is not 'knee' or 'silhouette'
+    """
+    from kneed import KneeLocator
+    from sklearn.cluster import MiniBatchKMeans
+    from sklearn.metrics import silhouette_score
+
+    if method not in ('knee', 'silhouette'):
+        raise ValueError(f'Unknown cluster search method: {method}')
+
+    sample = x if x is not None and len(x) <= SEARCH_ROWS else _sample_rows(x, SEARCH_ROWS, chunk_rows or 100_000)
+    sample = _project(sample, _fit_projection(sample, pca))
+    inertia = {}
+    silhouette = {}
+
+    def evaluate(counts: Iterable) -> int:
+        for n_clusters in counts:
+            if n_clusters in inertia:
+                continue
+            kmeans = MiniBatchKMeans(n_clusters=n_clusters, init='k-means++', n_init=COARSE_N_INIT, random_state=0)
+            labels = kmeans.fit_predict(sample)
+            inertia[n_clusters] = float(kmeans.inertia_)
+            silhouette[n_clusters] = float(silhouette_score(
+                sample, labels, sample_size=min(SILHOUETTE_ROWS, len(sample)), random_state=0))
+            logger.info(f'Search n={n_clusters}: inertia {inertia[n_clusters]:.4g}, silhouette '
+                        f'{silhouette[n_clusters]:.3f}')
+        numbers = sorted(inertia)
+        knee = None
+        if method == 'knee' and len(numbers) > 2:
+            knee = KneeLocator(numbers, [inertia[n] for n in numbers], curve='convex', direction='decreasing').knee
+        return int(knee) if knee is not None else max(numbers, key=silhouette.get)
+
+    coarse = list(range(2, max_clusters + 1, COARSE_STEP))
+    best = evaluate(coarse)
+    refined = [n for n in range(max(2, best - COARSE_STEP + 1), min(max_clusters, best + COARSE_STEP - 1) + 1)
+               if n not in coarse]
+    best = evaluate(refined)
+    logger.info(f'Search chose n={best} clusters by {method} from {sorted(inertia)}')
+
+    # only the chosen number and its neighbors are trained in full, so models of other numbers are out of date
+    trained = [n for n in (best - 1, best, best + 1) if 2 <= n <= max_clusters]
+    _remove_models()
+    generate(x, max_clusters, chunk_rows, pca, n_clusters=trained)
+
+    with open(os.path.join(get_dir('clusters'), CLUSTER_COUNT_JSON), 'w') as f:
+        json.dump({
+            'n_clusters': best,
+            'method': method,
+            'coarse': coarse,
+            'refined': refined,
+            'trained': trained,
+            'inertia': {str(n): inertia[n] for n in sorted(inertia)},
+            'silhouette': {str(n): silhouette[n] for n in sorted(silhouette)},
+        }, f, indent=2)
+    return best
+
+
+def best_cluster_count() -> int or None:
+    """
+    The number of clusters chosen by search, or None if the models were not trained by search
+
+    Returns:
+        int or None
+    """
+    path = os.path.join(get_dir('clusters'), CLUSTER_COUNT_JSON)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return int(json.load(f)['n_clusters'])
+
+
+def _remove_models() -> None:
+    # the models and the centers and silhouette scores computed from them, so none are left for numbers not retrained
+    for model_file in list_cluster_files('all'):
+        os.remove(model_file)
+    for pattern in ('cluster_centers_*', 'cluster_sscores_*'):
+        for table in glob.glob(_get_table_path(pattern)):
+            os.remove(table)
+    return
+
+
+def _remove_search_result() -> None:
+    # models trained without search replace the result of an earlier search
+    path = os.path.join(get_dir('clusters'), CLUSTER_COUNT_JSON)
+    if os.path.exists(path):
+        os.remove(path)
+    return
+
+
+def _fit_projection(x: np.ndarray, pca: int or float = None):
+    """
+    Fits the principal components the FDC data are projected onto and saves them with the models. Removes the saved
+    projection of earlier models when pca is None so the new models are used without one.
+
+    Args:
+        x: a numpy array of the prepared FDC data, or a sample of it
+        pca: the number of components, or the fraction of the variance to keep if it is less than 1
+
+    Returns:
+        sklearn.decomposition.PCA or None
+    """
+    path = os.path.join(get_dir('clusters'), CLUSTER_PCA_PICKLE)
+    if not pca:
+        if os.path.exists(path):
+            os.remove(path)
+        return None
+
+    from sklearn.decomposition import PCA
+
+    projection = PCA(n_components=float(pca) if float(pca) < 1 else int(pca)).fit(x)
+    logger.info(f'PCA keeps {projection.n_components_} of {x.shape[1]} dimensions and '
+                f'{projection.explained_variance_ratio_.sum():.2%} of the variance')
+    joblib.dump(projection, path)
+    return projection
+
+
+def _load_projection():
+    """
+    The principal components the saved models were trained on, or None if they were trained on the FDC data
+    """
+    path = os.path.join(get_dir('clusters'), CLUSTER_PCA_PICKLE)
+    return joblib.load(path) if os.path.exists(path) else None
+
+
+def _project(x: np.ndarray, projection=None) -> np.ndarray:
+    # FDC data are only projected when the models were trained on principal components
+    return x if projection is None else projection.transform(x)
+
+
+def _fdc_centers(kmeans, projection=None) -> np.ndarray:
+    # the centers of models trained on projected data are projected back to FDC values
+    return kmeans.cluster_centers_ if projection is None else projection.inverse_transform(kmeans.cluster_centers_)
+
+
+def _sample_rows(x: np.ndarray = None, rows: int = INIT_ROWS, chunk_rows: int = 100_000) -> np.ndarray:
+    """
+    Draws about the given number of rows at random from every chunk of the FDC data in x or cluster_data
+    """
+    n_rows = _count_rows(x)
+    rng = np.random.default_rng(0)
+    return np.concatenate([
+        chunk[rng.random(len(chunk)) < rows / max(n_rows, 1)] for chunk in _chunks(x, chunk_rows)
+    ])
+
+
+def _count_rows(x: np.ndarray = None) -> int:
+    """
+    The number of rows of the FDC data in x or cluster_data without reading the data of a parquet table
+    """
+    if x is not None:
+        return len(x)
+    table_path = _get_table_path('cluster_data')
+    if os.path.splitext(table_path)[-1] != '.parquet':
+        return len(read_table('cluster_data'))
+
+    import pyarrow.parquet as pq
+
+    return pq.ParquetFile(table_path).metadata.num_rows
+
+
+def _chunks(x: np.ndarray = None, chunk_rows: int = 100_000):
+    """
+    Yields consecutive chunks of at most chunk_rows rows of the FDC data, from x or the row groups of cluster_data
+    """
+    if x is not None:
+        for start in range(0, len(x), chunk_rows):
+            yield x[start:start + chunk_rows]
+        return
+
+    table_path = _get_table_path('cluster_data')
+    if os.path.splitext(table_path)[-1] != '.parquet':
+        logger.warning('Only parquet cluster_data can be read in chunks. Reading the whole table.')
+        yield from _chunks(read_table('cluster_data').values, chunk_rows)
+        return
+
+    import pyarrow.parquet as pq
+
+    # without pre_buffer the row groups are read as they are iterated instead of buffered ahead
+    parquet_file = pq.ParquetFile(table_path, pre_buffer=False)
+    # the index is stored as columns which are not FDC values
+    index_columns = [c for c in (parquet_file.schema_arrow.pandas_metadata or {}).get('index_columns', [])
+                     if isinstance(c, str)]
+    columns = [c for c in parquet_file.schema_arrow.names if c not in index_columns]
+    for batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=columns):
+        yield np.column_stack([column.to_numpy(zero_copy_only=False) for column in batch.columns])
+
+
 def predict_labels(n_clusters: int, x: pd.DataFrame = None) -> pd.DataFrame:
     """
     Predict the cluster labels for a set number of FDCs
@@ -99,7 +410,7 @@ def predict_labels(n_clusters: int, x: pd.DataFrame = None) -> pd.DataFrame:
 
     model = joblib.load(os.path.join(get_dir('clusters'), f'kmeans-{n_clusters}.pickle'))
     labels_df = pd.DataFrame(
-        np.transpose([model.predict(x.values), x.index]),
+        np.transpose([model.predict(_project(x.values, _load_projection())), x.index]),
         columns=[COL_CID, COL_MID]
     )
     write_table(labels_df, 'cluster_table')
@@ -113,8 +424,11 @@ def summarize_fit() -> None:
     Returns:
         None
     """
+    from kneed import KneeLocator
+
     summary = {'number': [], 'inertia': [], 'n_iter': []}
     labels = []
+    projection = _load_projection()
 
     for model_file in list_cluster_files(n_clusters='all'):
         logger.info(f'Post Processing {os.path.basename(model_file)}')
@@ -124,7 +438,8 @@ def summarize_fit() -> None:
 
         # save cluster centroids to table - columns are the cluster number, rows are the centroid FDC values
         write_table(
-            pd.DataFrame(np.transpose(kmeans.cluster_centers_), columns=np.array(range(n_clusters)).astype(str)),
+            pd.DataFrame(np.transpose(_fdc_centers(kmeans, projection)),
+                         columns=np.array(range(n_clusters)).astype(str)),
             f'cluster_centers_{n_clusters}')
 
         # save the summary stats from this model
@@ -134,7 +449,15 @@ def summarize_fit() -> None:
 
     # save the summary results as a csv
     sum_df = pd.DataFrame(summary)
-    sum_df['knee'] = KneeLocator(summary['number'], summary['inertia'], curve='convex', direction='decreasing').knee
+    # the number chosen by search is recorded as the knee since only the models around it were trained
+    knee = best_cluster_count()
+    if knee is None:
+        knee = KneeLocator(summary['number'], summary['inertia'], curve='convex', direction='decreasing').knee
+    sum_df['knee'] = knee
+    if projection is not None:
+        # the inertia is measured between the projected data and centers
+        sum_df['pca_components'] = projection.n_components_
+        sum_df['pca_variance'] = projection.explained_variance_ratio_.sum()
     write_table(sum_df, 'cluster_metrics')
 
     return
@@ -152,11 +475,14 @@ def calc_silhouette(x: np.ndarray, n_clusters: int or Iterable = 'all', samples:
     Returns:
         None
     """
+    from sklearn.metrics import silhouette_samples
+
     if x is None:
         x = read_table('cluster_data').values
     fdc_df = pd.DataFrame(x)
 
     summary = {'number': [], 'silhouette': []}
+    projection = _load_projection()
 
     random_shuffler = np.random.default_rng()
 
@@ -176,7 +502,8 @@ def calc_silhouette(x: np.ndarray, n_clusters: int or Iterable = 'all', samples:
             ss_df = pd.concat([ss_df, tmp])
 
         # calculate their silhouette scores
-        ss_df['silhouette'] = silhouette_samples(ss_df.drop(columns='label').values, ss_df['label'].values, n_jobs=-1)
+        ss_df['silhouette'] = silhouette_samples(_project(ss_df.drop(columns='label').values, projection),
+                                                 ss_df['label'].values, n_jobs=-1)
         ss_df['silhouette'] = ss_df['silhouette'].round(3)
         ss_df.columns = ss_df.columns.astype(str)
         write_table(ss_df, f'cluster_sscores_{kmeans.n_clusters}')
@@ -206,6 +533,8 @@ def plot_clusters(x: np.ndarray = None, n_clusters: int or Iterable = 'all',
     Returns:
         None
     """
+    import matplotlib.pyplot as plt
+
     if x is None:
         x = read_table('cluster_data').values
 
@@ -214,12 +543,14 @@ def plot_clusters(x: np.ndarray = None, n_clusters: int or Iterable = 'all',
     x_ticks = np.linspace(0, 100, 5).astype(int)
 
     random_shuffler = np.random.default_rng()
+    projection = _load_projection()
 
     for model_file in list_cluster_files(n_clusters):
         logger.info(f'Plotting Clusters {os.path.basename(model_file)}')
 
         # load the model and calculate
         kmeans = joblib.load(model_file)
+        centers = _fdc_centers(kmeans, projection)
         n_clusters = int(kmeans.n_clusters)
         n_cols = min(n_clusters, max_cols)
         n_rows = math.ceil(n_clusters / n_cols)
@@ -248,7 +579,7 @@ def plot_clusters(x: np.ndarray = None, n_clusters: int or Iterable = 'all',
             fdc_sample = fdc_sample[:n_lines]
             for j in fdc_sample:
                 ax.plot(j.ravel(), "k-")
-            ax.plot(kmeans.cluster_centers_[i].flatten(), "r-")
+            ax.plot(centers[i].flatten(), "r-")
         # turn off plotting axes which are blank (when ax number > n_clusters)
         for ax in fig.axes[n_clusters:]:
             ax.axis('off')
@@ -271,6 +602,9 @@ def plot_silhouettes(workdir: str, plt_width: int = 3, plt_height: int = 3) -> N
     Returns:
         None
     """
+    import matplotlib.cm as cm
+    import matplotlib.pyplot as plt
+
     logger.info('Generating Silhouette Diagrams')
 
     clusters_dir = os.path.join(workdir, 'clusters')
@@ -340,7 +674,7 @@ def plot_silhouettes(workdir: str, plt_width: int = 3, plt_height: int = 3) -> N
 
 def plot_centers(plt_width: int = 2, plt_height: int = 2, max_cols: int = 3) -> None:
     """
-    Plot the cluster centers for each cluster.
+    Plot the cluster centers of each trained cluster model.
 
     Args:
         plt_width: width of each subplot in inches
@@ -350,13 +684,24 @@ def plot_centers(plt_width: int = 2, plt_height: int = 2, max_cols: int = 3) ->
     Returns:
         None
     """
+    import matplotlib.pyplot as plt
+
     logger.info('Plotting Cluster Centers')
 
     clusters_dir = get_dir('clusters')
 
-    for n_clusters in [4, 7, 10, 13]:
+    # each figure plots the centers of every model up to a number of clusters, at every COARSE_STEP-th model
+    numbers = [int(os.path.basename(f).split('-')[-1].split('.')[0]) for f in list_cluster_files('all')]
+    if not numbers:
+        logger.warning('No cluster models to plot the centers of')
+        return
+    last_numbers = numbers[COARSE_STEP - 1::COARSE_STEP]
+    if numbers[-1] not in last_numbers:
+        last_numbers.append(numbers[-1])
+
+    for last_number in last_numbers:
         # count number of files to plot
-        centers_files = [os.path.join(clusters_dir, f'cluster_centers_{i}.parquet') for i in range(2, n_clusters + 1)]
+        centers_files = [_get_table_path(f'cluster_centers_{i}') for i in numbers if i <= last_number]
         n_files = len(centers_files)
         n_cols = min(n_files, max_cols)
         n_rows = math.ceil(n_files / n_cols)
@@ -389,7 +734,7 @@ def plot_centers(plt_width: int = 2, plt_height: int = 2, max_cols: int = 3) ->
             ax.set_xlim(0, 40)
             ax.set_ylim(-2, 4)
 
-        fig.savefig(os.path.join(clusters_dir, f'figure-cluster-centers-{n_clusters}.png'))
+        fig.savefig(os.path.join(clusters_dir, f'figure-cluster-centers-{last_number}.png'))
         plt.close(fig)
     return
 
@@ -405,6 +750,8 @@ def plot_fit_metrics(plt_width: int = 4, plt_height: int = 4) -> None:
     Returns:
         None
     """
+    import matplotlib.pyplot as plt
+
     logger.info('Plotting Cluster Fit Metrics')
 
     clusters_dir = get_dir('clusters')
@@ -0,0 +1,410 @@
+import atexit
+import logging
+import os
+import re
+import sys
+import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from . import io
+from .io import get_state
+from .progress import pss_mb
+from .progress import rss_mb
+from .trace import span
+
+__all__ = ['Executor', 'get_executor', 'shutdown', 'parse_memory', 'VALID_EXECUTORS', ]
+
+logger = logging.getLogger(__name__)
+
+VALID_EXECUTORS = ('serial', 'thread', 'process', 'persistent')
+
+# seconds of work each chunk sent to a worker should take so the cost of sending tasks and results is small compared
+# to the work, and the number of chunks per worker so workers which finish early can pick up more work
+TARGET_CHUNK_SECONDS = 0.2
+MIN_CHUNKS_PER_WORKER = 4
+
+# with max_memory: the number of tasks measured before sizing the pool, the fraction of the budget the pool is sized to
+# use, the fraction of the budget which makes the pool remove a worker, and the chunks per worker submitted at once
+WARMUP_TASKS = 2
+BUDGET_FRACTION = 0.8
+BACKOFF_FRACTION = 0.9
+BATCH_CHUNKS_PER_WORKER = 4
+
+# the persistent pool reused across stages and the config it was started with
+_persistent_pool = None
+_persistent_key = None
+
+# measured seconds per task and memory a worker adds per task of each function mapped by an executor, used by later
+# calls
+_task_seconds = {}
+_task_memory = {}
+
+
+class Executor:
+    """
+    Maps a function over tasks in serial, in a pool of threads, in a pool of processes, or in a warm pool of processes
+    which is reused by every stage. Use as a context manager in place of a multiprocessing Pool.
+
+    When max_memory is set in the config, the memory a worker adds to run a task is measured on the first few tasks of
+    each function and the number of processes is reduced to fit the budget. While tasks run, workers are removed if the
+    memory used by all of the processes approaches the budget.
+
+    Args:
+        kind: one of 'serial', 'thread', 'process', or 'persistent'. Defaults to the executor in the config
+        n_workers: the number of threads or processes. Defaults to n_processes in the config
+
+    Raises:
+        ValueError: if kind is not a valid executor
+    """
+
+    def __init__(self, kind: str = None, n_workers: int = None):
+        kind = kind or get_state('executor') or 'process'
+        if kind not in VALID_EXECUTORS:
+            raise ValueError(f'Unknown executor: "{kind}". Options: {", ".join(VALID_EXECUTORS)}')
+        self.kind = kind
+        self.n_workers = max(int(n_workers or get_state('n_processes') or os.cpu_count() or 1), 1)
+        self.max_memory = parse_memory(get_state('max_memory'))
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        """
+        Stops the pool of workers unless it is the persistent pool which is kept warm for the next stage
+        """
+        if self._pool is not None and self.kind != 'persistent':
+            self._pool.close()
+            self._pool.join()
+        self._pool = None
+        return
+
+    def starmap(self, func: callable, iterable, chunksize: int = None) -> list:
+        """
+        Calls func with each item of iterable unpacked as its arguments
+
+        Args:
+            func: the function to map. Must be picklable (defined at module level) for process executors
+            iterable: the arguments of each task
+            chunksize: the number of tasks sent to a worker at once. Chosen from the measured cost of func by default
+
+        Returns:
+            list of the results in the same order as iterable
+        """
+        return self.map(_Star(func), iterable, chunksize=chunksize)
+
+    def istarmap(self, func: callable, iterable, chunksize: int = None):
+        """
+        Lazily calls func with each item of iterable unpacked as its arguments and yields the results in order
+
+        Args:
+            func: the function to map. Must be picklable (defined at module level) for process executors
+            iterable: the arguments of each task
+            chunksize: the number of tasks sent to a worker at once. Chosen from the measured cost of func by default
+
+        Yields:
+            the result of each task in the same order as iterable
+        """
+        return self.imap(_Star(func), iterable, chunksize=chunksize)
+
+    def map(self, func: callable, iterable, chunksize: int = None) -> list:
+        """
+        Calls func with each item of iterable as its only argument
+
+        Args:
+            func: the function to map. Must be picklable (defined at module level) for process executors
+            iterable: the argument of each task
+            chunksize: the number of tasks sent to a worker at once. Chosen from the measured cost of func by default
+
+        Returns:
+            list of the results in the same order as iterable
+        """
+        return list(self.imap(func, iterable, chunksize=chunksize))
+
+    def imap(self, func: callable, iterable, chunksize: int = None):
+        """
+        Lazily calls func with each item of iterable as its only argument and yields the results in order as they finish
+
+        Args:
+            func: the function to map. Must be picklable (defined at module level) for process executors
+            iterable: the argument of each task
+            chunksize: the number of tasks sent to a worker at once. Chosen from the measured cost of func by default
+
+        Yields:
+            the result of each task in the same order as iterable
+        """
+        tasks = list(iterable)
+        if not tasks:
+            return
+        if self.kind == 'serial' or (self.n_workers == 1 and self.kind != 'thread'):
+            yield from _timed_map(_Traced(func) if get_state('trace') else func, tasks)
+            return
+
+        key = _task_key(func)
+        if get_state('trace'):
+            func = _Traced(func)
+        start = 0
+        if self.max_memory and self.kind != 'thread':
+            if key not in _task_memory:
+                # run a few tasks in a fresh process to measure the memory a worker needs before sizing the pool
+                start = min(WARMUP_TASKS, len(tasks))
+                results, _task_memory[key], _task_seconds[key] = _warm_up(func, tasks[:start])
+                yield from results
+            self._fit_budget(_task_memory[key])
+        if start == len(tasks):
+            return
+
+        pool = self._get_pool()
+        if chunksize is None and key not in _task_seconds:
+            # time one task on each worker before choosing how many tasks to send at once. The tasks are timed in
+            # the workers so the time the caller spends between results is not counted
+            n_probe = min(self.n_workers, len(tasks) - start)
+            seconds = []
+            for result, task_seconds in pool.imap(_Timed(func), tasks[start:start + n_probe], chunksize=1):
+                seconds.append(task_seconds)
+                yield result
+            _task_seconds[key] = sum(seconds) / n_probe
+            start += n_probe
+        if start < len(tasks):
+            if chunksize is None:
+                chunksize = _choose_chunksize(_task_seconds[key], len(tasks) - start, self.n_workers)
+                logger.debug(f'{key}: {_task_seconds[key]:.4f} s per task, chunksize {chunksize}')
+            if self.max_memory and self.kind != 'thread':
+                yield from self._imap_within_budget(func, tasks[start:], chunksize)
+            else:
+                yield from pool.imap(func, tasks[start:], chunksize=chunksize)
+
+    def worker_pids(self) -> list:
+        """
+        Process ids of the workers, or of this process for serial and thread executors
+        """
+        if self._pool is None or self.kind == 'thread':
+            return [os.getpid(), ]
+        return [p.pid for p in self._pool._pool if p.pid is not None]
+
+    def memory_mb(self) -> float:
+        """
+        Memory in megabytes of this process and the workers, counting the pages they share once (see pss_mb)
+        """
+        pids = set(self.worker_pids()) | {os.getpid(), }
+        return sum(pss_mb(pid) or 0 for pid in pids)
+
+    def _fit_budget(self, worker_mb: float) -> None:
+        # the main process keeps its current memory, the rest of the budget is shared by workers which each add the
+        # measured memory of a task to the pages they share with the main process
+        available = self.max_memory * BUDGET_FRACTION - (rss_mb() or 0)
+        n_workers = min(self.n_workers, max(int(available // max(worker_mb, 1)), 1))
+        if n_workers != self.n_workers:
+            logger.info(f'Using {n_workers} of {self.n_workers} workers to stay within max_memory '
+                        f'{self.max_memory:.0f} MB ({worker_mb:.0f} MB per worker)')
+            self._resize(n_workers)
+        return
+
+    def _imap_within_budget(self, func: callable, tasks: list, chunksize: int):
+        # submit the tasks in batches and remove a worker after any batch which ends with memory near the budget
+        position = 0
+        while position < len(tasks):
+            batch = tasks[position:position + self.n_workers * chunksize * BATCH_CHUNKS_PER_WORKER]
+            position += len(batch)
+            yield from self._get_pool().imap(func, batch, chunksize=chunksize)
+            used = self.memory_mb()
+            if used > self.max_memory * BACKOFF_FRACTION and self.n_workers > 1 and position < len(tasks):
+                logger.warning(f'Memory used {used:.0f} MB is near max_memory {self.max_memory:.0f} MB, '
+                               f'reducing workers from {self.n_workers} to {self.n_workers - 1}')
+                self._resize(self.n_workers - 1)
+
+    def _resize(self, n_workers: int) -> None:
+        if self._pool is not None:
+            if self.kind == 'persistent':
+                shutdown()
+            else:
+                self._pool.close()
+                self._pool.join()
+            self._pool = None
+        self.n_workers = n_workers
+        return
+
+    def _get_pool(self):
+        if self._pool is not None:
+            return self._pool
+        if self.kind == 'thread':
+            self._pool = ThreadPool(self.n_workers)
+        elif self.kind == 'process':
+            self._pool = Pool(self.n_workers)
+        else:
+            self._pool = _get_persistent_pool(self.n_workers)
+        return self._pool
+
+
+def get_executor(n_workers: int = None, kind: str = None) -> Executor:
+    """
+    Creates the executor selected in the config
+
+    Args:
+        n_workers: the number of threads or processes. Defaults to n_processes in the config
+        kind: one of 'serial', 'thread', 'process', or 'persistent'. Defaults to the executor in the config
+
+    Returns:
+        Executor
+    """
+    return Executor(kind=kind, n_workers=n_workers)
+
+
+def parse_memory(value: str or int or float or None) -> float or None:
+    """
+    Converts a memory size like '16GB', '512 MB', or a number of megabytes to megabytes
+
+    Args:
+        value: the memory size. Units KB, MB, GB, or TB. Numbers without units are megabytes
+
+    Returns:
+        float megabytes, or None if value is None or empty
+
+    Raises:
+        ValueError: if the value is not a recognized memory size
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)i?B?\s*', str(value), flags=re.IGNORECASE)
+    if match is None:
+        raise ValueError(f'Unrecognized memory size: "{value}". Use a number of megabytes or units like "16GB"')
+    scale = {'K': 1 / 1024, '': 1, 'M': 1, 'G': 1024, 'T': 1024 ** 2}[match.group(2).upper()]
+    return float(match.group(1)) * scale
+
+
+def shutdown() -> None:
+    """
+    Stops the persistent pool of processes if one is running
+
+    Returns:
+        None
+    """
+    global _persistent_pool, _persistent_key
+    if _persistent_pool is not None:
+        _persistent_pool.close()
+        _persistent_pool.join()
+    _persistent_pool = None
+    _persistent_key = None
+    return
+
+
+atexit.register(shutdown)
+
+
+class _Star:
+    """
+    Picklable wrapper which unpacks the arguments of a task for starmap
+    """
+
+    def __init__(self, func: callable):
+        self.func = func
+
+    def __call__(self, args):
+        return self.func(*args)
+
+
+class _Traced:
+    """
+    Picklable wrapper which records each task as a span of the trace
+    """
+
+    def __init__(self, func: callable):
+        self.func = func
+        self.name = _task_key(func)
+
+    def __call__(self, task):
+        with span(self.name, 'executor'):
+            return self.func(task)
+
+
+def _task_key(func: callable) -> str:
+    while isinstance(func, (_Star, _Traced, _Timed, _Measured)):
+        func = func.func
+    return f'{getattr(func, "__module__", "")}.{getattr(func, "__qualname__", repr(func))}'
+
+
+class _Timed:
+    """
+    Picklable wrapper which returns the result of a task with the seconds the task took
+    """
+
+    def __init__(self, func: callable):
+        self.func = func
+
+    def __call__(self, task):
+        t0 = time.perf_counter()
+        result = self.func(task)
+        return result, time.perf_counter() - t0
+
+
+class _Measured:
+    """
+    Picklable wrapper which returns the result of a task with the megabytes the peak resident memory of the worker rose
+    above its resident memory when the task started, and the seconds the task took. A forked worker starts with the
+    pages of the main process, which are already counted with the main process, so only the growth is the worker's own
+    """
+
+    def __init__(self, func: callable):
+        self.func = func
+
+    def __call__(self, task):
+        start = rss_mb() or 0
+        t0 = time.perf_counter()
+        result = self.func(task)
+        seconds = time.perf_counter() - t0
+        return result, max(_peak_rss_mb() - start, 0), seconds
+
+
+def _peak_rss_mb() -> float:
+    try:
+        import resource
+        # ru_maxrss is kilobytes on linux and bytes on macos
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+    except ImportError:
+        return rss_mb() or 0
+
+
+def _warm_up(func: callable, tasks: list) -> tuple:
+    with Pool(1) as pool:
+        measured = pool.map(_Measured(func), tasks, chunksize=1)
+    growth = max(mb for _, mb, _ in measured)
+    seconds = sum(task_seconds for _, _, task_seconds in measured) / len(tasks)
+    logger.debug(f'{_task_key(func)}: {growth:.0f} MB worker memory per task, {seconds:.4f} s per task')
+    return [result for result, _, _ in measured], growth, seconds
+
+
+def _timed_map(func: callable, tasks: list):
+    # only the tasks are timed, not the caller's work between the results it is given
+    seconds = 0
+    for task in tasks:
+        t0 = time.perf_counter()
+        result = func(task)
+        seconds += time.perf_counter() - t0
+        yield result
+    _task_seconds[_task_key(func)] = seconds / len(tasks)
+
+
+def _choose_chunksize(task_seconds: float, n_tasks: int, n_workers: int) -> int:
+    by_cost = int(TARGET_CHUNK_SECONDS / task_seconds) if task_seconds > 0 else n_tasks
+    by_balance = n_tasks // (n_workers * MIN_CHUNKS_PER_WORKER)
+    return max(1, min(by_cost, by_balance))
+
+
+def _get_persistent_pool(n_workers: int):
+    # workers copy the config when they start so the pool is restarted if the config or worker count changed
+    global _persistent_pool, _persistent_key
+    key = (n_workers, tuple((k, repr(getattr(io, k, None))) for k in sorted(io.VALID_YAML_KEYS)))
+    if _persistent_pool is not None and key != _persistent_key:
+        shutdown()
+    if _persistent_pool is None:
+        logger.info(f'Starting persistent pool of {n_workers} processes')
+        _persistent_pool = Pool(n_workers)
+        _persistent_key = key
+    return _persistent_pool
@@ -1,14 +1,25 @@
-import os
+import logging
 
 import numpy as np
 import pandas as pd
-import xarray as xr
 
+from .cache import cached_gauge_data
+from .cache import cached_hindcast
+from .executor import get_executor
 from .io import COL_GID
 from .io import COL_MID
 from .io import COL_QSIM
+from .io import get_state
+from .io import read_table
+from .io import write_table
+from .progress import Progress
+from .shard import shard_table
+from .shard import write_part
+from .trace import span
 
-__all__ = ['fdc', 'sfdc', 'precalc_sfdcs']
+__all__ = ['fdc', 'sfdc', 'precalc_sfdcs', 'mp_precalc_sfdcs', ]
+
+logger = logging.getLogger(__name__)
 
 
 def fdc(flows: np.array, steps: int = 101, col_name: str = 'Q') -> pd.DataFrame:
@@ -43,7 +54,7 @@ def sfdc(sim_fdc: pd.DataFrame, obs_fdc: pd.DataFrame) -> pd.DataFrame:
         pd.DataFrame with index (exceedance probabilities) and a column of scalars
     """
     scalars_df = pd.DataFrame(
-        np.divide(sim_fdc, obs_fdc.values.flatten()),
+        np.divide(sim_fdc.values.flatten(), obs_fdc.values.flatten()),
         columns=['scalars', ],
         index=sim_fdc.index
     )
@@ -52,7 +63,7 @@ def sfdc(sim_fdc: pd.DataFrame, obs_fdc: pd.DataFrame) -> pd.DataFrame:
     return scalars_df
 
 
-def precalc_sfdcs(assign_row: pd.DataFrame, gauge_data: str, hindcast_zarr: str) -> pd.DataFrame:
+def precalc_sfdcs(assign_row: pd.DataFrame, gauge_data: str, hindcast_zarr: str) -> np.ndarray:
     """
     Compute the scalar flow duration curve (exceedance probabilities) from two flow duration curves
 
@@ -62,29 +73,85 @@ def precalc_sfdcs(assign_row: pd.DataFrame, gauge_data: str, hindcast_zarr: str)
         hindcast_zarr: string path to the hindcast streamflow dataset
 
     Returns:
-        pd.DataFrame with index (exceedance probabilities) and a column of scalars
+        np.array of shape (13, 101): the scalar fdc of each month (rows 0-11) and of all months (row 12)
     """
-    # todo
-    # read the simulated data
-    hz = xr.open_mfdataset(hindcast_zarr, concat_dim='rivid', combine='nested', parallel=True, engine='zarr')
-    sim_df = hz['Qout'][:, hz.rivid.values == int(assign_row[COL_MID])].values
-    sim_df = pd.DataFrame(sim_df, index=pd.to_datetime(hz['time'].values), columns=[COL_QSIM])
-    sim_df = sim_df[sim_df.index.year >= 1980]
+    # read the simulated data within the correction period
+    with span('read_hindcast', 'io', model_id=assign_row[COL_MID]):
+        sim_df = cached_hindcast(hindcast_zarr, [assign_row[COL_MID], ]).set_axis([COL_QSIM], axis=1)
 
     # read the observed data
-    obs_df = pd.read_csv(os.path.join(gauge_data, f'{assign_row[COL_GID]}.csv'), index_col=0)
-    obs_df.index = pd.to_datetime(obs_df.index)
+    with span('read_gauge_csv', 'io', gauge_id=assign_row[COL_GID]):
+        obs_df = cached_gauge_data(gauge_data, assign_row[COL_GID])
 
-    sim_fdcs = []
-    obs_fdcs = []
-    for month in range(1, 13):
-        sim_fdcs.append(fdc(sim_df[sim_df.index.month == month].values.flatten()).values.flatten())
-        obs_fdcs.append(fdc(obs_df[obs_df.index.month == month].values.flatten()).values.flatten())
+    with span('monthly_fdcs', 'fdc', model_id=assign_row[COL_MID]):
+        sim_fdcs = []
+        obs_fdcs = []
+        for month in range(1, 13):
+            sim_fdcs.append(fdc(sim_df[sim_df.index.month == month].values.flatten()).values.flatten())
+            obs_fdcs.append(fdc(obs_df[obs_df.index.month == month].values.flatten()).values.flatten())
 
-    sim_fdcs.append(fdc(sim_df.values.flatten()))
-    obs_fdcs.append(fdc(obs_df.values.flatten()))
+        sim_fdcs.append(fdc(sim_df.values.flatten()).values.flatten())
+        obs_fdcs.append(fdc(obs_df.values.flatten()).values.flatten())
 
     sim_fdcs = np.array(sim_fdcs)
     obs_fdcs = np.array(obs_fdcs)
     sfdcs = np.divide(sim_fdcs, obs_fdcs)
     return sfdcs
+
+
+def mp_precalc_sfdcs(gauge_df: pd.DataFrame = None, shard: str or tuple = None,
+                     shard_by: str = 'outlet') -> pd.DataFrame:
+    """
+    Precomputes the monthly scalar flow duration curves at every gauge using multiprocessing
+
+    Args:
+        gauge_df: a table with the model_id and gauge_id of each gauge. Defaults to the gauge_table
+        shard: string 'i/N' or tuple (i, N) to only compute the gauges in one shard and write a part of the table
+        shard_by: how to partition the gauges into shards, see saber.shard.shard_table
+
+    Returns:
+        pd.DataFrame with a row per gauge and month (0 for all months) and a column per exceedance probability
+    """
+    logger.info('Precomputing Gauge Scalar Flow Duration Curves')
+
+    if gauge_df is None:
+        gauge_df = read_table('gauge_table')
+    gauge_df = gauge_df[gauge_df[COL_GID].notna()]
+    if shard is not None:
+        gauge_df = shard_table(gauge_df, shard, by=shard_by)
+
+    with get_executor() as p, Progress(len(gauge_df), 'gauge_sfdcs', p) as progress:
+        sfdcs = list(progress.track(p.istarmap(
+            _map_precalc_sfdcs,
+            [[row, get_state('gauge_data'), get_state('hindcast_zarr')] for _, row in gauge_df.iterrows()]
+        )))
+
+    exceed_prob = np.linspace(100, 0, 101)
+    rows = []
+    for (_, row), sfdc_array in zip(gauge_df.iterrows(), sfdcs):
+        if sfdc_array is None:
+            continue
+        month_df = pd.DataFrame(sfdc_array, columns=exceed_prob.astype(str))
+        month_df.insert(0, 'month', list(range(1, 13)) + [0, ])
+        month_df.insert(0, COL_GID, row[COL_GID])
+        month_df.insert(0, COL_MID, row[COL_MID])
+        rows.append(month_df)
+    sfdc_df = pd.concat(rows, ignore_index=True) if rows else pd.DataFrame(columns=[COL_MID, COL_GID, 'month'])
+
+    if shard is None:
+        write_table(sfdc_df, 'gauge_sfdcs')
+    else:
+        write_part(sfdc_df, 'gauge_sfdcs', shard)
+    return sfdc_df
+
+
+def _map_precalc_sfdcs(assign_row: pd.Series, gauge_data: str, hindcast_zarr: str) -> np.ndarray or None:
+    """
+    Helper function for mp_precalc_sfdcs which logs failures instead of stopping the executor. Separate function so it
+    can be pickled for multiprocessing.
+    """
+    try:
+        return precalc_sfdcs(assign_row, gauge_data, hindcast_zarr)
+    except Exception as e:
+        logger.error(f'Failed to precompute scalar FDCs for gauge {assign_row[COL_GID]}: {e}')
+        return None
@@ -0,0 +1,331 @@
+import logging
+import statistics
+
+import numpy as np
+import pandas as pd
+
+from .cache import cached_gauge_data
+from .cache import cached_hindcast
+from .executor import get_executor
+from .fdc import fdc
+from .io import COL_ASN_GID
+from .io import COL_ASN_MID
+from .io import COL_MID
+from .io import COL_QSIM
+from .io import get_state
+from .io import read_table
+from .saber import CURVE_PARAMS
+from .saber import SFDC_PARAMS
+from .saber import _flow_duration_curves
+from .saber import _gauge_groups
+from .saber import _gumbel_params
+from .saber import _make_interpolator
+from .saber import _select
+from .saber import sfdc_curves
+from .trace import span
+
+__all__ = ['Mappings', 'build_mappings', 'apply_mappings', 'correct_forecast', ]
+
+logger = logging.getLogger(__name__)
+
+# the number of exceedance probabilities of each flow duration curve and the most forecast values corrected at once
+N_PROBS = 101
+CHUNK_VALUES = 2 ** 22
+
+
+class Mappings:
+    """
+    Monthly lookup tables which bias correct the discharge of each river the same way as the correction stage: a flow
+    is matched to the nearest flow of the river's monthly flow duration curve from the hindcast, and the value of that
+    exceedance probability is either the scalar of the assigned gauge the flow is divided by (ungauged rivers) or the
+    observed flow which replaces it (gauged rivers).
+
+    Args:
+        model_id: model id string of each river
+        bounds: array (rivers, 12, 100) of the sorted midpoints between the flows of each monthly flow duration curve.
+            A flow maps to the position of the first bound which is not smaller than it
+        probs: array (rivers, 12, 101) of the exceedance probability of each position
+        values: array (rivers, 12, 101) of the scalar or observed flow at each position
+        gumbel: array (rivers, 12, 2) of the mean and standard deviation of the corrected hindcast of each month within
+            the fit_range of the correction settings, which saber.lut fits extreme flows to. NaN for gauged rivers
+        replace: boolean array (rivers,) True where the values replace the flows instead of dividing them
+        valid: boolean array (rivers, 12) of the months each river can be corrected in
+    """
+    ARRAYS = ('bounds', 'probs', 'values', 'gumbel', 'replace', 'valid')
+
+    def __init__(self, model_id: np.ndarray, bounds: np.ndarray, probs: np.ndarray, values: np.ndarray,
+                 gumbel: np.ndarray, replace: np.ndarray, valid: np.ndarray):
+        self.model_id = np.asarray(model_id).astype(str)
+        self.bounds = bounds
+        self.probs = probs
+        self.values = values
+        self.gumbel = gumbel
+        self.replace = replace
+        self.valid = valid
+
+    def __len__(self):
+        return len(self.model_id)
+
+    def positions(self, model_ids) -> np.ndarray:
+        """
+        Finds the position of each model id in the tables
+
+        Args:
+            model_ids: iterable of model ids
+
+        Returns:
+            np.ndarray of int positions, -1 for model ids which are not in the tables
+        """
+        return pd.Index(self.model_id).get_indexer([str(mid) for mid in model_ids])
+
+
+def build_mappings(model_ids: list, assign_df: pd.DataFrame = None, hindcast_zarr: str = None,
+                   gauge_data: str = None) -> Mappings:
+    """
+    Derives the monthly correction tables of some rivers from the hindcast and the observed data of their assigned
+    gauges, with the settings of the correction stage. Rivers are grouped by assigned gauge so each gauge's scalar flow
+    duration curves are computed once, and the groups are processed in parallel with the configured executor.
+
+    Args:
+        model_ids: the model ids of the rivers to correct
+        assign_df: the assignment table. Defaults to the assign_table in the workdir
+        hindcast_zarr: path to the hindcast streamflow zarr. Defaults to the hindcast_zarr in the config
+        gauge_data: path to the directory of observed data. Defaults to the gauge_data in the config
+
+    Returns:
+        Mappings
+
+    Raises:
+        ValueError: if any model id is not in the assignment table
+    """
+    if assign_df is None:
+        assign_df = read_table('assign_table')
+    hindcast_zarr = hindcast_zarr or get_state('hindcast_zarr')
+    gauge_data = gauge_data or get_state('gauge_data')
+
+    model_ids = list(dict.fromkeys(str(mid) for mid in model_ids))
+    assign_df = assign_df.set_index(assign_df[COL_MID].astype(str))
+    missing = pd.Index(model_ids).difference(assign_df.index)
+    if len(missing):
+        raise ValueError(f'{len(missing)} model ids are not in the assignment table: {list(missing)[:10]}')
+    rows = assign_df.loc[model_ids, [COL_ASN_MID, COL_ASN_GID]].rename_axis(COL_MID).reset_index()
+
+    mappings = _empty_mappings(model_ids)
+    with get_executor() as p:
+        for group in p.starmap(_map_build_group, [[*g, hindcast_zarr, gauge_data] for g in _gauge_groups(rows)]):
+            positions = mappings.positions(group.model_id)
+            for name in Mappings.ARRAYS:
+                getattr(mappings, name)[positions] = getattr(group, name)
+
+    n_missing = int((~mappings.valid.any(axis=1)).sum())
+    if n_missing:
+        logger.warning(f'{n_missing} of {len(mappings)} rivers have no correction and will be returned as NaN')
+    return mappings
+
+
+def apply_mappings(forecast: np.ndarray, times, mappings: Mappings, model_ids: list = None) -> np.ndarray:
+    """
+    Bias corrects an array of forecasts of many rivers at once with vectorized lookups. No DataFrames are made. The
+    mappings are compiled with saber.lut.CorrectionTables.from_mappings using the settings of the correction stage, so
+    flows at exceedance probabilities outside the fit_range are replaced by the Gumbel distribution of their month like
+    the correction stage does, and the lookups are the same as CorrectionTables.correct.
+
+    Args:
+        forecast: array (members, times, rivers) or (times, rivers) of simulated discharge
+        times: the datetime of each step of the time axis, which selects the month of the tables used
+        mappings: the correction tables from build_mappings
+        model_ids: the model id of each river of the last axis. Defaults to the rivers of the mappings in order
+
+    Returns:
+        np.ndarray of the corrected discharge with the shape of forecast. NaN where a value is NaN or its river has no
+        correction in that month
+
+    Raises:
+        ValueError: if the shapes do not match or a river is not in the mappings
+    """
+    # saber.lut imports this module to build its tables
+    from .lut import CorrectionTables
+
+    tables = CorrectionTables.from_mappings(mappings, SFDC_PARAMS.get('fit_gumbel', False),
+                                            SFDC_PARAMS.get('fit_range', (10, 90)))
+    forecast = np.asarray(forecast)
+    if forecast.dtype.kind != 'f':
+        forecast = forecast.astype(np.float64)
+    with span('apply_mappings', 'fdc', values=forecast.size):
+        return tables.correct(forecast, times, model_ids)
+
+
+def correct_forecast(forecast: np.ndarray, times, model_ids: list, assign_df: pd.DataFrame = None,
+                     hindcast_zarr: str = None, gauge_data: str = None) -> np.ndarray:
+    """
+    Bias corrects an ensemble forecast of many rivers. Builds the correction tables of the rivers with build_mappings
+    and applies them with apply_mappings. Build the mappings once and reuse them to correct each forecast cycle, or
+    compile them once with saber.lut.CorrectionTables.from_mappings and correct each cycle with its correct method.
+
+    Args:
+        forecast: array (members, times, rivers) or (times, rivers) of simulated discharge
+        times: the datetime of each step of the time axis
+        model_ids: the model id of each river of the last axis
+        assign_df: the assignment table. Defaults to the assign_table in the workdir
+        hindcast_zarr: path to the hindcast streamflow zarr. Defaults to the hindcast_zarr in the config
+        gauge_data: path to the directory of observed data. Defaults to the gauge_data in the config
+
+    Returns:
+        np.ndarray of the corrected discharge with the shape of forecast
+    """
+    mappings = build_mappings(model_ids, assign_df, hindcast_zarr, gauge_data)
+    return apply_mappings(forecast, times, mappings, model_ids)
+
+
+def _empty_mappings(model_ids: list) -> Mappings:
+    n = len(model_ids)
+    return Mappings(
+        model_id=np.asarray(model_ids),
+        bounds=np.full((n, 12, N_PROBS - 1), np.nan),
+        probs=np.full((n, 12, N_PROBS), np.nan),
+        values=np.full((n, 12, N_PROBS), np.nan),
+        gumbel=np.full((n, 12, 2), np.nan),
+        replace=np.zeros(n, dtype=bool),
+        valid=np.zeros((n, 12), dtype=bool),
+    )
+
+
+def _map_build_group(mids: list, asgn_mid: str, asgn_gid: str, hz: str, gauge_data: str) -> Mappings:
+    """
+    Helper function for build_mappings which builds the tables of a group of rivers assigned to the same gauge.
+    Separate function so it can be pickled for multiprocessing.
+
+    Returns:
+        Mappings of the rivers in the group
+    """
+    mappings = _empty_mappings(mids)
+    if asgn_gid is None or pd.isna(asgn_gid):
+        return mappings
+
+    mids = [str(mid) for mid in mids]
+    asgn_mid = str(asgn_mid)
+    try:
+        obs_df = cached_gauge_data(gauge_data, asgn_gid)
+        sim_df = cached_hindcast(hz, list(dict.fromkeys([asgn_mid, ] + mids)),
+                                 keep=None if len(mids) == 1 else [asgn_mid, ])
+        asgn_sim_df = sim_df[[asgn_mid]].set_axis([COL_QSIM], axis=1)
+        exceed_prob = np.linspace(100, 0, N_PROBS)
+
+        if asgn_mid in mids:
+            # gauged rivers: quantile mapping of the simulated to the observed flow duration curve of each month
+            i = mids.index(asgn_mid)
+            mappings.replace[i] = True
+            for month in range(1, 13):
+                month_sim = asgn_sim_df[asgn_sim_df.index.month == month].dropna()
+                month_obs = obs_df[obs_df.index.month == month].dropna()
+                if month_sim.empty or month_obs.empty:
+                    continue
+                to_flow = _make_interpolator(exceed_prob, fdc(month_obs.values).values.flatten())
+                _set_table(mappings, i, month, fdc(month_sim.values).values.flatten(), exceed_prob, to_flow)
+
+        ungauged = [i for i, mid in enumerate(mids) if mid != asgn_mid]
+        if ungauged:
+            # ungauged rivers: the scalars of the gauge at the exceedance probability of each flow of the river
+            curves = sfdc_curves(asgn_sim_df, obs_df, **_select(SFDC_PARAMS, CURVE_PARAMS))
+            flows = sim_df[[mids[i] for i in ungauged]].values
+            for month in range(1, 13):
+                scalar_fdc = curves.get(month, curves.get(0))
+                in_month = (sim_df.index.month == month)[:, None] & ~np.isnan(flows)
+                if scalar_fdc is None or not in_month.any():
+                    continue
+                _, fdcs = _flow_duration_curves(flows, in_month, SFDC_PARAMS.get('drop_outliers', False),
+                                                SFDC_PARAMS.get('outlier_threshold', 2.5))
+                to_scalar = _make_interpolator(scalar_fdc.index, scalar_fdc.values.flatten())
+                for column, i in enumerate(ungauged):
+                    if in_month[:, column].any():
+                        _set_table(mappings, i, month, fdcs[:, column], exceed_prob, to_scalar)
+                        if SFDC_PARAMS.get('fit_gumbel', False):
+                            mappings.gumbel[i, month - 1] = _gumbel_fit(mappings, i, month,
+                                                                        flows[in_month[:, column], column])
+    except Exception as e:
+        logger.error(e)
+        logger.debug(f'Failed to build the forecast correction of {len(mids)} rivers assigned to gauge {asgn_gid}')
+
+    return mappings
+
+
+def _set_table(mappings: Mappings, i: int, month: int, fdc_flows: np.ndarray, exceed_prob: np.ndarray,
+               to_value: callable) -> None:
+    # sorted like scipy's nearest interpolation: stable sort of the flows and midpoints between neighbors as bounds
+    order = np.argsort(fdc_flows, kind='mergesort')
+    flows = fdc_flows[order]
+    halves = flows / 2.0
+    mappings.bounds[i, month - 1] = halves[1:] + halves[:-1]
+    mappings.probs[i, month - 1] = exceed_prob[order]
+    mappings.values[i, month - 1] = to_value(exceed_prob[order])
+    mappings.valid[i, month - 1] = True
+    return
+
+
+def _gumbel_fit(mappings: Mappings, i: int, month: int, flows: np.ndarray) -> tuple:
+    # the mean and standard deviation of the month's corrected flows within the fit range, like sfdc_apply computes
+    fit_range = SFDC_PARAMS.get('fit_range', (10, 90))
+    index = _lower_bound(mappings.bounds[i, month - 1][None], np.zeros(flows.shape, dtype=np.intp), flows)
+    probs = mappings.probs[i, month - 1][index]
+    in_range = (probs >= fit_range[0]) & (probs <= fit_range[1])
+    try:
+        return _gumbel_params(flows[in_range] / mappings.values[i, month - 1][index[in_range]])
+    except statistics.StatisticsError:
+        return np.nan, np.nan
+
+
+def _table_chunks(shape: tuple, times, mappings, model_ids: list = None):
+    """
+    Splits a flattened array of shape (..., times, rivers) into chunks of at most CHUNK_VALUES values and finds the
+    monthly table (position * 12 + month - 1) of each value, so the tables of a large forecast are never all in memory
+
+    Args:
+        shape: shape of the array of flows
+        times: the datetime of each step of the time axis
+        mappings: Mappings or another set of tables with a positions method
+        model_ids: the model id of each river of the last axis. Defaults to the rivers of the tables in order
+
+    Yields:
+        tuple of the slice of the flattened array and the int array of the table of each of its values
+
+    Raises:
+        ValueError: if the shapes do not match or a river is not in the tables
+    """
+    months = pd.DatetimeIndex(pd.to_datetime(np.asarray(times))).month.values - 1
+    if len(shape) < 2 or months.shape[0] != shape[-2]:
+        raise ValueError(f'Got {months.shape[0]} times for an array of shape {shape}')
+    positions = np.arange(len(mappings)) if model_ids is None else mappings.positions(model_ids)
+    if positions.shape[0] != shape[-1]:
+        raise ValueError(f'Got {positions.shape[0]} rivers for a river axis of length {shape[-1]}')
+    if np.any(positions < 0):
+        raise ValueError(f'{int((positions < 0).sum())} rivers are not in the tables')
+
+    # every member of a river at a time uses the same month of the same river
+    size = int(np.prod(shape))
+    for start in range(0, size, CHUNK_VALUES):
+        flat = np.arange(start, min(start + CHUNK_VALUES, size))
+        yield slice(start, start + flat.size), positions[flat % shape[-1]] * 12 + months[flat // shape[-1] % shape[-2]]
+
+
+def _lower_bound(bounds: np.ndarray, tables: np.ndarray, flows: np.ndarray) -> np.ndarray:
+    """
+    Vectorized searchsorted (side='left') of each flow in its row of a 2D array of sorted bounds. Every row has the
+    same length so a branchless binary search takes the same steps for every flow.
+
+    Args:
+        bounds: array (tables, n) of sorted bounds
+        tables: the row of bounds of each flow
+        flows: the flows to search for
+
+    Returns:
+        np.ndarray of the number of bounds in the row of each flow which are smaller than the flow
+    """
+    flat = bounds.reshape(-1)
+    offset = tables.astype(np.intp) * bounds.shape[1]
+    base = np.zeros(flows.shape, dtype=np.intp)
+    size = bounds.shape[1]
+    while size > 1:
+        half = size // 2
+        base = np.where(flat[offset + base + half - 1] < flows, base + half, base)
+        size -= half
+    return base + (flat[offset + base] < flows)
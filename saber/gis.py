@@ -1,10 +1,7 @@
 import logging
 import os
+from typing import TYPE_CHECKING
 
-import contextily as cx
-import geopandas as gpd
-import matplotlib as mpl
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
@@ -15,13 +12,18 @@ from .io import COL_MID
 from .io import get_dir
 from .io import read_gis
 from .io import read_table
+from .topology import Topology
+from .topology import read_topology
 
-__all__ = ['create_maps', 'map_by_reason', 'map_by_cluster', 'map_unassigned', 'map_ids', ]
+if TYPE_CHECKING:
+    import geopandas as gpd
+
+__all__ = ['create_maps', 'map_by_reason', 'map_by_cluster', 'map_unassigned', 'map_ids', 'map_watershed', ]
 
 logger = logging.getLogger(__name__)
 
 
-def create_maps(assign_df: pd.DataFrame = None, drain_gis: gpd.GeoDataFrame = None, prefix: str = '') -> None:
+def create_maps(assign_df: pd.DataFrame = None, drain_gis: 'gpd.GeoDataFrame' = None, prefix: str = '') -> None:
     """
     Runs all the clip functions which create subsets of the drainage lines GIS dataset based on how they were assigned
     for bias correction.
@@ -34,6 +36,8 @@ def create_maps(assign_df: pd.DataFrame = None, drain_gis: gpd.GeoDataFrame = No
     Returns:
         None
     """
+    import geopandas as gpd
+
     if assign_df is None:
         assign_df = read_table('assign_table')
     if drain_gis is None:
@@ -52,7 +56,7 @@ def create_maps(assign_df: pd.DataFrame = None, drain_gis: gpd.GeoDataFrame = No
     return
 
 
-def map_by_reason(assign_df: pd.DataFrame, drain_gis: str or gpd.GeoDataFrame, prefix: str = '') -> None:
+def map_by_reason(assign_df: pd.DataFrame, drain_gis: 'str or gpd.GeoDataFrame', prefix: str = '') -> None:
     """
     Creates Geopackage files in workdir/gis_outputs for each unique value in the assignment column
 
@@ -64,6 +68,8 @@ def map_by_reason(assign_df: pd.DataFrame, drain_gis: str or gpd.GeoDataFrame, p
     Returns:
         None
     """
+    import geopandas as gpd
+
     # read the drainage line shapefile
     if isinstance(drain_gis, str):
         drain_gis = gpd.read_file(drain_gis)
@@ -94,6 +100,8 @@ def map_by_cluster(assign_table: pd.DataFrame, drain_gis: str, prefix: str = '')
     Returns:
         None
     """
+    import geopandas as gpd
+
     if isinstance(drain_gis, str):
         drain_gis = gpd.read_file(drain_gis)
     for num in assign_table[COL_CID].unique():
@@ -118,6 +126,8 @@ def map_unassigned(assign_table: pd.DataFrame, drain_gis: str, prefix: str = '')
     Returns:
         None
     """
+    import geopandas as gpd
+
     logger.info('Creating GIS output for unassigned basins')
     if isinstance(drain_gis, str):
         drain_gis = gpd.read_file(drain_gis)
@@ -144,6 +154,8 @@ def map_ids(ids: list, drain_gis: str, prefix: str = '', id_column: str = COL_MI
     Returns:
         None
     """
+    import geopandas as gpd
+
     if isinstance(drain_gis, str):
         drain_gis = gpd.read_file(drain_gis)
     name = f'{prefix}{"_" if prefix else ""}id_subset.gpkg'
@@ -151,7 +163,37 @@ def map_ids(ids: list, drain_gis: str, prefix: str = '', id_column: str = COL_MI
     return
 
 
-def histomaps(gdf: gpd.GeoDataFrame, metric: str, prct: str) -> None:
+def map_watershed(model_id: str, drain_gis: str, prefix: str = '', topology: Topology = None) -> None:
+    """
+    Creates a Geopackage file in workdir/gis_outputs of the drainage lines of a reach and every reach upstream of it
+
+    Args:
+        model_id: the model id of the most downstream reach of the watershed
+        drain_gis: path to the drainage shapefile to be clipped
+        prefix: optional, a prefix to prepend to the created file's name
+        topology: the topology of the network. Defaults to the topology in the workdir, or one built from the drain
+            table if it has not been written
+
+    Returns:
+        None
+    """
+    import geopandas as gpd
+
+    if topology is None:
+        try:
+            topology = read_topology()
+        except FileNotFoundError:
+            topology = Topology.from_table(read_table('drain_table'))
+    ids = topology.watershed(model_id)
+    if isinstance(drain_gis, str):
+        drain_gis = gpd.read_file(drain_gis)
+    logger.info(f'Creating GIS output for the {len(ids)} reaches of the watershed of {model_id}')
+    name = f'{prefix}{"_" if prefix else ""}watershed-{model_id}.gpkg'
+    drain_gis[drain_gis[COL_MID].astype(str).isin(ids)].to_file(os.path.join(get_dir('gis'), name))
+    return
+
+
+def histomaps(gdf: 'gpd.GeoDataFrame', metric: str, prct: str) -> None:
     """
     Creates a histogram of the KGE2012 values for the validation set
 
@@ -163,6 +205,10 @@ def histomaps(gdf: gpd.GeoDataFrame, metric: str, prct: str) -> None:
     Returns:
         None
     """
+    import contextily as cx
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+
     core_columns = [COL_MID, COL_GID, 'geometry']
     # world = gpd.read_file(gpd.datasets.get_path('naturalearth_lowres'))
     # world.plot(ax=axm, color='white', edgecolor='black')
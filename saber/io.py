@@ -1,30 +1,39 @@
 import glob
+import hashlib
 import logging
 import os
 import shutil
 from collections.abc import Iterable
 from typing import List
+from typing import TYPE_CHECKING
 
-import geopandas as gpd
+import numpy as np
 import pandas as pd
 import yaml
 from natsort import natsorted
 
+if TYPE_CHECKING:
+    import geopandas as gpd
+
 logger = logging.getLogger(__name__)
 
 __all__ = [
     'read_config', 'init_workdir', 'get_state', 'get_dir', 'read_table', 'write_table', 'read_gis', 'write_gis',
-    'list_cluster_files',
+    'list_cluster_files', 'read_hindcast', 'period_slice',
 
     'COL_MID', 'COL_GID', 'COL_RID', 'COL_CID',
-    'COL_STRM_ORD', 'COL_X', 'COL_Y', 'COL_MID_DOWN',
+    'COL_STRM_ORD', 'COL_X', 'COL_Y', 'COL_MID_DOWN', 'COL_OUTLET',
     'COL_RPROP', 'COL_GPROP', 'COL_ASN_MID', 'COL_ASN_GID', 'COL_ASN_REASON',
+    'COL_RPROP_DIR', 'COL_RPROP_STEPS', 'COL_GPROP_DIR', 'COL_GPROP_STEPS', 'PROP_NONE', 'PROP_DOWN', 'PROP_UP',
 
     'COL_QOBS', 'COL_QMOD', 'COL_QSIM',
-    'DIR_TABLES', 'DIR_GIS', 'DIR_CLUSTERS', 'DIR_VALID', 'DIR_LIST',
+    'DIR_TABLES', 'DIR_GIS', 'DIR_CLUSTERS', 'DIR_VALID', 'DIR_CORRECTED', 'DIR_LIST',
     'TABLE_ASSIGN',
     'TABLE_CLUSTER_METRICS', 'TABLE_CLUSTER_SSCORES', 'TABLE_CLUSTER_LABELS', 'CLUSTER_COUNT_JSON',
-    'TABLE_ASSIGN_BTSTRP', 'TABLE_BTSTRP_METRICS',
+    'CLUSTER_PCA_PICKLE',
+    'TABLE_ASSIGN_BTSTRP', 'TABLE_BTSTRP_METRICS', 'TABLE_BTSTRP_SWEEP', 'TABLE_BTSTRP_CV', 'TABLE_GAUGE_SFDCS',
+    'TABLE_TOPOLOGY', 'TABLE_CORRECTION_LUT', 'TABLE_CORRECTION_MANIFEST',
+    'PIPELINE_STATE_JSON', 'PROGRESS_JSONL', 'TRACE_JSON', 'DIR_TRACES', 'DIR_SIDECARS',
 
     'GENERATED_TABLE_NAMES_MAP', 'VALID_YAML_KEYS', 'VALID_GIS_NAMES',
 ]
@@ -42,6 +51,23 @@ hindcast_zarr = ''
 
 # processing options
 n_processes = 1
+n_clusters = None
+cluster_chunk_rows = None
+cluster_pca = None
+cluster_search = None
+executor = 'process'
+max_memory = None
+cache_size = '256MB'
+trace = False
+table_sidecars = True
+
+# the period of the hindcast which is corrected and used to compute flow duration curves
+start_date = '1980-01-01'
+end_date = None
+
+# resampling of the bootstrap validation metrics to compute confidence intervals
+bootstrap_resamples = 1000
+bootstrap_block_days = 365
 
 # lists for validating
 VALID_YAML_KEYS = {'workdir',
@@ -53,7 +79,20 @@ VALID_YAML_KEYS = {'workdir',
                    'gauge_gis',
                    'gauge_data',
                    'hindcast_zarr',
-                   'n_processes', }
+                   'n_processes',
+                   'n_clusters',
+                   'cluster_chunk_rows',
+                   'cluster_pca',
+                   'cluster_search',
+                   'executor',
+                   'max_memory',
+                   'cache_size',
+                   'trace',
+                   'table_sidecars',
+                   'start_date',
+                   'end_date',
+                   'bootstrap_resamples',
+                   'bootstrap_block_days', }
 
 VALID_GIS_NAMES = ['drain_gis', 'gauge_gis']
 
@@ -67,9 +106,14 @@ COL_STRM_ORD = 'strahler_order'  # strahler order column name: in drain_table
 COL_X = 'x_mod'  # x coordinate column name: in drain_table
 COL_Y = 'y_mod'  # y coordinate column name: in drain_table
 COL_MID_DOWN = 'downstream_model_id'  # downstream model id column name: in drain_table
-
-COL_RPROP = 'rprop'  # regulated stream propagation: created by assign_table
-COL_GPROP = 'gprop'  # gauged stream propagation: created by assign_table
+COL_OUTLET = 'outlet_model_id'  # model id of the terminal outlet of the basin: computed from the drain_table
+
+COL_RPROP = 'rprop'  # model id of the regulatory structure propagated to the stream: created by assign_table
+COL_GPROP = 'gprop'  # model id of the gauged stream propagated to the stream: created by assign_table
+COL_RPROP_DIR = 'rprop_dir'  # direction code of the regulated stream propagation: created by assign_table
+COL_RPROP_STEPS = 'rprop_steps'  # number of streams from the regulated stream to the stream: created by assign_table
+COL_GPROP_DIR = 'gprop_dir'  # direction code of the gauged stream propagation: created by assign_table
+COL_GPROP_STEPS = 'gprop_steps'  # number of streams between the gauged stream and the stream: created by assign_table
 COL_ASN_MID = 'asgn_mid'  # assigned model id column name: in assign_table
 COL_ASN_GID = 'asgn_gid'  # assigned gauge id column name: in assign_table
 COL_ASN_REASON = 'reason'  # reason column name: in assign_table
@@ -88,8 +132,15 @@ all_cols = [COL_MID,
             COL_ASN_GID,
             COL_ASN_REASON, ]
 
-atable_cols = [COL_ASN_MID, COL_ASN_GID, COL_ASN_REASON, COL_RPROP, COL_GPROP]
-atable_cols_defaults = ['unassigned', 'unassigned', 'unassigned', '', '']
+# propagation direction codes: the direction from the source stream to the stream it was propagated to
+PROP_NONE = -1
+PROP_DOWN = 0
+PROP_UP = 1
+
+atable_cols = [COL_ASN_MID, COL_ASN_GID, COL_ASN_REASON,
+               COL_RPROP, COL_RPROP_DIR, COL_RPROP_STEPS,
+               COL_GPROP, COL_GPROP_DIR, COL_GPROP_STEPS, ]
+atable_cols_defaults = ['unassigned', 'unassigned', 'unassigned', '', PROP_NONE, 0, '', PROP_NONE, 0]
 
 # discharge dataframe columns names
 COL_QOBS = 'Qobs'
@@ -101,7 +152,8 @@ DIR_TABLES = 'tables'
 DIR_GIS = 'gis'
 DIR_CLUSTERS = 'clusters'
 DIR_VALID = 'validation'
-DIR_LIST = [DIR_TABLES, DIR_GIS, DIR_CLUSTERS, DIR_VALID]
+DIR_CORRECTED = 'corrected'
+DIR_LIST = [DIR_TABLES, DIR_GIS, DIR_CLUSTERS, DIR_VALID, DIR_CORRECTED]
 
 # name of the required input tables
 TABLE_ASSIGN = 'assign_table.parquet'
@@ -111,18 +163,52 @@ TABLE_CLUSTER_METRICS = 'cluster_metrics.csv'
 TABLE_CLUSTER_SSCORES = 'cluster_sscores.csv'
 TABLE_CLUSTER_LABELS = 'cluster_labels.parquet'
 CLUSTER_COUNT_JSON = 'best-fit-cluster-count.json'
+CLUSTER_PCA_PICKLE = 'pca.pickle'
 
 # tables produced by the bootstrap validation process
 TABLE_ASSIGN_BTSTRP = 'assign_table_bootstrap.csv'
 TABLE_BTSTRP_METRICS = 'bootstrap_metrics.csv'
+TABLE_BTSTRP_SWEEP = 'bootstrap_sweep.csv'
+TABLE_BTSTRP_CV = 'bootstrap_cv.csv'
+
+# monthly scalar flow duration curves precomputed at each gauge
+TABLE_GAUGE_SFDCS = 'gauge_sfdcs.parquet'
+
+# directory of memory mappable arrays describing the river network: created by table.init
+TABLE_TOPOLOGY = 'topology'
+
+# directory of the compiled correction lookup tables of every river: created by saber.lut.compile_tables
+TABLE_CORRECTION_LUT = 'correction_lut'
+
+# the rivers written to the corrected directory by the correction stage and whether each was corrected
+TABLE_CORRECTION_MANIFEST = 'correction_manifest.parquet'
+
+# record of the inputs and outputs of each stage run by the pipeline runner
+PIPELINE_STATE_JSON = 'pipeline_state.json'
+
+# progress reports appended by long parallel runs
+PROGRESS_JSONL = 'progress.jsonl'
+
+# spans recorded by each process when tracing and the chrome trace they are merged into
+DIR_TRACES = 'traces'
+TRACE_JSON = 'trace.json'
+
+# binary copies of the csv input tables, in the tables directory, which are read while the csv is unchanged
+DIR_SIDECARS = 'sidecars'
 
 GENERATED_TABLE_NAMES_MAP = {
     'assign_table': TABLE_ASSIGN,
     'assign_table_bootstrap': TABLE_ASSIGN_BTSTRP,
     'bootstrap_metrics': TABLE_BTSTRP_METRICS,
+    'bootstrap_sweep': TABLE_BTSTRP_SWEEP,
+    'bootstrap_cv': TABLE_BTSTRP_CV,
     'cluster_metrics': TABLE_CLUSTER_METRICS,
     'cluster_sscores': TABLE_CLUSTER_SSCORES,
     'cluster_table': TABLE_CLUSTER_LABELS,
+    'gauge_sfdcs': TABLE_GAUGE_SFDCS,
+    'topology': TABLE_TOPOLOGY,
+    'correction_lut': TABLE_CORRECTION_LUT,
+    'correction_manifest': TABLE_CORRECTION_MANIFEST,
 }
 
 GIS_BOOTSTRAP = 'bootstrap_gauges.gpkg'
@@ -228,7 +314,7 @@ def get_dir(dir_name: str) -> str:
     Returns:
         path to the directory
     """
-    assert dir_name in [DIR_TABLES, DIR_GIS, DIR_CLUSTERS, DIR_VALID], f'"{dir_name}" is not a valid directory name'
+    assert dir_name in DIR_LIST, f'"{dir_name}" is not a valid directory name'
     table_path = os.path.join(workdir, dir_name)
     if not os.path.exists(table_path):
         logger.warning(f'"{dir_name}" directory does not exist. Error imminent: {table_path}')
@@ -252,16 +338,7 @@ def read_table(table_name: str) -> pd.DataFrame:
     table_path = _get_table_path(table_name)
     if not os.path.exists(table_path):
         raise FileNotFoundError(f'Table does not exist: {table_path}')
-
-    table_format = os.path.splitext(table_path)[-1]
-    if table_format == '.parquet':
-        return pd.read_parquet(table_path, engine='fastparquet')
-    elif table_format == '.feather':
-        return pd.read_feather(table_path)
-    elif table_format == '.csv':
-        return pd.read_csv(table_path, dtype=str)
-    else:
-        raise ValueError(f'Unknown table format: {table_format}')
+    return _read_table_cached(table_path, sidecar=bool(table_sidecars) and table_name in VALID_YAML_KEYS)
 
 
 def write_table(df: pd.DataFrame, name: str) -> None:
@@ -278,19 +355,10 @@ def write_table(df: pd.DataFrame, name: str) -> None:
     Raises:
         ValueError: if the table format is not recognized
     """
-    table_path = _get_table_path(name)
-    table_format = os.path.splitext(table_path)[-1]
-    if table_format == '.parquet':
-        return df.to_parquet(table_path)
-    elif table_format == '.feather':
-        return df.to_feather(table_path)
-    elif table_format == '.csv':
-        return df.to_csv(table_path, index=False)
-    else:
-        raise ValueError(f'Unknown table format: {table_format}')
+    return _write_table_path(df, _get_table_path(name))
 
 
-def read_gis(name: str) -> gpd.GeoDataFrame:
+def read_gis(name: str) -> 'gpd.GeoDataFrame':
     """
     Read a GIS file from the project directory by name.
 
@@ -303,12 +371,14 @@ def read_gis(name: str) -> gpd.GeoDataFrame:
     Raises:
         ValueError: if the GIS format is not recognized
     """
+    import geopandas as gpd
+
     assert name in VALID_GIS_NAMES or name in GENERATE_GIS_NAMES_MAP, \
         ValueError(f'"{name}" is not a recognized project state key')
     return gpd.read_file(_get_gis_path(name))
 
 
-def write_gis(gdf: gpd.GeoDataFrame, name: str) -> None:
+def write_gis(gdf: 'gpd.GeoDataFrame', name: str) -> None:
     """
     Write a GIS file to the correct location in the project directory
 
@@ -352,6 +422,66 @@ def list_cluster_files(n_clusters: int or Iterable = 'all') -> List[str]:
         raise TypeError('n_clusters should be of type int or an iterable')
 
 
+def read_hindcast(hindcast_zarr: str, model_ids: list, start: str = None, end: str = None) -> pd.DataFrame:
+    """
+    Reads the simulated discharge of some rivers from the hindcast zarr within the correction period. The period is
+    resolved to a slice of the time index before reading so only the chunks of the zarr within the period are read.
+
+    Args:
+        hindcast_zarr: path or glob pattern of the hindcast zarr(s) with a Qout variable with time and rivid dimensions
+        model_ids: the model ids of the rivers to read
+        start: the first date to read. Defaults to the start_date in the config
+        end: the last date to read (inclusive). Defaults to the end_date in the config
+
+    Returns:
+        pd.DataFrame with a datetime index and a column of discharge per model id, named by the model id as a string
+
+    Raises:
+        ValueError: if any of the model ids are not in the hindcast zarr
+    """
+    import dask
+    import xarray as xr
+
+    # the selection is small so it is read in this thread. Threads started by dask's default scheduler make the workers
+    # of process pools forked afterwards deadlock, e.g. when build_mappings or mp_saber run after a read in the parent
+    with dask.config.set(scheduler='synchronous'), \
+            xr.open_mfdataset(hindcast_zarr, concat_dim='rivid', combine='nested', parallel=True, engine='zarr') as hz:
+        times = pd.to_datetime(hz['time'].values)
+        time_slice = period_slice(times, start, end)
+        positions = pd.Index(hz['rivid'].values).get_indexer([int(float(mid)) for mid in model_ids])
+        if np.any(positions < 0):
+            missing = [mid for mid, pos in zip(model_ids, positions) if pos < 0]
+            raise ValueError(f'Model ids not found in the hindcast zarr: {missing}')
+        values = hz['Qout'].isel(time=time_slice, rivid=positions).values
+    return pd.DataFrame(values, index=times[time_slice], columns=[str(mid) for mid in model_ids])
+
+
+def period_slice(times: pd.DatetimeIndex, start: str = None, end: str = None) -> slice:
+    """
+    Resolves a period of dates to a slice of positions in a sorted datetime index
+
+    Args:
+        times: the sorted datetime index
+        start: the first date of the period. Defaults to the start_date in the config
+        end: the last date of the period (inclusive). Defaults to the end_date in the config
+
+    Returns:
+        slice of the positions of the times in the period
+    """
+    start = start_date if start is None else start
+    end = end_date if end is None else end
+    first = 0 if start is None else int(np.searchsorted(times, pd.Timestamp(start), side='left'))
+    if end is None:
+        return slice(first, len(times))
+    end = pd.Timestamp(end)
+    if end == end.normalize():
+        # a date without a time includes every time on that day
+        last = int(np.searchsorted(times, end + pd.Timedelta(days=1), side='left'))
+    else:
+        last = int(np.searchsorted(times, end, side='right'))
+    return slice(first, last)
+
+
 def _get_table_path(table_name: str) -> str:
     """
     Get the path to a table in the project directory by name
@@ -377,6 +507,167 @@ def _get_table_path(table_name: str) -> str:
         raise ValueError(f'Unknown table name: {table_name}')
 
 
+def _read_table_path(table_path: str) -> pd.DataFrame:
+    """
+    Read a table from a path using the reader for its file extension
+
+    Args:
+        table_path: path to the table
+
+    Returns:
+        pd.DataFrame
+
+    Raises:
+        ValueError: if the table format is not recognized
+    """
+    table_format = os.path.splitext(table_path)[-1]
+    if table_format == '.parquet':
+        return pd.read_parquet(table_path, engine='fastparquet')
+    elif table_format == '.feather':
+        return pd.read_feather(table_path)
+    elif table_format == '.csv':
+        return pd.read_csv(table_path, dtype=str)
+    else:
+        raise ValueError(f'Unknown table format: {table_format}')
+
+
+def _read_table_cached(table_path: str, sidecar: bool = False) -> pd.DataFrame:
+    """
+    Read a table from a path, or while the file has the same modification time and size, a copy of the table from the
+    cache of this process
+
+    Args:
+        table_path: path to the table
+        sidecar: read csv tables from a binary sidecar written the first time the csv is read
+
+    Returns:
+        pd.DataFrame
+    """
+    # imported here because saber.cache imports this module
+    from .cache import get_cache
+
+    stat = os.stat(table_path)
+    key = ('table', os.path.abspath(table_path), stat.st_mtime_ns, stat.st_size)
+    cache = get_cache()
+    df = cache.get(key)
+    if df is None:
+        if sidecar and os.path.splitext(table_path)[-1] == '.csv':
+            df = _read_sidecar(table_path, key)
+        else:
+            df = _read_table_path(table_path)
+        cache.put(key, df)
+    # callers modify the tables they read so the cached table is never returned
+    return df.copy()
+
+
+def _read_sidecar(table_path: str, key: tuple) -> pd.DataFrame:
+    """
+    Read a csv table from the feather sidecar of its modification time and size, or from the csv when there is none and
+    replace any stale sidecar of the csv with a new one
+
+    Args:
+        table_path: path to the csv table
+        key: tuple of 'table', the absolute path, modification time in ns, and size in bytes of the csv
+
+    Returns:
+        pd.DataFrame
+    """
+    sidecar_dir = os.path.join(workdir, DIR_TABLES, DIR_SIDECARS)
+    prefix = f'{os.path.splitext(os.path.basename(table_path))[0]}-{hashlib.sha1(key[1].encode()).hexdigest()[:8]}'
+    sidecar_path = os.path.join(sidecar_dir, f'{prefix}-{key[2]}-{key[3]}.feather')
+    if os.path.exists(sidecar_path):
+        try:
+            return _read_feather_strings(sidecar_path)
+        except Exception as e:
+            logger.warning(f'Ignored unreadable table sidecar {sidecar_path}: {e}')
+
+    df = _read_table_path(table_path)
+    if not os.path.isdir(os.path.join(workdir, DIR_TABLES)):
+        return df
+    try:
+        os.makedirs(sidecar_dir, exist_ok=True)
+        for stale_path in glob.glob(os.path.join(sidecar_dir, f'{prefix}-*.feather')):
+            os.remove(stale_path)
+        # written under a temporary name so other processes never read a partial sidecar
+        tmp_path = f'{sidecar_path}.{os.getpid()}.tmp'
+        df.to_feather(tmp_path)
+        os.replace(tmp_path, sidecar_path)
+    except Exception as e:
+        logger.warning(f'Could not write table sidecar {sidecar_path}: {e}')
+    return df
+
+
+def _read_feather_strings(path: str) -> pd.DataFrame:
+    """
+    Read a feather table of string columns like read_csv reads a csv with dtype=str
+    """
+    import pyarrow.feather
+
+    table = pyarrow.feather.read_table(path)
+    # identical strings are not looked up to share one object, which takes most of the time of converting the table
+    df = table.to_pandas(deduplicate_objects=False)
+    # feather reads the missing values of string columns as None instead of the NaN of read_csv
+    for name, column in zip(table.column_names, table.columns):
+        if column.null_count:
+            df.loc[df[name].isna(), name] = np.nan
+    return df
+
+
+def _write_table_path(df: pd.DataFrame, table_path: str) -> None:
+    """
+    Write a table to a path using the writer for its file extension
+
+    Args:
+        df: the pandas DataFrame to write
+        table_path: path to write the table to
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: if the table format is not recognized
+    """
+    table_format = os.path.splitext(table_path)[-1]
+    if table_format == '.parquet':
+        return df.to_parquet(table_path)
+    elif table_format == '.feather':
+        return df.to_feather(table_path)
+    elif table_format == '.csv':
+        return df.to_csv(table_path, index=False)
+    else:
+        raise ValueError(f'Unknown table format: {table_format}')
+
+
+class _MappedArrays:
+    """
+    Base of the classes whose numpy arrays are written as a directory of .npy files which are memory mapped when read.
+    Subclasses name their arrays in ARRAYS, take them as the first arguments of __init__ followed by the path keyword,
+    and keep the directory the arrays were mapped from as path.
+    """
+    ARRAYS = ()
+
+    def __reduce__(self):
+        # memory mapped arrays are sent to worker processes as their path so each worker maps the same files
+        if self.path is not None:
+            return type(self)._read, (self.path,)
+        return type(self), self._arguments()
+
+    def _arguments(self) -> tuple:
+        return tuple(getattr(self, name) for name in self.ARRAYS)
+
+    def _write(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(path, f'{name}.npy'), np.ascontiguousarray(getattr(self, name)))
+        return
+
+    @classmethod
+    def _read(cls, path: str, mmap: bool = True):
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r' if mmap else None)
+                  for name in cls.ARRAYS}
+        return cls(**arrays, path=os.path.abspath(path) if mmap else None)
+
+
 def _get_gis_path(name: str) -> str:
     if name in VALID_GIS_NAMES:
         return globals()[name]
@@ -0,0 +1,259 @@
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from .forecast import Mappings
+from .forecast import N_PROBS
+from .forecast import _lower_bound
+from .forecast import _table_chunks
+from .forecast import build_mappings
+from .io import COL_MID
+from .io import _MappedArrays
+from .io import _get_table_path
+from .io import get_state
+from .io import read_table
+from .saber import SFDC_PARAMS
+from .saber import _gumbel_flows
+from .trace import span
+
+__all__ = ['CorrectionTables', 'compile_tables', 'write_tables', 'read_tables', ]
+
+logger = logging.getLogger(__name__)
+
+SETTINGS_JSON = 'settings.json'
+
+
+class CorrectionTables(_MappedArrays):
+    """
+    Compiled bias correction of every river: the monthly flow duration curve of its hindcast, the exceedance
+    probability and scalar at each flow of the curve, and the flows which replace the scaled flow, such as the observed
+    flows of gauged rivers and the Gumbel flows of extreme exceedance probabilities. The tables are float32 and are
+    written as a directory of .npy files which are memory mapped when read, so correcting a flow needs a binary search
+    and a multiply but no hindcast or gauge data.
+
+    Args:
+        model_id: model id string of each river
+        bounds: float32 array (rivers, 12, 100) of the sorted midpoints between the flows of each monthly flow duration
+            curve. A flow maps to the position of the first bound which is not smaller than it
+        probs: float32 array (rivers, 12, 101) of the exceedance probability of each position
+        factors: float32 array (rivers, 12, 101) of the factor the flow is multiplied by at each position. NaN where
+            the flow is replaced
+        flows: float32 array (rivers, 12, 101) of the flow which replaces the flow at each position. NaN where the flow
+            is multiplied by the factor
+        gumbel: float32 array (rivers, 12, 2) of the mean and standard deviation of the Gumbel distribution of each
+            month's extreme flows. NaN where none was fit
+        valid: boolean array (rivers, 12) of the months each river can be corrected in
+        settings: the correction settings the tables were compiled with
+        path: directory the arrays were read from, if any
+    """
+    ARRAYS = ('model_id', 'bounds', 'probs', 'factors', 'flows', 'gumbel', 'valid')
+
+    def __init__(self, model_id: np.ndarray, bounds: np.ndarray, probs: np.ndarray, factors: np.ndarray,
+                 flows: np.ndarray, gumbel: np.ndarray, valid: np.ndarray, settings: dict = None, path: str = None):
+        self.model_id = model_id
+        self.bounds = bounds
+        self.probs = probs
+        self.factors = factors
+        self.flows = flows
+        self.gumbel = gumbel
+        self.valid = valid
+        self.settings = settings or {}
+        self.path = path
+        self._index = None
+
+    def __len__(self):
+        return len(self.model_id)
+
+    def _arguments(self) -> tuple:
+        return (*super()._arguments(), self.settings)
+
+    def _write(self, path: str) -> None:
+        super()._write(path)
+        with open(os.path.join(path, SETTINGS_JSON), 'w') as f:
+            json.dump(self.settings, f, indent=2, default=str)
+        return
+
+    @classmethod
+    def _read(cls, path: str, mmap: bool = True) -> 'CorrectionTables':
+        tables = super()._read(path, mmap)
+        with open(os.path.join(path, SETTINGS_JSON)) as f:
+            tables.settings = json.load(f)
+        return tables
+
+    @classmethod
+    def from_mappings(cls, mappings: Mappings, fit_gumbel: bool = False, fit_range: tuple = (10, 90),
+                      settings: dict = None) -> 'CorrectionTables':
+        """
+        Compiles the tables of saber.forecast.build_mappings into float32 lookup tables
+
+        Args:
+            mappings: the correction tables of each river
+            fit_gumbel: replace the flows at exceedance probabilities outside fit_range with the Gumbel distribution of
+                each month like sfdc_mapping does
+            fit_range: lower and upper bounds of exceedance probabilities to keep the scaled flows in
+            settings: the correction settings to record with the tables
+
+        Returns:
+            CorrectionTables
+        """
+        valid = mappings.valid.copy()
+        with np.errstate(divide='ignore'):
+            factors = np.where(mappings.replace[:, None, None], np.nan, 1 / mappings.values)
+        flows = np.where(mappings.replace[:, None, None], mappings.values, np.nan)
+
+        ungauged = ~mappings.replace
+        if fit_gumbel:
+            # sfdc_apply fails the whole river when a month has too few flows to fit to
+            unfit = np.isnan(mappings.gumbel[..., 1]) & valid & ungauged[:, None]
+            valid[unfit.any(axis=1)] = False
+            outside = (mappings.probs < fit_range[0]) | (mappings.probs > fit_range[1])
+            gumbel = _gumbel_flows(mappings.probs, mappings.gumbel[..., :1], mappings.gumbel[..., 1:])
+            replaced = outside & ~np.isnan(gumbel) & ungauged[:, None, None]
+            flows[replaced] = gumbel[replaced]
+            factors[replaced] = np.nan
+
+        return cls(
+            model_id=mappings.model_id,
+            bounds=_floor_float32(mappings.bounds),
+            probs=mappings.probs.astype(np.float32),
+            factors=factors.astype(np.float32),
+            flows=flows.astype(np.float32),
+            gumbel=(mappings.gumbel if fit_gumbel else np.full_like(mappings.gumbel, np.nan)).astype(np.float32),
+            valid=valid,
+            settings=settings,
+        )
+
+    def positions(self, model_ids) -> np.ndarray:
+        """
+        Finds the position of each model id in the tables
+
+        Args:
+            model_ids: iterable of model ids
+
+        Returns:
+            np.ndarray of int positions, -1 for model ids which are not in the tables
+        """
+        if self._index is None:
+            self._index = pd.Index(np.asarray(self.model_id).astype(str))
+        return self._index.get_indexer([str(mid) for mid in model_ids])
+
+    def correct(self, flows: np.ndarray, times, model_ids: list = None) -> np.ndarray:
+        """
+        Bias corrects an array of simulated discharge, such as a hindcast or an ensemble forecast
+
+        Args:
+            flows: array (..., times, rivers) of simulated discharge
+            times: the datetime of each step of the time axis, which selects the month of the tables used
+            model_ids: the model id of each river of the last axis. Defaults to the rivers of the tables in order
+
+        Returns:
+            np.ndarray of the corrected discharge with the shape of flows. NaN where a flow is NaN or its river has no
+            correction in that month
+
+        Raises:
+            ValueError: if the shapes do not match or a river is not in the tables
+        """
+        flows = np.asarray(flows)
+        if flows.dtype.kind != 'f':
+            flows = flows.astype(np.float32)
+        flat = flows.reshape(-1)
+        corrected = np.empty(flat.shape, dtype=np.result_type(flat.dtype, np.float32))
+        flat_bounds = np.asarray(self.bounds).reshape(-1, N_PROBS - 1)
+        flat_factors = np.asarray(self.factors).reshape(-1, N_PROBS)
+        flat_flows = np.asarray(self.flows).reshape(-1, N_PROBS)
+        flat_valid = np.asarray(self.valid).reshape(-1)
+        with span('correct_lut', 'fdc', values=flat.size):
+            for chunk, tables in _table_chunks(flows.shape, times, self, model_ids):
+                index = _lower_bound(flat_bounds, tables, flat[chunk])
+                replaced = flat_flows[tables, index]
+                corrected[chunk] = np.where(np.isnan(replaced), flat[chunk] * flat_factors[tables, index], replaced)
+                corrected[chunk][~flat_valid[tables]] = np.nan
+        corrected[np.isnan(flat)] = np.nan
+        return corrected.reshape(flows.shape)
+
+
+def _floor_float32(bounds: np.ndarray) -> np.ndarray:
+    # rounding each bound down to the float32 below it keeps the comparisons with float32 flows, such as the hindcast
+    # and forecasts, the same as with the float64 bounds, so no flow moves to the neighboring position
+    rounded = bounds.astype(np.float32)
+    above = rounded > bounds
+    rounded[above] = np.nextafter(rounded[above], np.float32(-np.inf))
+    return rounded
+
+
+def compile_tables(model_ids: list = None, assign_df: pd.DataFrame = None, hindcast_zarr: str = None,
+                   gauge_data: str = None) -> CorrectionTables:
+    """
+    Compiles the correction of some rivers into lookup tables with the settings of the correction stage. The tables
+    are derived from the hindcast and observed data once, see saber.forecast.build_mappings.
+
+    Args:
+        model_ids: the model ids of the rivers to compile. Defaults to every river in the assignment table
+        assign_df: the assignment table. Defaults to the assign_table in the workdir
+        hindcast_zarr: path to the hindcast streamflow zarr. Defaults to the hindcast_zarr in the config
+        gauge_data: path to the directory of observed data. Defaults to the gauge_data in the config
+
+    Returns:
+        CorrectionTables
+    """
+    if assign_df is None:
+        assign_df = read_table('assign_table')
+    if model_ids is None:
+        model_ids = assign_df[COL_MID].astype(str).tolist()
+    hindcast_zarr = hindcast_zarr or get_state('hindcast_zarr')
+
+    mappings = build_mappings(model_ids, assign_df, hindcast_zarr, gauge_data)
+    fit_gumbel = SFDC_PARAMS.get('fit_gumbel', False)
+    fit_range = SFDC_PARAMS.get('fit_range', (10, 90))
+    settings = {
+        # the monthly correction of the correction stage does not log transform the flows
+        'use_log': False,
+        'extrapolate': 'nearest',
+        'fit_gumbel': fit_gumbel,
+        'fit_range': list(fit_range),
+        'hindcast_zarr': hindcast_zarr,
+        'start_date': get_state('start_date'),
+        'end_date': get_state('end_date'),
+    }
+    return CorrectionTables.from_mappings(mappings, fit_gumbel, fit_range, settings)
+
+
+def write_tables(tables: CorrectionTables, path: str = None) -> None:
+    """
+    Writes the arrays of compiled correction tables to a directory of .npy files
+
+    Args:
+        tables: the compiled correction tables
+        path: the directory to write to. Defaults to the correction_lut directory in the workdir tables directory
+
+    Returns:
+        None
+    """
+    if path is None:
+        path = _get_table_path('correction_lut')
+    tables._write(path)
+    return
+
+
+def read_tables(path: str = None, mmap: bool = True) -> CorrectionTables:
+    """
+    Reads correction tables written by write_tables
+
+    Args:
+        path: the directory of the tables. Defaults to the correction_lut directory in the workdir tables directory
+        mmap: memory map the arrays instead of reading them into memory
+
+    Returns:
+        CorrectionTables
+
+    Raises:
+        FileNotFoundError: if the tables have not been written
+    """
+    if path is None:
+        path = _get_table_path('correction_lut')
+    if not os.path.isdir(path):
+        raise FileNotFoundError(f'Correction tables do not exist: {path}')
+    return CorrectionTables._read(path, mmap)
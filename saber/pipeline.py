@@ -0,0 +1,389 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+
+from .assign import mp_assign
+from .bs import mp_metrics
+from .bs import mp_table
+from .cluster import best_cluster_count
+from .cluster import cluster
+from .cluster import predict_labels
+from .fdc import mp_precalc_sfdcs
+from .io import DIR_CLUSTERS
+from .io import DIR_CORRECTED
+from .io import PIPELINE_STATE_JSON
+from .io import _get_table_path
+from .io import get_dir
+from .io import get_state
+from .io import read_config
+from .io import read_table
+from .io import write_table
+from .lut import compile_tables
+from .lut import write_tables
+from .saber import mp_saber
+from .shard import merge_parts
+from .shard import write_part
+from .table import init
+from .table import mp_prop_gauges
+from .table import mp_prop_regulated
+from .topology import read_topology
+from .topology import write_topology
+from .trace import merge_traces
+from .trace import span
+
+__all__ = ['STAGES', 'Stage', 'run', 'merge', 'status', ]
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:
+    """
+    A step of the SABER workflow and the files it depends on
+
+    Args:
+        name: name of the stage
+        func: function which runs the stage. Takes no arguments and reads/writes everything in the workdir
+        inputs: config keys whose values (or the contents of the files they point to) the stage depends on
+        upstream: names of the stages whose outputs this stage depends on
+        outputs: functions which return the paths (files, directories, or glob patterns) the stage produces
+        shardable: whether func accepts shard and shard_by arguments to process one part of the work on each machine
+        part_table: name of the table each shard writes a part of, which is merged after every shard finishes
+        optional: whether the stage only runs or merges when it is named in the selected stages
+    """
+
+    def __init__(self, name: str, func: callable, inputs: list = (), upstream: list = (), outputs: list = (),
+                 shardable: bool = False, part_table: str = None, optional: bool = False):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.upstream = list(upstream)
+        self.outputs = list(outputs)
+        self.shardable = shardable
+        self.part_table = part_table
+        self.optional = optional
+
+    def output_paths(self) -> list:
+        return [p() for p in self.outputs]
+
+    def __repr__(self):
+        return f'Stage({self.name})'
+
+
+def _run_cluster() -> None:
+    cluster()
+    return
+
+
+def _run_cluster_table() -> None:
+    predict_labels(int(get_state('n_clusters') or best_cluster_count()))
+    return
+
+
+def _run_assign_table() -> None:
+    assign_df = init(cache=False)
+    write_topology(assign_df)
+    topology = read_topology()
+    assign_df = mp_prop_gauges(assign_df, get_state('n_processes'), topology)
+    assign_df = mp_prop_regulated(assign_df, get_state('n_processes'), topology)
+    assign_df = mp_assign(assign_df)
+    write_table(assign_df, 'assign_table')
+    return
+
+
+def _run_assign_table_bootstrap() -> None:
+    mp_table(read_table('assign_table'))
+    return
+
+
+def _run_bootstrap_metrics(shard: str or tuple = None, shard_by: str = 'outlet') -> None:
+    mp_metrics(read_table('assign_table_bootstrap'), shard=shard, shard_by=shard_by)
+    return
+
+
+def _run_gauge_sfdcs(shard: str or tuple = None, shard_by: str = 'outlet') -> None:
+    mp_precalc_sfdcs(read_table('gauge_table'), shard=shard, shard_by=shard_by)
+    return
+
+
+def _run_correction(shard: str or tuple = None, shard_by: str = 'outlet') -> None:
+    manifest_df = mp_saber(read_table('assign_table'), get_state('hindcast_zarr'), get_state('gauge_data'),
+                           save_dir=get_dir(DIR_CORRECTED), n_processes=get_state('n_processes'),
+                           shard=shard, shard_by=shard_by)
+    # the manifest is written last so a complete manifest (or every part of it) means every river was processed
+    if shard is None:
+        write_table(manifest_df, 'correction_manifest')
+    else:
+        write_part(manifest_df, 'correction_manifest', shard)
+    return
+
+
+def _run_correction_lut() -> None:
+    write_tables(compile_tables())
+    return
+
+
+STAGES = [
+    Stage('cluster', _run_cluster,
+          inputs=['cluster_data', 'cluster_chunk_rows', 'cluster_pca', 'cluster_search'],
+          outputs=[lambda: os.path.join(get_dir(DIR_CLUSTERS), 'kmeans-*.pickle'),
+                   lambda: _get_table_path('cluster_metrics')]),
+    Stage('cluster_table', _run_cluster_table,
+          inputs=['cluster_data', 'n_clusters'], upstream=['cluster'],
+          outputs=[lambda: _get_table_path('cluster_table')]),
+    Stage('assign_table', _run_assign_table,
+          inputs=['drain_table', 'gauge_table', 'regulate_table'], upstream=['cluster_table'],
+          outputs=[lambda: _get_table_path('assign_table'), lambda: _get_table_path('topology')]),
+    Stage('assign_table_bootstrap', _run_assign_table_bootstrap,
+          upstream=['assign_table'],
+          outputs=[lambda: _get_table_path('assign_table_bootstrap')]),
+    Stage('bootstrap_metrics', _run_bootstrap_metrics,
+          inputs=['gauge_data', 'hindcast_zarr', 'start_date', 'end_date', 'bootstrap_resamples',
+                  'bootstrap_block_days'],
+          upstream=['assign_table_bootstrap'],
+          outputs=[lambda: _get_table_path('bootstrap_metrics')],
+          shardable=True, part_table='bootstrap_metrics'),
+    Stage('gauge_sfdcs', _run_gauge_sfdcs,
+          inputs=['gauge_table', 'gauge_data', 'hindcast_zarr', 'start_date', 'end_date'],
+          outputs=[lambda: _get_table_path('gauge_sfdcs')],
+          shardable=True, part_table='gauge_sfdcs', optional=True),
+    Stage('correction', _run_correction,
+          inputs=['gauge_data', 'hindcast_zarr', 'start_date', 'end_date'], upstream=['assign_table'],
+          outputs=[lambda: get_dir(DIR_CORRECTED), lambda: _get_table_path('correction_manifest')],
+          shardable=True, part_table='correction_manifest'),
+    Stage('correction_lut', _run_correction_lut,
+          inputs=['gauge_data', 'hindcast_zarr', 'start_date', 'end_date'], upstream=['assign_table'],
+          outputs=[lambda: _get_table_path('correction_lut')], optional=True),
+]
+
+
+def run(config: str, stages: list = None, force: list or bool = False, dry_run: bool = False,
+        shard: str or tuple = None, shard_by: str = 'outlet') -> list:
+    """
+    Runs the stages of the SABER workflow in dependency order, skipping stages whose inputs and upstream outputs have
+    not changed since they last ran and whose outputs still exist unmodified.
+
+    Args:
+        config: path to the config file
+        stages: names of the stages to run (and their upstream stages when stale). Defaults to all stages which are
+            not optional
+        force: True to rerun every selected stage, or a list of stage names to rerun regardless of their state
+        dry_run: report which stages are stale without running them
+        shard: string 'i/N' or tuple (i, N). Only runs this machine's part of the shardable stages whose upstream
+            stages are up to date. Run merge after every shard finishes to combine the parts and record the stages.
+        shard_by: how to partition the work into shards, see saber.shard.shard_table
+
+    Returns:
+        list of the names of the stages which ran (or would run if dry_run)
+    """
+    read_config(config)
+    state = _read_state()
+    if shard is not None:
+        return _run_shard(state, stages, shard, shard_by, dry_run)
+    selected = _with_upstream(stages) if stages else _default_stages()
+    forced = selected if force is True else list(force or [])
+
+    ran = []
+    for stage in STAGES:
+        if stage.name not in selected:
+            continue
+        if any(u in selected and u not in state for u in stage.upstream):
+            logger.warning(f'Stage "{stage.name}" skipped: upstream stages have not completed')
+            continue
+        if stage.name == 'cluster_table' and get_state('n_clusters') is None and best_cluster_count() is None:
+            logger.warning('Stage "cluster_table" skipped: review the cluster results and set n_clusters in the config')
+            continue
+
+        input_hash = _hash_inputs(stage, state)
+        upstream_stale = dry_run and any(u in ran for u in stage.upstream)
+        if not (stage.name in forced or upstream_stale) and _is_current(stage, state.get(stage.name), input_hash):
+            logger.info(f'Stage "{stage.name}" is up to date')
+            continue
+
+        ran.append(stage.name)
+        if dry_run:
+            logger.info(f'Stage "{stage.name}" is stale')
+            continue
+
+        logger.info(f'Running stage "{stage.name}"')
+        with span(stage.name, 'stage'):
+            stage.func()
+        state[stage.name] = {'inputs': input_hash, 'outputs': _hash_outputs(stage)}
+        _write_state(state)
+
+    if get_state('trace'):
+        merge_traces()
+    return ran
+
+
+def merge(config: str, stages: list = None) -> list:
+    """
+    Combines the parts written by each shard of the shardable stages and records the stages as complete
+
+    Args:
+        config: path to the config file
+        stages: names of the shardable stages to merge. Defaults to all shardable stages which are not optional
+
+    Returns:
+        list of the names of the stages which were merged
+    """
+    read_config(config)
+    state = _read_state()
+    merged = []
+    for stage in STAGES:
+        if not stage.shardable or stage.name not in (stages or _default_stages()):
+            continue
+        if stage.part_table is not None:
+            try:
+                merge_parts(stage.part_table)
+            except FileNotFoundError as e:
+                logger.warning(f'Stage "{stage.name}" not merged: {e}')
+                continue
+        outputs = _hash_outputs(stage)
+        if outputs is None:
+            continue
+        state[stage.name] = {'inputs': _hash_inputs(stage, state), 'outputs': outputs}
+        _write_state(state)
+        merged.append(stage.name)
+    if get_state('trace'):
+        merge_traces()
+    return merged
+
+
+def status(config: str) -> dict:
+    """
+    Reports whether each stage of the SABER workflow is up to date
+
+    Args:
+        config: path to the config file
+
+    Returns:
+        dict of stage name to one of 'current', 'stale', or 'never run'
+    """
+    read_config(config)
+    state = _read_state()
+    report = {}
+    for stage in STAGES:
+        if stage.name not in state:
+            report[stage.name] = 'never run'
+        elif _is_current(stage, state[stage.name], _hash_inputs(stage, state)):
+            report[stage.name] = 'current'
+        else:
+            report[stage.name] = 'stale'
+    return report
+
+
+def _run_shard(state: dict, stages: list or None, shard: str or tuple, shard_by: str, dry_run: bool) -> list:
+    selected = stages or _default_stages()
+    ran = []
+    for stage in STAGES:
+        if stage.name not in selected or not stage.shardable:
+            continue
+        upstream = [u for u in _with_upstream([stage.name]) if u != stage.name]
+        stale_upstream = [u for u in upstream if u not in state or not _is_current(
+            _get_stage(u), state[u], _hash_inputs(_get_stage(u), state))]
+        if stale_upstream:
+            logger.warning(f'Stage "{stage.name}" skipped: upstream stages are not up to date: {stale_upstream}')
+            continue
+        ran.append(stage.name)
+        if dry_run:
+            continue
+        logger.info(f'Running shard {shard} of stage "{stage.name}"')
+        with span(stage.name, 'stage', shard=shard):
+            stage.func(shard=shard, shard_by=shard_by)
+    return ran
+
+
+def _default_stages() -> list:
+    return [s.name for s in STAGES if not s.optional]
+
+
+def _get_stage(name: str) -> Stage:
+    return next(s for s in STAGES if s.name == name)
+
+
+def _with_upstream(names: list) -> list:
+    stages = {s.name: s for s in STAGES}
+    unknown = set(names) - set(stages)
+    if unknown:
+        raise ValueError(f'Unknown stage names: {sorted(unknown)}. Valid names: {list(stages)}')
+    selected = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name not in selected:
+            selected.add(name)
+            pending.extend(stages[name].upstream)
+    return [s.name for s in STAGES if s.name in selected]
+
+
+def _is_current(stage: Stage, record: dict or None, input_hash: str) -> bool:
+    if record is None or record['inputs'] != input_hash:
+        return False
+    return record['outputs'] == _hash_outputs(stage)
+
+
+def _hash_inputs(stage: Stage, state: dict) -> str:
+    """
+    Hash the config values and input files of a stage plus the recorded outputs of its upstream stages
+    """
+    h = hashlib.sha256()
+    for key in stage.inputs:
+        value = get_state(key)
+        h.update(f'{key}={value}'.encode())
+        if isinstance(value, str) and value:
+            for path in sorted(glob.glob(os.path.join(get_state('workdir'), value))):
+                h.update(_fingerprint(path).encode())
+    for name in stage.upstream:
+        h.update(f'{name}={state.get(name, {}).get("outputs")}'.encode())
+    return h.hexdigest()
+
+
+def _hash_outputs(stage: Stage) -> str or None:
+    h = hashlib.sha256()
+    for pattern in stage.output_paths():
+        paths = sorted(glob.glob(pattern))
+        if not paths:
+            return None
+        for path in paths:
+            h.update(_fingerprint(path).encode())
+    return h.hexdigest()
+
+
+def _fingerprint(path: str) -> str:
+    """
+    Content hash of a file. Directories (zarr stores, gauge data, corrected outputs) can be too large to read so they
+    are fingerprinted by the relative path, size, and modification time of every file they contain.
+    """
+    if os.path.isfile(path):
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            stat = os.stat(file_path)
+            h.update(f'{os.path.relpath(file_path, path)}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return h.hexdigest()
+
+
+def _read_state() -> dict:
+    path = os.path.join(get_state('workdir'), PIPELINE_STATE_JSON)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_state(state: dict) -> None:
+    path = os.path.join(get_state('workdir'), PIPELINE_STATE_JSON)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + '.tmp', path)
+    return
@@ -0,0 +1,196 @@
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+from .io import PROGRESS_JSONL
+from .io import get_state
+
+__all__ = ['Progress', 'rss_mb', 'pss_mb', ]
+
+logger = logging.getLogger(__name__)
+
+
+class Progress:
+    """
+    Reports the progress of a parallel run while it is in flight: completed and failed task counts, tasks per second,
+    estimated time remaining and the resident memory of each worker. Reports are logged and appended as JSON lines to
+    the progress file in the workdir every interval seconds, including while no task finishes so stalls are visible.
+
+    Use as a context manager around the loop which collects the results of an executor.
+
+    Args:
+        total: the number of tasks in the run
+        label: name of the run written with each report
+        executor: the executor running the tasks, used to find the worker processes. Defaults to this process only
+        interval: seconds between reports
+        path: path of the JSON lines file to append reports to. Defaults to the progress file in the workdir. Use
+            False to only log the reports
+    """
+
+    def __init__(self, total: int, label: str, executor=None, interval: float = 10, path: str or bool = None):
+        self.total = int(total)
+        self.label = label
+        self.executor = executor
+        self.interval = interval
+        if path is None:
+            workdir = get_state('workdir')
+            path = os.path.join(workdir, PROGRESS_JSONL) if workdir and os.path.isdir(workdir) else False
+        self.path = path
+        self.completed = 0
+        self.failed = 0
+        self._start = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        self._thread = threading.Thread(target=self._report_every_interval, name='saber-progress', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+        self.report(final=True)
+
+    def update(self, ok: bool = True) -> None:
+        """
+        Records that a task finished
+
+        Args:
+            ok: False if the task failed
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.completed += 1
+            if not ok:
+                self.failed += 1
+        return
+
+    def track(self, results, failed: callable = lambda result: result is None):
+        """
+        Records each result of an iterator of results as it arrives and passes it through
+
+        Args:
+            results: iterator of task results, such as Executor.imap
+            failed: function which returns True if a result means the task failed. Defaults to results which are None
+
+        Yields:
+            each result
+        """
+        for result in results:
+            self.update(not failed(result))
+            yield result
+
+    def report(self, final: bool = False) -> dict:
+        """
+        Logs the current progress and appends it to the progress file
+
+        Args:
+            final: whether this is the report after every task finished
+
+        Returns:
+            dict of the report
+        """
+        with self._lock:
+            completed, failed = self.completed, self.failed
+        elapsed = time.monotonic() - self._start if self._start is not None else 0
+        rate = completed / elapsed if elapsed > 0 else 0
+        eta = (self.total - completed) / rate if rate > 0 else None
+        workers = {} if final else {str(pid): rss_mb(pid) for pid in self._worker_pids()}
+        record = {
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'label': self.label,
+            'total': self.total,
+            'completed': completed,
+            'failed': failed,
+            'elapsed_seconds': round(elapsed, 1),
+            'per_second': round(rate, 3),
+            'eta_seconds': None if eta is None else round(eta, 1),
+            'worker_rss_mb': workers,
+            'final': final,
+        }
+
+        message = f'{self.label}: {completed}/{self.total} done, {failed} failed, {rate:.2f}/s'
+        if final:
+            message += f', finished in {datetime.timedelta(seconds=round(elapsed))}'
+        else:
+            message += f', ETA {"unknown" if eta is None else datetime.timedelta(seconds=round(eta))}'
+            rss = [mb for mb in workers.values() if mb is not None]
+            if rss:
+                message += f', worker RSS {min(rss):.0f}-{max(rss):.0f} MB'
+        logger.info(message)
+
+        if self.path:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        return record
+
+    def _report_every_interval(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.report()
+        return
+
+    def _worker_pids(self) -> list:
+        if self.executor is not None and hasattr(self.executor, 'worker_pids'):
+            return self.executor.worker_pids()
+        return [os.getpid(), ]
+
+
+def rss_mb(pid: int = None) -> float or None:
+    """
+    Resident memory of a process in megabytes, read from /proc on Linux or with psutil if it is installed
+
+    Args:
+        pid: the process id. Defaults to this process
+
+    Returns:
+        float megabytes, or None if it cannot be measured
+    """
+    pid = os.getpid() if pid is None else pid
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss / 1024 ** 2
+    except Exception:
+        return None
+
+
+def pss_mb(pid: int = None) -> float or None:
+    """
+    Proportional set size of a process in megabytes: its resident memory with each page shared with other processes,
+    such as the copy-on-write pages of forked workers, divided between them. Read from /proc on Linux or with psutil if
+    it is installed, otherwise the resident memory
+
+    Args:
+        pid: the process id. Defaults to this process
+
+    Returns:
+        float megabytes, or None if it cannot be measured
+    """
+    pid = os.getpid() if pid is None else pid
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+        info = psutil.Process(pid).memory_full_info()
+        return getattr(info, 'pss', info.uss) / 1024 ** 2
+    except Exception:
+        return rss_mb(pid)
@@ -1,42 +1,67 @@
+import functools
 import logging
 import os
 import statistics
-from multiprocessing import Pool
+import warnings
 
 import numpy as np
 import pandas as pd
-import xarray
 from natsort import natsorted
-from scipy import interpolate, stats
+from scipy import interpolate
 
+from .cache import cached_gauge_data
+from .cache import cached_hindcast
+from .cache import prefetch
+from .executor import get_executor
 from .fdc import fdc
 from .fdc import sfdc
+from .io import COL_ASN_GID
 from .io import COL_ASN_MID
-from .io import COL_GID
 from .io import COL_MID
 from .io import COL_QMOD
 from .io import COL_QOBS
 from .io import COL_QSIM
+from .progress import Progress
+from .shard import shard_table
+from .trace import span
 
 logger = logging.getLogger(__name__)
 
-__all__ = ['mp_saber', 'fdc_mapping', 'sfdc_mapping', 'map_saber']
+__all__ = ['mp_saber', 'fdc_mapping', 'sfdc_mapping', 'sfdc_curves', 'sfdc_apply', 'map_saber', 'map_saber_group']
+
+# the most streams corrected by one task. Larger groups share the scalar flow duration curves of their gauge between
+# more streams but read more of the hindcast at once and balance the work between workers less evenly
+GROUP_SIZE = 256
+
+# the most groups corrected by one task. The data of the next groups of a task are read while a group is corrected
+TASK_GROUPS = 8
+
+# the sfdc_mapping settings used to correct the streams assigned to a gauge, and the settings which only change the
+# scalar flow duration curves of the gauge (sfdc_curves) or how they are applied to each stream (sfdc_apply)
+SFDC_PARAMS = {'use_log': True, 'drop_outliers': True, 'outlier_threshold': 3, 'fit_gumbel': True, 'fit_range': (5, 95)}
+CURVE_PARAMS = ('use_log', 'fix_seasonally', 'empty_months', 'drop_outliers', 'outlier_threshold',
+                'filter_scalar_fdc', 'filter_range')
+APPLY_PARAMS = ('use_log', 'drop_outliers', 'outlier_threshold', 'extrapolate', 'fill_value', 'fit_gumbel', 'fit_range')
 
 
 def mp_saber(assign_df: pd.DataFrame, hindcast_zarr: str, gauge_data: str, save_dir: str = None,
-             n_processes: int or None = None) -> None:
+             n_processes: int or None = None, shard: str or tuple = None, shard_by: str = 'outlet') -> pd.DataFrame:
     """
-    Corrects all streams in the assignment table using the SABER method with a multiprocessing Pool
+    Corrects all streams in the assignment table using the SABER method in parallel with the configured executor.
+    Streams are grouped by their assigned gauge so the scalar flow duration curves of each gauge are computed once per
+    group of up to GROUP_SIZE streams instead of once per stream.
 
     Args:
         assign_df: the assignment table
         hindcast_zarr: string path to the hindcast streamflow dataset in zarr format
         gauge_data: path to the directory of observed data
         save_dir: path to the directory to save the corrected data
-        n_processes: number of processes to use for multiprocessing, passed to Pool
+        n_processes: number of processes to use for multiprocessing, passed to the executor
+        shard: string 'i/N' or tuple (i, N) to only correct the streams in one shard of the assignment table
+        shard_by: how to partition the streams into shards, see saber.shard.shard_table
 
     Returns:
-        None
+        pd.DataFrame manifest with the model id of each stream and whether its corrected data were written
     """
     logger.info('Starting SABER Bias Correction')
 
@@ -45,70 +70,176 @@ def mp_saber(assign_df: pd.DataFrame, hindcast_zarr: str, gauge_data: str, save_
         if not os.path.exists(save_dir):
             os.makedirs(save_dir)
 
-    with Pool(n_processes) as p:
-        p.starmap(
-            map_saber,
-            [[mid, asgn_mid, asgn_gid, hindcast_zarr, gauge_data, save_dir] for mid, asgn_mid, asgn_gid in
-             np.moveaxis(assign_df[[COL_MID, COL_ASN_MID, COL_GID]].values, 0, 0)]
-        )
+    if shard is not None:
+        assign_df = shard_table(assign_df, shard, by=shard_by, network=assign_df, hindcast_zarr=hindcast_zarr)
+
+    # each task corrects several groups so the data of the next group is read while the current one is corrected
+    groups = _gauge_groups(assign_df)
+    tasks = [[groups[i:i + TASK_GROUPS], hindcast_zarr, gauge_data, save_dir]
+             for i in range(0, len(groups), TASK_GROUPS)]
+    written = []
+    with get_executor(n_processes) as p, Progress(len(assign_df), 'correction', p) as progress:
+        for corrected in p.istarmap(_map_saber_write, tasks):
+            for ok in corrected:
+                progress.update(ok)
+            written.extend(corrected)
 
     logger.info('Finished SABER Bias Correction')
-    return
+    mids = [mid for mids, _, _ in groups for mid in mids]
+    return pd.DataFrame({COL_MID: mids, 'corrected': written})
+
+
+def _gauge_groups(assign_df: pd.DataFrame) -> list:
+    """
+    Splits the assignment table into groups of streams with the same assigned gauge and model id, largest first so the
+    longest tasks start first, with at most GROUP_SIZE streams per group
+
+    Args:
+        assign_df: the assignment table
+
+    Returns:
+        list of tuples (list of model ids, assigned model id, assigned gauge id)
+    """
+    groups = []
+    for (asgn_gid, asgn_mid), group_df in assign_df.groupby([COL_ASN_GID, COL_ASN_MID], dropna=False, sort=False):
+        mids = group_df[COL_MID].tolist()
+        groups.extend((mids[i:i + GROUP_SIZE], asgn_mid, asgn_gid) for i in range(0, len(mids), GROUP_SIZE))
+    return sorted(groups, key=lambda group: len(group[0]), reverse=True)
+
+
+def _map_saber_write(groups: list, hz: str, gauge_data: str, save_dir: str) -> list:
+    """
+    Helper function for mp_saber which corrects some groups of streams assigned to the same gauge and writes each result
+    to a parquet file named by the model id in the save_dir. The data of the next groups are read in the background
+    while a group is corrected. Separate function so it can be pickled for multiprocessing.
+
+    Args:
+        groups: list of tuples (model ids of the streams to be corrected, assigned model id, assigned gauge id)
+        hz: string path to the hindcast streamflow dataset in zarr format
+        gauge_data: path to the directory of observed data
+        save_dir: path to the directory to save the corrected data
+
+    Returns:
+        list of bool whether each stream was corrected
+    """
+    corrected = []
+    loaders = [functools.partial(_read_group, *group, hz, gauge_data) for group in groups]
+    for (mids, asgn_mid, asgn_gid), data in zip(groups, prefetch(loaders)):
+        # a failed read is repeated by map_saber_group which handles the error
+        data = None if data.exception() else data.result()
+        for mid, corrected_df in zip(mids, map_saber_group(mids, asgn_mid, asgn_gid, hz, gauge_data, data)):
+            if corrected_df is None:
+                corrected.append(False)
+                continue
+            with span('write_parquet', 'write', model_id=mid):
+                corrected_df.to_parquet(os.path.join(save_dir, f'{mid}.parquet'))
+            corrected.append(True)
+    return corrected
 
 
 def map_saber(mid: str, asgn_mid: str, asgn_gid: str, hz: str, gauge_data: str) -> pd.DataFrame | tuple | None:
     """
-    Corrects all streams in the assignment table using the SABER method
+    Corrects a single stream using the SABER method
 
     Args:
         mid: the model id of the stream to be corrected
         asgn_mid: the model id of the stream assigned to mid for bias correction
         asgn_gid: the gauge id of the stream assigned to mid for bias correction
-        hz: xarray dataset of hindcast streamflow data
+        hz: path to the hindcast streamflow zarr. Only the correction period (start_date to end_date) is read
         gauge_data: path to the directory of observed data
 
     Returns:
-        None
+        pd.DataFrame of the corrected and simulated discharge, or None if the stream could not be corrected
     """
-    try:
-        if asgn_gid is None or pd.isna(asgn_gid):
-            logger.debug(f'No gauge assigned to {mid}')
-            return
-
-        # find the observed data to be used for correction
-        if not os.path.exists(os.path.join(gauge_data, f'{asgn_gid}.csv')):
-            logger.debug(f'Observed data "{asgn_gid}" not found. Cannot correct "{mid}".')
-        obs_df = pd.read_csv(os.path.join(gauge_data, f'{asgn_gid}.csv'), index_col=0)
-        obs_df.index = pd.to_datetime(obs_df.index)
-
-        # perform corrections
-        hz = xarray.open_mfdataset(hz, concat_dim='rivid', combine='nested', parallel=True, engine='zarr')
-        rivids = hz.rivid.values
-        sim_a = hz['Qout'][:, rivids == int(mid)].values
-        sim_a = pd.DataFrame(sim_a, index=hz['time'].values, columns=[COL_QSIM])
-        if asgn_mid != mid:
-            sim_b = hz['Qout'][:, rivids == int(asgn_mid)].values
-            sim_b = pd.DataFrame(sim_b, index=sim_a.index, columns=[COL_QSIM])
-            sim_b = sim_b[sim_b.index.year >= 1980]
-        sim_a = sim_a[sim_a.index.year >= 1980]
-        hz.close()
-
-        if asgn_mid == mid:
-            corrected_df = fdc_mapping(sim_a, obs_df)
-        else:
-            corrected_df = sfdc_mapping(
-                sim_b, obs_df, sim_a,
-                use_log=True,
-                drop_outliers=True, outlier_threshold=3,
-                fit_gumbel=True, fit_range=(5, 95),
-            )
+    return map_saber_group([mid, ], asgn_mid, asgn_gid, hz, gauge_data)[0]
+
 
-        return corrected_df
+def map_saber_group(mids: list, asgn_mid: str, asgn_gid: str, hz: str, gauge_data: str, data: tuple = None) -> list:
+    """
+    Corrects a group of streams assigned to the same gauge using the SABER method. The observed data and the scalar
+    flow duration curves at the gauge are computed once and applied to every stream in the group, and the simulated
+    data of the group are read from the hindcast in one request.
 
+    Args:
+        mids: the model ids of the streams to be corrected
+        asgn_mid: the model id of the stream assigned to the mids for bias correction
+        asgn_gid: the gauge id of the stream assigned to the mids for bias correction
+        hz: path to the hindcast streamflow zarr. Only the correction period (start_date to end_date) is read
+        gauge_data: path to the directory of observed data
+        data: tuple of the observed and simulated discharge of the group from _read_group, such as read ahead by
+            saber.cache.prefetch. Read when not given
+
+    Returns:
+        list of a pd.DataFrame of the corrected and simulated discharge of each mid, or None for the streams which
+        could not be corrected
+    """
+    if asgn_gid is None or pd.isna(asgn_gid):
+        logger.debug(f'No gauge assigned to {len(mids)} streams')
+        return [None, ] * len(mids)
+
+    mids = [str(mid) for mid in mids]
+    asgn_mid = str(asgn_mid)
+    try:
+        obs_df, sim_df = _read_group(mids, asgn_mid, asgn_gid, hz, gauge_data) if data is None else data
     except Exception as e:
+        if len(mids) > 1 and isinstance(e, ValueError):
+            # a river missing from the hindcast only fails that river
+            return [result for mid in mids for result in map_saber_group([mid, ], asgn_mid, asgn_gid, hz, gauge_data)]
         logger.error(e)
-        logger.debug(f'Failed to correct {mid}')
-        return
+        logger.debug(f'Failed to correct {len(mids)} streams assigned to gauge {asgn_gid}')
+        return [None, ] * len(mids)
+
+    corrected = dict.fromkeys(mids)
+    if asgn_mid in corrected:
+        try:
+            with span('fdc_mapping', 'fdc', model_id=asgn_mid):
+                corrected[asgn_mid] = fdc_mapping(sim_df[[asgn_mid]].set_axis([COL_QSIM], axis=1), obs_df)
+        except Exception as e:
+            logger.error(e)
+            logger.debug(f'Failed to correct {asgn_mid}')
+
+    ungauged = [mid for mid in mids if mid != asgn_mid]
+    if ungauged:
+        try:
+            with span('sfdc_curves', 'fdc', gauge_id=asgn_gid):
+                curves = sfdc_curves(sim_df[[asgn_mid]].set_axis([COL_QSIM], axis=1), obs_df,
+                                     **_select(SFDC_PARAMS, CURVE_PARAMS))
+            with span('sfdc_apply', 'fdc', gauge_id=asgn_gid, rivers=len(ungauged)):
+                corrected.update(zip(ungauged, sfdc_apply(curves, sim_df[ungauged],
+                                                          **_select(SFDC_PARAMS, APPLY_PARAMS))))
+        except Exception as e:
+            logger.error(e)
+            logger.debug(f'Failed to correct {len(ungauged)} streams assigned to gauge {asgn_gid}')
+
+    return list(corrected.values())
+
+
+def _read_group(mids: list, asgn_mid: str, asgn_gid: str, hz: str, gauge_data: str) -> tuple:
+    """
+    Reads the observed discharge of the assigned gauge and the simulated discharge of the assigned river and every river
+    of a group within the correction period
+
+    Returns:
+        tuple of the observed and simulated discharge DataFrames, or None if no gauge is assigned
+    """
+    if asgn_gid is None or pd.isna(asgn_gid):
+        return None
+    mids = [str(mid) for mid in mids]
+    asgn_mid = str(asgn_mid)
+
+    # find the observed data to be used for correction
+    if not os.path.exists(os.path.join(gauge_data, f'{asgn_gid}.csv')):
+        logger.debug(f'Observed data "{asgn_gid}" not found. Cannot correct {len(mids)} streams.')
+    with span('read_gauge_csv', 'io', gauge_id=asgn_gid):
+        obs_df = cached_gauge_data(gauge_data, asgn_gid)
+
+    # read the simulated data of the gauged river and every river in the group within the correction period. The
+    # gauged river is shared by every group of the gauge so it is cached, the rivers of a large group are only read
+    # once so they are not
+    with span('read_hindcast', 'io', gauge_id=asgn_gid, rivers=len(mids)):
+        sim_df = cached_hindcast(hz, list(dict.fromkeys([asgn_mid, ] + mids)),
+                                 keep=None if len(mids) == 1 else [asgn_mid, ])
+    return obs_df, sim_df
 
 
 def fdc_mapping(sim_df: pd.DataFrame, obs_df: pd.DataFrame) -> pd.DataFrame:
@@ -161,6 +292,9 @@ def sfdc_mapping(sim_flow_a: pd.DataFrame, obs_flow_a: pd.DataFrame, sim_flow_b:
     Given simulated and observed discharge at location A, removes bias from simulated data at point A.
     Given simulated and observed discharge at location A, removes bias from simulated data at point B, if given B.
 
+    Equivalent to sfdc_apply(sfdc_curves(...), ...). Use those functions directly to correct many points B with the
+    same data at point A.
+
     Args:
         sim_flow_a (pd.DataFrame): simulated hydrograph at point A. should contain a datetime index with daily values
             and a single column of discharge values.
@@ -194,13 +328,60 @@ def sfdc_mapping(sim_flow_a: pd.DataFrame, obs_flow_a: pd.DataFrame, sim_flow_b:
         pd.DataFrame with a DateTime index and columns with corrected flow, uncorrected flow, the scalar adjustment
         factor applied to correct the discharge, and the percentile of the uncorrected flow (in the seasonal grouping,
         if applicable).
+
+    Raises:
+        ValueError: if the discharge at point B could not be corrected
+    """
+    curves = sfdc_curves(
+        sim_flow_a, obs_flow_a,
+        use_log=use_log,
+        fix_seasonally=fix_seasonally, empty_months=empty_months,
+        drop_outliers=drop_outliers, outlier_threshold=outlier_threshold,
+        filter_scalar_fdc=filter_scalar_fdc, filter_range=filter_range,
+    )
+    corrected_df = sfdc_apply(
+        curves, sim_flow_b,
+        use_log=use_log,
+        drop_outliers=drop_outliers, outlier_threshold=outlier_threshold,
+        extrapolate=extrapolate, fill_value=fill_value,
+        fit_gumbel=fit_gumbel, fit_range=fit_range,
+        metadata=metadata,
+    )[0]
+    if corrected_df is None:
+        raise ValueError('Failed to correct the simulated discharge at point B')
+    return corrected_df
+
+
+def sfdc_curves(sim_flow_a: pd.DataFrame, obs_flow_a: pd.DataFrame,
+                use_log: bool = False,
+                fix_seasonally: bool = True, empty_months: str = 'skip',
+                drop_outliers: bool = False, outlier_threshold: int or float = 2.5,
+                filter_scalar_fdc: bool = False, filter_range: tuple = (0, 80), ) -> dict:
+    """
+    Computes the scalar flow duration curves at point A from its simulated and observed discharge. The curves only
+    depend on point A so they can be computed once and used by sfdc_apply to correct any number of points B.
+
+    Args:
+        sim_flow_a (pd.DataFrame): simulated hydrograph at point A with a datetime index and a column of discharge
+        obs_flow_a (pd.DataFrame): observed hydrograph at point A with a datetime index and a column of discharge
+        use_log (bool): if True, log10 transform the discharge values before computing the curves
+        fix_seasonally (bool): compute a curve for each month (True) or one for all months (False)
+        empty_months (str): how to handle months without observed data. Options: "skip"
+        drop_outliers (bool): flag to exclude outliers
+        outlier_threshold (int or float): number of std deviations from mean to exclude from flow duration curve
+        filter_scalar_fdc (bool): flag to filter the scalar flow duration curve
+        filter_range (tuple): lower and upper bounds of the filter range
+
+    Returns:
+        dict of the scalar flow duration curve DataFrames keyed by month number (1-12), or with the key 0 for the curve
+        of all months when not fix_seasonally
     """
     if fix_seasonally:
         # list of the unique months in the historical simulation. should always be 1->12 but just in case...
-        monthly_results = []
-        for month in sorted(set(sim_flow_a.index.strftime('%m'))):
+        curves = {}
+        for month in sorted(set(sim_flow_a.index.month)):
             # filter data to current iteration's month
-            mon_obs_a = obs_flow_a[obs_flow_a.index.month == int(month)].dropna()
+            mon_obs_a = obs_flow_a[obs_flow_a.index.month == month].dropna()
 
             if mon_obs_a.empty:
                 if empty_months == 'skip':
@@ -208,75 +389,170 @@ def sfdc_mapping(sim_flow_a: pd.DataFrame, obs_flow_a: pd.DataFrame, sim_flow_b:
                 else:
                     raise ValueError(f'Invalid value for argument "empty_months". Given: {empty_months}.')
 
-            mon_sim_a = sim_flow_a[sim_flow_a.index.month == int(month)].dropna()
-            mon_sim_b = sim_flow_b[sim_flow_b.index.month == int(month)].dropna()
-            monthly_results.append(sfdc_mapping(
-                mon_sim_a, mon_obs_a, mon_sim_b,
+            mon_sim_a = sim_flow_a[sim_flow_a.index.month == month].dropna()
+            curves[month] = sfdc_curves(
+                mon_sim_a, mon_obs_a,
                 fix_seasonally=False, empty_months=empty_months,
                 drop_outliers=drop_outliers, outlier_threshold=outlier_threshold,
                 filter_scalar_fdc=filter_scalar_fdc, filter_range=filter_range,
-                extrapolate=extrapolate, fill_value=fill_value,
-                fit_gumbel=fit_gumbel, fit_range=fit_range, )
-            )
-        # combine the results from each monthly into a single dataframe (sorted chronologically) and return it
-        return pd.concat(monthly_results).sort_index()
+            )[0]
+        return curves
 
     if use_log:
         sim_flow_a = np.log10(sim_flow_a)
         obs_flow_a = np.log10(obs_flow_a)
-        if sim_flow_b is not None:
-            sim_flow_b = np.log10(sim_flow_b)
 
     # compute the flow duration curves
     if drop_outliers:
         sim_fdc_a = fdc(_drop_outliers_by_zscore(sim_flow_a, threshold=outlier_threshold), col_name=COL_QSIM)
-        sim_fdc_b = fdc(_drop_outliers_by_zscore(sim_flow_b, threshold=outlier_threshold), col_name=COL_QSIM)
         obs_fdc = fdc(_drop_outliers_by_zscore(obs_flow_a, threshold=outlier_threshold), col_name=COL_QOBS)
     else:
         sim_fdc_a = fdc(sim_flow_a, col_name=COL_QSIM)
-        sim_fdc_b = fdc(sim_flow_b, col_name=COL_QSIM)
         obs_fdc = fdc(obs_flow_a, col_name=COL_QOBS)
 
     # calculate the scalar flow duration curve (at point A with simulated and observed data)
     scalar_fdc = sfdc(sim_fdc_a[COL_QSIM], obs_fdc[COL_QOBS])
     if filter_scalar_fdc:
-        scalar_fdc = scalar_fdc[scalar_fdc['p_exceed'].between(filter_range[0], filter_range[1])]
+        scalar_fdc = scalar_fdc[(scalar_fdc.index >= filter_range[0]) & (scalar_fdc.index <= filter_range[1])]
 
     logger.debug(f'Min/Max Scalar {scalar_fdc.min()} {scalar_fdc.max()}')
+    return {0: scalar_fdc}
 
-    # make interpolators: Q_b -> p_exceed_b, p_exceed_a -> scalars_a
-    # flow at B converted to exceedance probabilities, then matched with the scalar computed at point A
-    flow_to_percent = _make_interpolator(sim_fdc_b.values.flatten(),
-                                         sim_fdc_b.index,
-                                         extrap=extrapolate,
-                                         fill_value=fill_value)
-
-    percent_to_scalar = _make_interpolator(scalar_fdc.index,
-                                           scalar_fdc.values.flatten(),
-                                           extrap=extrapolate,
-                                           fill_value=fill_value)
 
-    # apply interpolators to correct flows at B with data from A
-    qb_original = sim_flow_b.values.flatten()
-    p_exceed = flow_to_percent(qb_original)
-    scalars = percent_to_scalar(p_exceed)
-    qb_adjusted = qb_original / scalars
+def sfdc_apply(curves: dict, sim_flow_b: pd.DataFrame,
+               use_log: bool = False,
+               drop_outliers: bool = False, outlier_threshold: int or float = 2.5,
+               extrapolate: str = 'nearest', fill_value: int or float = None,
+               fit_gumbel: bool = False, fit_range: tuple = (10, 90),
+               metadata: bool = False, ) -> list:
+    """
+    Removes the bias from the simulated discharge of one or more points B using the scalar flow duration curves of
+    point A from sfdc_curves. The flow duration curves of every point B are computed together and the scalars are
+    interpolated for all of them at once.
 
-    if fit_gumbel:
-        qb_adjusted = _fit_extreme_values_to_gumbel(qb_adjusted, p_exceed, fit_range)
+    Args:
+        curves (dict): the scalar flow duration curves from sfdc_curves
+        sim_flow_b (pd.DataFrame): simulated hydrographs at points B with a datetime index and a column of discharge
+            for each point. Missing values are skipped.
+        use_log (bool): if True, log10 transform the discharge values before correcting
+        drop_outliers (bool): flag to exclude outliers from the flow duration curves
+        outlier_threshold (int or float): number of std deviations from mean to exclude from flow duration curve
+        extrapolate (str): method to use for extrapolation. Options: nearest, const, linear, average, max, min
+        fill_value (int or float): value to use for extrapolation when extrapolate_method='const'
+        fit_gumbel (bool): flag to replace extremely low/high corrected flows with values from Gumbel type 1
+        fit_range (tuple): lower and upper bounds of exceedance probabilities to replace with Gumbel values
+        metadata (bool): flag to return the scalars and metadata about the correction process
 
+    Returns:
+        list with a pd.DataFrame like sfdc_mapping returns for each column of sim_flow_b, or None for the points which
+        could not be corrected
+    """
+    if 0 not in curves:
+        monthly_results = [[] for _ in sim_flow_b.columns]
+        for month, scalar_fdc in curves.items():
+            mon_sim_b = sim_flow_b[sim_flow_b.index.month == month]
+            month_dfs = sfdc_apply(
+                {0: scalar_fdc}, mon_sim_b,
+                drop_outliers=drop_outliers, outlier_threshold=outlier_threshold,
+                extrapolate=extrapolate, fill_value=fill_value,
+                fit_gumbel=fit_gumbel, fit_range=fit_range,
+                metadata=metadata,
+            )
+            for results, month_df in zip(monthly_results, month_dfs):
+                results.append(month_df)
+        # combine the results from each month into a single dataframe (sorted chronologically)
+        return [None if not results or any(df is None for df in results) else pd.concat(results).sort_index()
+                for results in monthly_results]
+
+    # keep the precision of the hindcast so log transforms round the same way as for a single point
+    flows = sim_flow_b.values
+    if flows.dtype.kind != 'f':
+        flows = flows.astype(np.float64)
     if use_log:
-        qb_adjusted = np.power(10, qb_adjusted)
-        qb_original = np.power(10, qb_original)
+        flows = np.log10(flows)
+    valid = ~np.isnan(flows)
+
+    # compute the flow duration curves of every point B together, leaving out the outliers of each point
+    with span('flow_duration_curves', 'fdc'):
+        exceed_prob, fdcs = _flow_duration_curves(flows, valid, drop_outliers, outlier_threshold)
+
+    with span('interpolate', 'interp'):
+        # flow at each B converted to exceedance probabilities, then matched with the scalar computed at point A
+        p_exceed = np.full(flows.shape, np.nan)
+        for i in range(flows.shape[1]):
+            flow_to_percent = _make_interpolator(fdcs[:, i], exceed_prob, extrap=extrapolate, fill_value=fill_value)
+            p_exceed[valid[:, i], i] = flow_to_percent(flows[valid[:, i], i])
+
+        scalar_fdc = curves[0]
+        percent_to_scalar = _make_interpolator(scalar_fdc.index,
+                                               scalar_fdc.values.flatten(),
+                                               extrap=extrapolate,
+                                               fill_value=fill_value)
+        scalars = np.full(flows.shape, np.nan)
+        scalars[valid] = percent_to_scalar(p_exceed[valid])
+        adjusted = flows / scalars
+
+    corrected = []
+    for i, column in enumerate(sim_flow_b.columns):
+        rows = valid[:, i]
+        try:
+            qb_original = flows[rows, i]
+            qb_adjusted = adjusted[rows, i]
+            if fit_gumbel:
+                with span('fit_gumbel', 'fdc'):
+                    qb_adjusted = _fit_extreme_values_to_gumbel(qb_adjusted, p_exceed[rows, i], fit_range)
+
+            if use_log:
+                qb_adjusted = np.power(10, qb_adjusted)
+                qb_original = np.power(10, qb_original)
+
+            response = pd.DataFrame(data=np.transpose([qb_adjusted, qb_original]),
+                                    index=sim_flow_b.index[rows].to_list(),
+                                    columns=(COL_QMOD, COL_QSIM))
+            if metadata:
+                response['scalars'] = scalars[rows, i]
+                response['p_exceed'] = p_exceed[rows, i]
+            corrected.append(response)
+        except Exception as e:
+            logger.error(e)
+            logger.debug(f'Failed to correct {column}')
+            corrected.append(None)
+
+    return corrected
+
+
+def _flow_duration_curves(flows: np.ndarray, valid: np.ndarray, drop_outliers: bool = False,
+                          outlier_threshold: int or float = 2.5) -> tuple:
+    """
+    Computes the flow duration curve of each column of an array of flows in one call
 
-    response = pd.DataFrame(data=np.transpose([qb_adjusted, qb_original]),
-                            index=sim_flow_b.index.to_list(),
-                            columns=(COL_QMOD, COL_QSIM))
-    if metadata:
-        response['scalars'] = scalars
-        response['p_exceed'] = p_exceed
+    Args:
+        flows: array (values, columns) of flows
+        valid: boolean array (values, columns) of the flows to use
+        drop_outliers: flag to exclude the outliers of each column
+        outlier_threshold: number of std deviations from the mean of a column to exclude
 
-    return response
+    Returns:
+        tuple of the exceedance probabilities (101,) and the flow duration curves (101, columns)
+    """
+    in_fdc = valid.copy()
+    if drop_outliers:
+        for i in range(flows.shape[1]):
+            values = flows[valid[:, i], i]
+            zscores = (values - values.mean()) / values.std()
+            in_fdc[valid[:, i], i] = np.abs(zscores) < outlier_threshold
+    exceed_prob = np.linspace(100, 0, 101)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        fdcs = np.nanpercentile(np.where(in_fdc, flows, np.nan), exceed_prob, axis=0)
+    return exceed_prob, fdcs
+
+
+def _select(params: dict, names: tuple) -> dict:
+    """
+    Subset of a dict of sfdc_mapping settings which are accepted by sfdc_curves or sfdc_apply
+    """
+    return {name: value for name, value in params.items() if name in names}
 
 
 def _drop_outliers_by_zscore(df: pd.DataFrame, threshold: float = 3) -> pd.DataFrame:
@@ -290,7 +566,9 @@ def _drop_outliers_by_zscore(df: pd.DataFrame, threshold: float = 3) -> pd.DataF
     Returns:
         pd.DataFrame with outliers removed
     """
-    return df[(np.abs(stats.zscore(df)) < threshold).all(axis=1)]
+    values = df.values
+    zscores = (values - values.mean(axis=0)) / values.std(axis=0)
+    return df[(np.abs(zscores) < threshold).all(axis=1)]
 
 
 def _filter_sfdc(sfdc: pd.DataFrame, filter_range: list) -> pd.DataFrame:
@@ -371,17 +649,52 @@ def _fit_extreme_values_to_gumbel(q_adjust: np.array, p_exceed: np.array, fit_ra
     Returns:
         array of the flows with the extreme values replaced
     """
-    all_values = pd.DataFrame(np.transpose([q_adjust, p_exceed]), columns=('q', 'p'))
+    q_adjust = np.array(q_adjust, dtype=np.float64)
+    p_exceed = np.asarray(p_exceed, dtype=np.float64)
 
     # compute the average and standard deviation for the values within the user specified fit_range
-    mid_vals = all_values[np.logical_and(all_values['p'] >= fit_range[0], all_values['p'] <= fit_range[1])]
-    xbar = statistics.mean(mid_vals['q'].values)
-    std = statistics.stdev(mid_vals['q'].values, xbar)
+    in_range = np.logical_and(p_exceed >= fit_range[0], p_exceed <= fit_range[1])
+    xbar, std = _gumbel_params(q_adjust[in_range])
+
+    # replace the values outside the fit_range with the gumbel values, keeping the original where that is undefined
+    outliers = ~in_range
+    gumbel = _gumbel_flows(p_exceed[outliers], xbar, std)
+    q_adjust[outliers] = np.where(np.isnan(gumbel), q_adjust[outliers], gumbel)
+
+    return q_adjust
+
+
+def _gumbel_params(q_fit: np.array) -> tuple:
+    """
+    Mean and standard deviation of the flows a Gumbel type 1 distribution is fit to
+
+    Args:
+        q_fit: the flows within the fit range of exceedance probabilities
+
+    Returns:
+        tuple of the mean and standard deviation
+
+    Raises:
+        statistics.StatisticsError: if there are fewer than 2 flows
+    """
+    xbar = statistics.mean(q_fit)
+    return xbar, statistics.stdev(q_fit, xbar)
 
-    outlier_vals = all_values.drop(mid_vals.index)
-    outlier_vals['q'] = outlier_vals['q'] = -np.log(
-        -np.log(1 - (1 / (1 / (1 - (outlier_vals['p'] / 100)))))) * std * .7797 + xbar - (.45 * std)
-    outlier_vals[outlier_vals < 0] = 0
-    all_values.update(outlier_vals)
 
-    return all_values['q'].values.flatten()
+def _gumbel_flows(p_exceed: np.array, xbar: float, std: float) -> np.array:
+    """
+    Flows of a Gumbel type 1 distribution at some exceedance probabilities, with negative flows set to 0
+
+    Args:
+        p_exceed: exceedance probabilities (0-100)
+        xbar: mean of the fitted flows
+        std: standard deviation of the fitted flows
+
+    Returns:
+        array of the flows, NaN where the distribution is undefined
+    """
+    p_exceed = np.asarray(p_exceed, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gumbel = -np.log(-np.log(1 - (1 / (1 / (1 - (p_exceed / 100)))))) * std * .7797 + xbar - (.45 * std)
+    gumbel[gumbel < 0] = 0
+    return gumbel
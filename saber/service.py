@@ -0,0 +1,329 @@
+import concurrent.futures
+import json
+import logging
+import math
+import queue
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from .cache import get_cache
+from .io import get_state
+from .io import read_hindcast
+from .lut import CorrectionTables
+from .lut import read_tables
+from .trace import span
+
+__all__ = ['CorrectionService', 'serve', ]
+
+logger = logging.getLogger(__name__)
+
+# the longest a request waits for others to join its batch and the most rivers read from the hindcast in one batch
+MAX_WAIT = 0.005
+MAX_BATCH = 512
+
+
+class CorrectionService:
+    """
+    Answers requests for the corrected discharge of rivers from compiled correction tables. Corrected series are kept
+    in the cache of this process (see cache_size in the config) and requests for cached rivers are answered right away.
+    Requests which need the hindcast are coalesced into batches: the hindcast of every river of the batch is read in
+    one request and corrected with one vectorized lookup, then each request gets its rivers and dates.
+
+    Args:
+        tables: the compiled correction tables. Defaults to the correction_lut in the workdir
+        hindcast_zarr: path to the hindcast streamflow zarr. Defaults to the hindcast_zarr in the config
+        max_wait: seconds a request which needs the hindcast waits for other requests to join its batch
+        max_batch: the most rivers read from the hindcast in one batch
+        preload: read and correct every river in the tables before answering requests, as far as the cache holds them
+    """
+
+    def __init__(self, tables: CorrectionTables = None, hindcast_zarr: str = None, max_wait: float = MAX_WAIT,
+                 max_batch: int = MAX_BATCH, preload: bool = False):
+        self.tables = read_tables() if tables is None else tables
+        self.hindcast_zarr = hindcast_zarr or get_state('hindcast_zarr')
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.requests = 0
+        self.batched = 0
+        self.batches = 0
+        self._times = None
+        self._key = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='saber-service-batcher', daemon=True)
+        self._thread.start()
+        if preload:
+            model_ids = np.asarray(self.tables.model_id).astype(str).tolist()
+            for i in range(0, len(model_ids), max_batch):
+                self._answer([(model_ids[i:i + max_batch], None, None, concurrent.futures.Future()), ])
+            logger.info(f'Preloaded the corrected discharge of {len(model_ids)} rivers: {get_cache().stats()}')
+
+    def correct(self, model_ids: list, start: str = None, end: str = None) -> pd.DataFrame:
+        """
+        Corrected discharge of some rivers over the correction period (start_date to end_date in the config), or the
+        part of it from start to end
+
+        Args:
+            model_ids: the model ids of the rivers
+            start: the first date to return. Defaults to the start of the correction period
+            end: the last date to return (inclusive). Defaults to the end of the correction period
+
+        Returns:
+            pd.DataFrame with a datetime index and a column of corrected discharge per model id
+
+        Raises:
+            ValueError: if a river is not in the tables or the hindcast
+        """
+        return self.submit(model_ids, start, end).result()
+
+    def submit(self, model_ids: list, start: str = None, end: str = None) -> concurrent.futures.Future:
+        """
+        Queues a request for the batcher thread, like correct but returns immediately
+
+        Returns:
+            concurrent.futures.Future of the pd.DataFrame of corrected discharge
+
+        Raises:
+            ValueError: if start or end is not a date
+        """
+        model_ids = [str(mid) for mid in model_ids]
+        start = _timestamp(start, 'start')
+        end = _timestamp(end, 'end')
+        future = concurrent.futures.Future()
+        missing = [mid for mid, pos in zip(model_ids, self.tables.positions(model_ids)) if pos < 0]
+        if not model_ids or missing:
+            future.set_exception(ValueError(f'Model ids not in the correction tables: {missing[:10]}'))
+            return future
+
+        cache = get_cache()
+        columns = {mid: cache.get(('corrected', self._key, mid)) for mid in dict.fromkeys(model_ids)}
+        if self._times is None or any(values is None for values in columns.values()):
+            self._queue.put((model_ids, start, end, future))
+            return future
+        try:
+            future.set_result(self._frame(model_ids, start, end, columns))
+        except Exception as e:
+            future.set_exception(e)
+        with self._lock:
+            self.requests += 1
+        return future
+
+    def correct_flows(self, flows: np.ndarray, times, model_ids: list) -> np.ndarray:
+        """
+        Corrects discharge sent with the request, such as a forecast, without reading the hindcast
+
+        Args:
+            flows: array (..., times, rivers) of simulated discharge
+            times: the datetime of each step of the time axis
+            model_ids: the model id of each river of the last axis
+
+        Returns:
+            np.ndarray of the corrected discharge with the shape of flows
+        """
+        with self._lock:
+            self.requests += 1
+        return self.tables.correct(np.asarray(flows, dtype=np.float32), times, model_ids)
+
+    def stats(self) -> dict:
+        """
+        Number of requests answered, the number of batches read from the hindcast and their average number of requests,
+        and the statistics of the cache
+        """
+        return {
+            'rivers': len(self.tables),
+            'requests': self.requests,
+            'batches': self.batches,
+            'requests_per_batch': round(self.batched / self.batches, 2) if self.batches else None,
+            'cache': get_cache().stats(),
+        }
+
+    def _run(self) -> None:
+        # nothing may end this thread: every request which needs the hindcast would wait on it forever
+        while True:
+            batch = [self._queue.get()]
+            try:
+                self._collect(batch)
+                self._answer(batch)
+            except Exception as e:
+                if len(batch) == 1:
+                    _fail(batch[0][3], e)
+                    continue
+                # a river missing from the hindcast or a bad date only fails the requests which asked for it
+                for request in batch:
+                    if request[3].done():
+                        continue
+                    try:
+                        self._answer([request, ])
+                    except Exception as request_error:
+                        _fail(request[3], request_error)
+
+    def _collect(self, batch: list) -> None:
+        rivers = set(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while len(rivers) < self.max_batch:
+            try:
+                batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+            rivers.update(batch[-1][0])
+        return
+
+    def _answer(self, batch: list) -> None:
+        cache = get_cache()
+        rivers = list(dict.fromkeys(mid for model_ids, *_ in batch for mid in model_ids))
+        columns = {mid: cache.get(('corrected', self._key, mid)) for mid in rivers}
+
+        missing = [mid for mid, values in columns.items() if values is None]
+        if missing:
+            with span('service_batch', 'io', rivers=len(missing), requests=len(batch)):
+                sim_df = read_hindcast(self.hindcast_zarr, missing)
+                corrected = self.tables.correct(sim_df.values, sim_df.index, missing)
+            self._times = sim_df.index
+            for i, mid in enumerate(missing):
+                columns[mid] = np.ascontiguousarray(corrected[:, i])
+                cache.put(('corrected', self._key, mid), columns[mid])
+
+        for model_ids, start, end, future in batch:
+            # requests answered before another request of the batch failed keep their result when it is retried
+            if not future.done():
+                future.set_result(self._frame(model_ids, start, end, columns))
+        with self._lock:
+            self.requests += len(batch)
+            self.batched += len(batch)
+            self.batches += 1
+        return
+
+    def _frame(self, model_ids: list, start: pd.Timestamp, end: pd.Timestamp, columns: dict) -> pd.DataFrame:
+        rows = slice(
+            None if start is None else int(self._times.searchsorted(start, side='left')),
+            None if end is None else int(self._times.searchsorted(end, side='right')),
+        )
+        return pd.DataFrame({mid: columns[mid][rows] for mid in model_ids}, index=self._times[rows])
+
+
+def serve(host: str = '127.0.0.1', port: int = 8080, service: CorrectionService = None, preload: bool = False) -> None:
+    """
+    Serves corrected discharge over HTTP until interrupted. Every request is answered by the same CorrectionService so
+    concurrent requests are batched together. Responses are JSON with null for values which could not be corrected.
+
+    GET /correct?model_id=1,2&start=2000-01-01&end=2000-12-31
+        corrected hindcast of the rivers from start to end: {"time": [...], "flows": {"1": [...], "2": [...]}}
+    POST /correct with a JSON body {"model_id": [...], "time": [...], "flows": [[...], ...]}
+        corrects flows shaped (..., times, rivers) sent with the request, such as a forecast, without the hindcast
+    GET /rivers
+        the model ids in the correction tables
+    GET /stats
+        the number of requests and batches answered and the cache statistics
+
+    Args:
+        host: the address to listen on
+        port: the port to listen on
+        service: the service answering the requests. Defaults to a CorrectionService of the workdir's tables
+        preload: correct every river before serving when the service is created here, see CorrectionService
+
+    Returns:
+        None
+    """
+    service = CorrectionService(preload=preload) if service is None else service
+    server = _Server((host, port), _handler(service))
+    logger.info(f'Serving corrections of {len(service.tables)} rivers at http://{host}:{server.server_port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return
+
+
+class _Server(ThreadingHTTPServer):
+    # a longer queue of pending connections than the default 5 so bursts of clients are not refused and retried
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def _handler(service: CorrectionService) -> type:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            query = urllib.parse.parse_qs(url.query)
+            try:
+                if url.path == '/correct':
+                    model_ids = [mid for value in query.get('model_id', []) for mid in value.split(',') if mid]
+                    if not model_ids:
+                        raise ValueError('Provide the model_id of one or more rivers')
+                    df = service.correct(model_ids, query.get('start', [None])[0], query.get('end', [None])[0])
+                    self._reply(200, {
+                        'time': df.index.strftime('%Y-%m-%d').tolist(),
+                        'flows': {mid: _json_values(df[mid].values) for mid in df.columns},
+                    })
+                elif url.path == '/rivers':
+                    self._reply(200, {'model_id': np.asarray(service.tables.model_id).astype(str).tolist()})
+                elif url.path == '/stats':
+                    self._reply(200, service.stats())
+                else:
+                    self._reply(404, {'error': f'Unknown path: {url.path}'})
+            except ValueError as e:
+                self._reply(400, {'error': str(e)})
+            except Exception as e:
+                logger.exception(f'Failed to answer {self.path}')
+                self._reply(500, {'error': f'{type(e).__name__}: {e}'})
+
+        def do_POST(self):
+            if urllib.parse.urlparse(self.path).path != '/correct':
+                self._reply(404, {'error': f'Unknown path: {self.path}'})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                flows = np.asarray(body['flows'], dtype=np.float32)
+                corrected = service.correct_flows(flows, body['time'], body['model_id'])
+                self._reply(200, {'flows': _json_values(corrected)})
+            except (KeyError, TypeError, ValueError) as e:
+                self._reply(400, {'error': f'{type(e).__name__}: {e}'})
+
+        def _reply(self, status: int, body: dict) -> None:
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            logger.debug(f'{self.address_string()} {format % args}')
+
+    return Handler
+
+
+def _timestamp(value, name: str) -> pd.Timestamp | None:
+    # the hindcast index is naive UTC so aware dates are converted to it rather than failing the batch they join
+    if value is None:
+        return None
+    try:
+        value = pd.Timestamp(value)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f'{name} is not a date: {value!r}') from e
+    if value is pd.NaT:
+        raise ValueError(f'{name} is not a date: {value!r}')
+    return value if value.tzinfo is None else value.tz_convert('UTC').tz_localize(None)
+
+
+def _fail(future: concurrent.futures.Future, error: Exception) -> None:
+    if not future.done():
+        future.set_exception(error)
+    return
+
+
+def _json_values(values: np.ndarray) -> list:
+    # JSON has no NaN or infinity so the values which could not be corrected are null
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim > 1:
+        return [_json_values(v) for v in values]
+    return [v if math.isfinite(v) else None for v in values.tolist()]
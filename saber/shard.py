@@ -0,0 +1,166 @@
+import glob
+import logging
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from .io import COL_MID
+from .io import COL_OUTLET
+from .io import _get_table_path
+from .io import _read_table_path
+from .io import _write_table_path
+from .io import get_state
+from .io import read_table
+from .io import write_table
+from .table import basin_packets
+from .topology import _id_strings
+from .topology import Topology
+from .topology import read_topology
+
+__all__ = ['parse_shard', 'shard_table', 'write_part', 'merge_parts', ]
+
+logger = logging.getLogger(__name__)
+
+
+def parse_shard(shard: str or tuple) -> tuple:
+    """
+    Parses a shard specification like '2/4' (the 2nd of 4 shards) into a tuple of integers
+
+    Args:
+        shard: string 'i/N' or a tuple (i, N) where 1 <= i <= N
+
+    Returns:
+        tuple of (i, N)
+
+    Raises:
+        ValueError: if the shard is not formatted correctly or i is not between 1 and N
+    """
+    if isinstance(shard, str):
+        match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', shard)
+        if match is None:
+            raise ValueError(f'Shard should be formatted as "i/N", given: {shard}')
+        shard = (int(match.group(1)), int(match.group(2)))
+    i, n = int(shard[0]), int(shard[1])
+    if not 1 <= i <= n:
+        raise ValueError(f'Shard number should be between 1 and {n}, given: {i}')
+    return i, n
+
+
+def shard_table(df: pd.DataFrame, shard: str or tuple, by: str = 'outlet', network: pd.DataFrame = None,
+                hindcast_zarr: str = None) -> pd.DataFrame:
+    """
+    Deterministically selects the rows of a table which belong to one shard so that several machines can each process
+    a disjoint part of the table without coordinating. Every machine computes the same partition from the same inputs.
+
+    Args:
+        df: a table with a model_id column, usually the assign table or the bootstrap assign table
+        shard: string 'i/N' or a tuple (i, N) of the shard to select
+        by: how to partition the rows. Options:
+            "outlet": keep whole drainage basins together and balance the number of rows in each shard
+            "chunk": keep the rivers of each chunk of the hindcast zarr together so each shard reads a disjoint slice
+        network: the drainage network used to find the outlet of each reach when df does not have an outlet column.
+            Defaults to the topology written by table.init, or the drain_table if it has not been written
+        hindcast_zarr: path to the hindcast zarr used when by="chunk"
+
+    Returns:
+        pd.DataFrame of the rows in the shard
+    """
+    i, n = parse_shard(shard)
+    if by == 'outlet':
+        shard_ids = _shard_by_outlet(df, n, network)
+    elif by == 'chunk':
+        shard_ids = _shard_by_chunk(df, n, hindcast_zarr)
+    else:
+        raise ValueError(f'Unknown shard partition: "{by}". Options: outlet, chunk')
+    logger.info(f'Shard {i}/{n}: {np.sum(shard_ids == i - 1)} of {len(df)} rows')
+    return df[shard_ids == i - 1]
+
+
+def _shard_by_outlet(df: pd.DataFrame, n: int, network: pd.DataFrame = None) -> np.ndarray:
+    if COL_OUTLET in df.columns:
+        return basin_packets(df, n)
+    if network is not None:
+        topology = Topology.from_table(network)
+    else:
+        try:
+            topology = read_topology()
+        except FileNotFoundError:
+            topology = Topology.from_table(read_table('drain_table'))
+    network_outlets = pd.Series(topology.outlet_ids(), index=np.asarray(topology.model_id).astype(str))
+    mids = pd.Series(_id_strings(df[COL_MID]), index=df.index)
+    return basin_packets(pd.DataFrame({COL_OUTLET: mids.map(network_outlets).fillna(mids)}), n)
+
+
+def _shard_by_chunk(df: pd.DataFrame, n: int, hindcast_zarr: str = None) -> np.ndarray:
+    if hindcast_zarr is None:
+        hindcast_zarr = get_state('hindcast_zarr')
+    with xr.open_mfdataset(hindcast_zarr, concat_dim='rivid', combine='nested', engine='zarr') as hz:
+        rivids = hz['rivid'].values
+        chunk_sizes = hz['Qout'].chunksizes['rivid'] if hz['Qout'].chunks else (len(rivids),)
+
+    # contiguous runs of chunks go to each shard so each machine reads a disjoint slice of the zarr
+    boundaries = np.cumsum((0,) + tuple(chunk_sizes))
+    positions = pd.Index(rivids.astype(np.int64)).get_indexer(pd.to_numeric(df[COL_MID]).astype(np.int64))
+    chunk = np.searchsorted(boundaries, np.maximum(positions, 0), side='right') - 1
+    return chunk * n // len(chunk_sizes)
+
+
+def write_part(df: pd.DataFrame, name: str, shard: str or tuple) -> None:
+    """
+    Write the part of a generated table computed by one shard next to where the complete table is written
+
+    Args:
+        df: the pandas DataFrame to write
+        name: the name of the table to write
+        shard: string 'i/N' or a tuple (i, N) of the shard which computed the part
+
+    Returns:
+        None
+    """
+    _write_table_path(df, _get_part_path(name, shard))
+    return
+
+
+def merge_parts(name: str, remove: bool = True) -> pd.DataFrame:
+    """
+    Combines the parts of a table written by each shard into the complete table
+
+    Args:
+        name: the name of the table to merge
+        remove: delete the part files after writing the merged table
+
+    Returns:
+        pd.DataFrame of the merged table
+
+    Raises:
+        FileNotFoundError: if there are no parts or any shard's part is missing
+    """
+    root, ext = os.path.splitext(_get_table_path(name))
+    parts = glob.glob(f'{root}.part-*-of-*{ext}')
+    if not parts:
+        raise FileNotFoundError(f'No parts found for table: {name}')
+
+    counts = {int(re.search(r'\.part-\d+-of-(\d+)', p).group(1)) for p in parts}
+    if len(counts) != 1:
+        raise ValueError(f'Parts of table {name} were written with different shard counts: {sorted(counts)}')
+    n = counts.pop()
+    expected = [_get_part_path(name, (i, n)) for i in range(1, n + 1)]
+    missing = [p for p in expected if not os.path.exists(p)]
+    if missing:
+        raise FileNotFoundError(f'Missing {len(missing)} of {n} parts of table {name}: {missing}')
+
+    df = pd.concat([_read_table_path(p) for p in expected], ignore_index=True)
+    write_table(df, name)
+    if remove:
+        for p in expected:
+            os.remove(p)
+    return df
+
+
+def _get_part_path(name: str, shard: str or tuple) -> str:
+    i, n = parse_shard(shard)
+    root, ext = os.path.splitext(_get_table_path(name))
+    return f'{root}.part-{i}-of-{n}{ext}'
@@ -0,0 +1,325 @@
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import yaml
+
+from .io import COL_CID
+from .io import COL_GID
+from .io import COL_MID
+from .io import COL_MID_DOWN
+from .io import COL_RID
+from .io import COL_STRM_ORD
+from .io import COL_X
+from .io import COL_Y
+from .io import DIR_LIST
+from .io import DIR_TABLES
+from .io import TABLE_CLUSTER_LABELS
+
+__all__ = ['make_project', 'drain_table', 'gauge_table', 'regulate_table', 'cluster_data', 'hindcast', 'gauge_data', ]
+
+logger = logging.getLogger(__name__)
+
+
+def make_project(path: str, n_reaches: int = 1_000, basin_size: int = 500, n_clusters: int = 5,
+                 gauge_fraction: float = 0.02, regulate_fraction: float = 0.005,
+                 start_date: str = '1980-01-01', n_years: int = 10, write_hindcast: bool = True,
+                 rivid_chunk: int = 1_000, seed: int = 0) -> str:
+    """
+    Creates a complete synthetic SABER project which can be used for benchmarking and testing the workflow without the
+    real datasets. The project directory contains the input tables, a cluster_table in the workdir, a chunked hindcast
+    zarr, a directory of gauge csv files and a config.yml pointing to all of them.
+
+    Args:
+        path: directory to create the project in. Used as the workdir
+        n_reaches: total number of river reaches in the drainage network
+        basin_size: average number of reaches in each independent drainage basin
+        n_clusters: number of FDC clusters to generate cluster_data and labels for
+        gauge_fraction: fraction of reaches which contain a gauge
+        regulate_fraction: fraction of reaches which contain a regulatory structure
+        start_date: first date of the hindcast and observed records
+        n_years: number of years of daily discharge to generate
+        write_hindcast: flag to write the hindcast zarr and gauge data. Disable for large networks used only to time
+            the table and clustering stages
+        rivid_chunk: number of rivers in each chunk of the hindcast zarr
+        seed: seed for the random number generator so projects are reproducible
+
+    Returns:
+        path to the config file of the project
+    """
+    rng = np.random.default_rng(seed)
+    path = os.path.abspath(path)
+    for d in DIR_LIST:
+        os.makedirs(os.path.join(path, d), exist_ok=True)
+    inputs_dir = os.path.join(path, 'inputs')
+    os.makedirs(inputs_dir, exist_ok=True)
+
+    logger.info(f'Generating synthetic drainage network with {n_reaches} reaches')
+    drain_df = drain_table(n_reaches, basin_size=basin_size, rng=rng)
+    gauge_df = gauge_table(drain_df, fraction=gauge_fraction, rng=rng)
+    reg_df = regulate_table(drain_df, fraction=regulate_fraction, rng=rng)
+    fdc_df, labels = cluster_data(drain_df, n_clusters=n_clusters, rng=rng)
+
+    config = {
+        'workdir': path,
+        'cluster_data': os.path.join(inputs_dir, 'cluster_data.parquet'),
+        'drain_table': os.path.join(inputs_dir, 'drain_table.parquet'),
+        'gauge_table': os.path.join(inputs_dir, 'gauge_table.csv'),
+        'regulate_table': os.path.join(inputs_dir, 'regulate_table.csv'),
+        'drain_gis': '',
+        'gauge_gis': '',
+        'gauge_data': os.path.join(inputs_dir, 'gauge_data'),
+        'hindcast_zarr': os.path.join(inputs_dir, 'hindcast.zarr'),
+        'n_processes': 1,
+    }
+
+    drain_df.to_parquet(config['drain_table'])
+    gauge_df.to_csv(config['gauge_table'], index=False)
+    reg_df.to_csv(config['regulate_table'], index=False)
+    fdc_df.to_parquet(config['cluster_data'])
+    pd.DataFrame({COL_CID: labels, COL_MID: drain_df[COL_MID].values}) \
+        .to_parquet(os.path.join(path, DIR_TABLES, TABLE_CLUSTER_LABELS))
+
+    if write_hindcast:
+        logger.info('Generating synthetic hindcast and observed discharge')
+        hindcast(drain_df, config['hindcast_zarr'], start_date=start_date, n_years=n_years,
+                 rivid_chunk=rivid_chunk, rng=rng)
+        gauge_data(gauge_df, config['hindcast_zarr'], config['gauge_data'], rng=rng)
+
+    config_path = os.path.join(path, 'config.yml')
+    with open(config_path, 'w') as f:
+        yaml.safe_dump(config, f, sort_keys=False)
+    return config_path
+
+
+def drain_table(n_reaches: int, basin_size: int = 500, rng: np.random.Generator = None) -> pd.DataFrame:
+    """
+    Generates a dendritic drainage network made of binary trees, one per basin, with strahler orders, downstream ids,
+    and centroid coordinates
+
+    Args:
+        n_reaches: total number of reaches in the network
+        basin_size: average number of reaches in each basin
+        rng: numpy random generator
+
+    Returns:
+        pd.DataFrame with the columns required in the drain_table plus an 'upstream_count' column of the number of
+        reaches upstream of (and including) each reach which is a proxy for drainage area
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    n_basins = max(1, int(round(n_reaches / basin_size)))
+    sizes = rng.multinomial(n_reaches - n_basins, np.full(n_basins, 1 / n_basins)) + 1
+
+    parent = np.full(n_reaches, -1, dtype=np.int64)
+    x = np.zeros(n_reaches)
+    y = np.zeros(n_reaches)
+    outlets_xy = rng.uniform(0, 100_000 * np.sqrt(n_basins), size=(n_basins, 2))
+    angles = rng.uniform(0, 2 * np.pi, size=n_reaches)
+    lengths = rng.uniform(500, 2_000, size=n_reaches)
+
+    # grow each basin from its outlet by splitting a random headwater reach into two tributaries
+    start = 0
+    for basin, size in enumerate(sizes):
+        x[start], y[start] = outlets_xy[basin]
+        tips = [start]
+        n_made = 1
+        picks = rng.random(size)
+        while n_made < size:
+            tip_pos = int(picks[n_made] * len(tips))
+            tip = tips[tip_pos]
+            tips[tip_pos] = tips[-1]
+            tips.pop()
+            for child in range(start + n_made, start + min(n_made + 2, size)):
+                parent[child] = tip
+                x[child] = x[tip] + lengths[child] * np.cos(angles[child])
+                y[child] = y[tip] + lengths[child] * np.sin(angles[child])
+                tips.append(child)
+            n_made = min(n_made + 2, size)
+        start += size
+
+    # children always come after their parent so a reverse pass visits the network from headwaters to outlets
+    order = np.ones(n_reaches, dtype=np.int64)
+    max_up_order = np.zeros(n_reaches, dtype=np.int64)
+    n_max_order = np.zeros(n_reaches, dtype=np.int64)
+    upstream_count = np.ones(n_reaches, dtype=np.int64)
+    for i in range(n_reaches - 1, -1, -1):
+        if max_up_order[i]:
+            order[i] = max_up_order[i] + (n_max_order[i] >= 2)
+        p = parent[i]
+        if p < 0:
+            continue
+        upstream_count[p] += upstream_count[i]
+        if order[i] > max_up_order[p]:
+            max_up_order[p] = order[i]
+            n_max_order[p] = 1
+        elif order[i] == max_up_order[p]:
+            n_max_order[p] += 1
+
+    # shuffle the ids so that id order does not follow the network topology
+    ids = rng.permutation(n_reaches) + 1
+    down_ids = np.where(parent >= 0, ids[parent], -1)
+    return pd.DataFrame({
+        COL_MID: ids,
+        COL_MID_DOWN: down_ids,
+        COL_STRM_ORD: order,
+        COL_X: x.round(2),
+        COL_Y: y.round(2),
+        'upstream_count': upstream_count,
+    })
+
+
+def gauge_table(drain_df: pd.DataFrame, fraction: float = 0.02, rng: np.random.Generator = None) -> pd.DataFrame:
+    """
+    Places gauges on the drainage network preferring larger rivers
+
+    Args:
+        drain_df: the synthetic drain table
+        fraction: fraction of reaches to place a gauge on
+        rng: numpy random generator
+
+    Returns:
+        pd.DataFrame with the columns required in the gauge_table
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    n_gauges = max(2, int(len(drain_df) * fraction))
+    weights = drain_df[COL_STRM_ORD].values.astype(float) ** 2
+    rows = rng.choice(len(drain_df), size=min(n_gauges, len(drain_df)), replace=False, p=weights / weights.sum())
+    return pd.DataFrame({
+        COL_MID: drain_df[COL_MID].values[rows],
+        COL_GID: [f'g{i}' for i in range(len(rows))],
+        'latitude': drain_df[COL_Y].values[rows],
+        'longitude': drain_df[COL_X].values[rows],
+    })
+
+
+def regulate_table(drain_df: pd.DataFrame, fraction: float = 0.005, rng: np.random.Generator = None) -> pd.DataFrame:
+    """
+    Places regulatory structures on the drainage network, excluding first order streams
+
+    Args:
+        drain_df: the synthetic drain table
+        fraction: fraction of reaches to place a regulatory structure on
+        rng: numpy random generator
+
+    Returns:
+        pd.DataFrame with the columns required in the regulate_table
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    candidates = np.flatnonzero(drain_df[COL_STRM_ORD].values > 1)
+    if not len(candidates):
+        candidates = np.arange(len(drain_df))
+    n_structures = min(max(1, int(len(drain_df) * fraction)), len(candidates))
+    rows = rng.choice(candidates, size=n_structures, replace=False)
+    return pd.DataFrame({
+        COL_MID: drain_df[COL_MID].values[rows],
+        COL_RID: [f'r{i}' for i in range(len(rows))],
+    })
+
+
+def cluster_data(drain_df: pd.DataFrame, n_clusters: int = 5, n_features: int = 41,
+                 rng: np.random.Generator = None) -> tuple[pd.DataFrame, np.ndarray]:
+    """
+    Generates z-scored flow duration curves for each reach drawn around a set of cluster prototype curves
+
+    Args:
+        drain_df: the synthetic drain table
+        n_clusters: number of prototype FDC shapes
+        n_features: number of exceedance probabilities in each FDC
+        rng: numpy random generator
+
+    Returns:
+        tuple of (cluster_data dataframe indexed by model_id, array of the cluster label of each reach)
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    p = np.linspace(0, 1, n_features)
+    slopes = np.linspace(1.5, 6, n_clusters)
+    prototypes = np.exp(-np.outer(slopes, p))
+
+    # group neighboring reaches into the same cluster so labels are spatially coherent
+    x_rank = drain_df[COL_X].rank(method='first').values - 1
+    labels = (x_rank * n_clusters // len(drain_df)).astype(np.int64)
+    curves = prototypes[labels] * rng.lognormal(0, 0.1, size=(len(drain_df), n_features))
+    curves = np.sort(curves, axis=1)[:, ::-1]
+    curves = (curves - curves.mean(axis=1, keepdims=True)) / curves.std(axis=1, keepdims=True)
+
+    fdc_df = pd.DataFrame(
+        curves.astype(np.float32),
+        index=pd.Index(drain_df[COL_MID].values, name=COL_MID),
+        columns=[f'Q{q:g}' for q in np.linspace(100, 0, n_features)],
+    )
+    return fdc_df, labels
+
+
+def hindcast(drain_df: pd.DataFrame, zarr_path: str, start_date: str = '1980-01-01', n_years: int = 10,
+             rivid_chunk: int = 1_000, rng: np.random.Generator = None) -> None:
+    """
+    Writes a daily simulated discharge zarr with a Qout(time, rivid) variable, chunked along the rivid dimension
+
+    Args:
+        drain_df: the synthetic drain table
+        zarr_path: path to write the zarr store to
+        start_date: first date of the hindcast
+        n_years: number of years of daily values
+        rivid_chunk: number of rivers in each chunk of the zarr
+        rng: numpy random generator
+
+    Returns:
+        None
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    times = pd.date_range(start_date, periods=int(365.25 * n_years), freq='D')
+    season = 2 * np.pi * times.dayofyear.values / 365.25
+    rivids = drain_df[COL_MID].values
+    area = drain_df['upstream_count'].values if 'upstream_count' in drain_df else np.ones(len(rivids))
+
+    for block in range(0, len(rivids), rivid_chunk):
+        block_ids = rivids[block:block + rivid_chunk]
+        phase = rng.uniform(0, 2 * np.pi, size=len(block_ids))
+        flows = (
+            area[block:block + rivid_chunk] * 2.5
+            * (1 + 0.8 * np.sin(season[:, None] + phase[None, :]))
+            * rng.lognormal(0, 0.35, size=(len(times), len(block_ids)))
+        )
+        ds = xr.Dataset(
+            {'Qout': (('time', 'rivid'), flows.astype(np.float32))},
+            coords={'time': times, 'rivid': block_ids},
+        )
+        if block == 0:
+            ds.to_zarr(zarr_path, mode='w', encoding={'Qout': {'chunks': (len(times), rivid_chunk)}})
+        else:
+            ds.to_zarr(zarr_path, append_dim='rivid')
+    return
+
+
+def gauge_data(gauge_df: pd.DataFrame, zarr_path: str, save_dir: str, missing_fraction: float = 0.1,
+               rng: np.random.Generator = None) -> None:
+    """
+    Writes an observed discharge csv for each gauge by applying a random seasonal bias and noise to the hindcast at the
+    gauged reach and removing a random fraction of the days
+
+    Args:
+        gauge_df: the synthetic gauge table
+        zarr_path: path to the hindcast zarr to derive observations from
+        save_dir: directory to write the gauge csv files to
+        missing_fraction: fraction of days to remove from each record
+        rng: numpy random generator
+
+    Returns:
+        None
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    os.makedirs(save_dir, exist_ok=True)
+    with xr.open_zarr(zarr_path) as ds:
+        times = pd.to_datetime(ds['time'].values)
+        positions = pd.Index(ds['rivid'].values).get_indexer(gauge_df[COL_MID].values)
+        sim = ds['Qout'].isel(rivid=positions).values
+
+    month_bias = rng.uniform(0.4, 1.6, size=(12, len(gauge_df)))
+    for i, gid in enumerate(gauge_df[COL_GID].values):
+        obs = sim[:, i] * month_bias[times.month.values - 1, i] * rng.lognormal(0, 0.15, size=len(times))
+        keep = rng.random(len(times)) >= missing_fraction
+        pd.DataFrame({'flow': obs[keep]}, index=pd.Index(times[keep], name='datetime')) \
+            .to_csv(os.path.join(save_dir, f'{gid}.csv'))
+    return
@@ -1,28 +1,45 @@
 import logging
-from multiprocessing import Pool
+import os
 
 import numpy as np
 import pandas as pd
 
+from .executor import get_executor
 from .io import COL_ASN_GID
 from .io import COL_ASN_MID
 from .io import COL_GID
 from .io import COL_GPROP
+from .io import COL_GPROP_DIR
+from .io import COL_GPROP_STEPS
 from .io import COL_MID
 from .io import COL_MID_DOWN
+from .io import COL_OUTLET
 from .io import COL_RID
 from .io import COL_RPROP
-from .io import COL_STRM_ORD
+from .io import COL_RPROP_DIR
+from .io import COL_RPROP_STEPS
+from .io import PROP_DOWN
+from .io import PROP_UP
 from .io import all_cols
 from .io import atable_cols
 from .io import atable_cols_defaults
 from .io import read_table
 from .io import write_table
+from .topology import Topology
+from .topology import _id_strings
+from .topology import write_topology
 
-__all__ = ['init', 'mp_prop_gauges', 'mp_prop_regulated']
+__all__ = ['init', 'mp_prop_gauges', 'mp_prop_regulated', 'label_outlets', 'basin_packets', ]
 
 logger = logging.getLogger(__name__)
 
+# the direction and step count columns recorded with each propagation column
+_PROP_COLS = {
+    COL_GPROP: (COL_GPROP_DIR, COL_GPROP_STEPS),
+    COL_RPROP: (COL_RPROP_DIR, COL_RPROP_STEPS),
+}
+_PROP_DIRECTIONS = {'down': PROP_DOWN, 'up': PROP_UP}
+
 
 def init(drain_table: pd.DataFrame = None,
          gauge_table: pd.DataFrame = None,
@@ -30,14 +47,14 @@ def init(drain_table: pd.DataFrame = None,
          cluster_table: pd.DataFrame = None,
          cache: bool = True) -> pd.DataFrame:
     """
-    Joins the drain_table.csv and gauge_table.csv to create the assign_table.csv
+    Joins the drain_table.csv and gauge_table.csv to create the assign_table.csv and writes the topology of the network
 
     Args:
         drain_table: the drain table dataframe
         gauge_table: the gauge table dataframe
         reg_table: the regulatory structure table dataframe
         cluster_table: a dataframe with a column for the assigned cluster label and a column for the model_id
-        cache: whether to cache the assign table immediately
+        cache: whether to cache the assign table and the topology immediately
 
     Returns:
         pd.DataFrame
@@ -96,153 +113,245 @@ def init(drain_table: pd.DataFrame = None,
     # check for and remove duplicate rows
     assign_df = assign_df.drop_duplicates(subset=[COL_MID])
 
+    # label the basin outlet of each reach so that later steps can work on independent basins
+    topology = Topology.from_table(assign_df)
+    assign_df[COL_OUTLET] = topology.outlet_ids()
+
     if cache:
         write_table(assign_df, 'assign_table')
+        write_topology(topology)
 
     return assign_df
 
 
-def mp_prop_gauges(df: pd.DataFrame, n_processes: int or None = None) -> pd.DataFrame:
+def mp_prop_gauges(df: pd.DataFrame, n_processes: int or None = None, topology: Topology = None) -> pd.DataFrame:
     """
     Traverses dendritic stream networks to identify upstream and downstream river reaches
 
     Args:
         df: the assign table dataframe
         n_processes: the number of processes to use for multiprocessing
+        topology: the topology of the network, such as the one written by init. Defaults to building the topology of
+            each packet of basins from its rows
 
     Returns:
         pd.DataFrame
     """
     logger.info('Propagating from Gauges')
-    gauged_mids = df[df[COL_GID].notna()][COL_MID].values
-
-    with Pool(n_processes) as p:
-        logger.info('Finding Downstream')
-        df_prop_down = pd.concat(p.starmap(_map_propagate, [(df, x, 'down', COL_GPROP) for x in gauged_mids]))
-        logger.info('Finding Upstream')
-        df_prop_up = pd.concat(p.starmap(_map_propagate, [(df, x, 'up', COL_GPROP) for x in gauged_mids]))
-        logger.info('Resolving Nearest Propagation Neighbor')
-        df_prop = pd.concat([df_prop_down, df_prop_up]).reset_index(drop=True)
-        df_prop = pd.concat(p.starmap(_map_resolve_props, [(df_prop, x, COL_GPROP) for x in df_prop[COL_MID].unique()]))
+    packets = _split_packets(df, n_processes)
+    with get_executor(n_processes) as p:
+        logger.info(f'Propagating within {len(packets)} packets of basins')
+        df_prop = p.starmap(_map_prop_gauges_packet, [(packet, topology) for packet in packets])
+    return _merge_props(df, df_prop)
 
-    return pd.concat([df[~df[COL_MID].isin(df_prop[COL_MID])], df_prop])
 
-
-def mp_prop_regulated(df: pd.DataFrame, n_processes: int or None = None) -> pd.DataFrame:
+def mp_prop_regulated(df: pd.DataFrame, n_processes: int or None = None, topology: Topology = None) -> pd.DataFrame:
     """
     Traverses dendritic stream networks downstream from regulatory structures
 
     Args:
         df: the assign table dataframe
         n_processes: the number of processes to use for multiprocessing
+        topology: the topology of the network, such as the one written by init. Defaults to building the topology of
+            each packet of basins from its rows
 
     Returns:
         pd.DataFrame
     """
     logger.info('Propagating from Regulatory Structures')
-    with Pool(n_processes) as p:
-        logger.info('Propagating Downstream')
-        df_prop = pd.concat(p.starmap(
-            _map_propagate,
-            [(df, x, 'down', COL_RPROP, False) for x in df[df[COL_RID].notna()][COL_MID].values]
-        ))
-        logger.info('Resolving Propagation')
-        df_prop = pd.concat(p.starmap(_map_resolve_props, [(df_prop, x, COL_RPROP) for x in df_prop[COL_MID].unique()]))
+    packets = _split_packets(df, n_processes)
+    with get_executor(n_processes) as p:
+        logger.info(f'Propagating within {len(packets)} packets of basins')
+        df_prop = p.starmap(_map_prop_regulated_packet, [(packet, topology) for packet in packets])
+    return _merge_props(df, df_prop)
+
+
+def label_outlets(df: pd.DataFrame) -> pd.Series:
+    """
+    Finds the terminal outlet of the basin each reach drains to by following the downstream model ids
+
+    Args:
+        df: a table of the drainage network with the model_id and downstream_model_id columns
 
-    return pd.concat([df[~df[COL_MID].isin(df_prop[COL_MID])], df_prop])
+    Returns:
+        pd.Series of the outlet model_id of each row with the same index as df
+    """
+    return pd.Series(Topology.from_table(df).outlet_ids(), index=df.index, name=COL_OUTLET)
 
 
-def _map_propagate(df: pd.DataFrame, start_mid: str, direction: str, prop_col: str,
-                   same_order: bool = True, max_steps: int = 15) -> pd.DataFrame or None:
+def basin_packets(df: pd.DataFrame, n_packets: int) -> np.ndarray:
     """
-    Meant to be mapped over a dataframe to propagate assignments downstream or upstream
+    Groups whole drainage basins into work packets with a balanced number of reaches. Propagation never crosses a basin
+    outlet so each packet can be processed independently of the others.
 
     Args:
-        df: the assignments table dataframe
-        start_mid: the model_id to start the propagation from
-        direction: either 'down' or 'up' to indicate the direction of propagation
-        prop_col: the column where the propagation information should be recorded
-        max_steps: the maximum number of steps to propagate
+        df: a table with the outlet_model_id column, or the model_id and downstream_model_id columns to compute it from
+        n_packets: the number of packets to create
 
     Returns:
-        pd.DataFrame
+        np.ndarray of the packet number (0 to n_packets - 1) of each row of df
     """
-    assigned_rows = []
+    outlets = df[COL_OUTLET] if COL_OUTLET in df.columns else label_outlets(df)
+    outlets = pd.Series(_id_strings(outlets), index=df.index)
+
+    # largest basins first (ties by outlet id) each go to the packet with the fewest reaches so far
+    sizes = outlets.value_counts()
+    sizes = sizes.iloc[np.lexsort((sizes.index.values.astype(str), -sizes.values))]
+    loads = np.zeros(max(int(n_packets), 1), dtype=np.int64)
+    basin_packet = {}
+    for outlet, size in sizes.items():
+        target = int(np.argmin(loads))
+        basin_packet[outlet] = target
+        loads[target] += size
+    return outlets.map(basin_packet).values
+
+
+def _split_packets(df: pd.DataFrame, n_processes: int or None = None, packets_per_process: int = 4) -> list:
+    """
+    Splits a table into packets of whole drainage basins to be processed in parallel. Several packets are made per
+    process so that workers which finish early can pick up more work.
 
-    # select the row to start the propagation from
-    start_row = df[df[COL_MID] == start_mid]
-    start_order = start_row[COL_STRM_ORD].values[0]
-    start_gid = start_row[COL_ASN_GID].values[0]
+    Args:
+        df: a table with the outlet_model_id column, or the model_id and downstream_model_id columns to compute it from
+        n_processes: the number of processes which will work on the packets. Defaults to the number of cpus
+        packets_per_process: the number of packets to create for each process
 
-    # create a boolean selector array for filtering all future queries
-    if same_order:
-        select_same_order_streams = True
-    else:
-        select_same_order_streams = df[COL_STRM_ORD] == start_order
+    Returns:
+        list of pd.DataFrame, the rows of each non-empty packet
+    """
+    if df.empty:
+        return []
+    packet_ids = basin_packets(df, (n_processes or os.cpu_count() or 1) * packets_per_process)
+    return [df[packet_ids == i] for i in np.unique(packet_ids)]
 
-    # # modify the start row to include the propagation information
-    # start_row[[COL_ASN_MID, COL_ASN_GID, prop_col]] = [start_mid, start_gid, f'{direction}-{0}-{start_mid}']
-    # assigned_rows.append(start_row)
 
-    # counter for the number of steps taken by the loop
-    n_steps = 1
+def _map_prop_gauges_packet(df: pd.DataFrame, topology: Topology = None) -> pd.DataFrame:
+    """
+    Propagates gauge assignments up and downstream within a packet of basins and resolves the nearest gauge of each row
+    """
+    starts = np.flatnonzero(df[COL_GID].notna().values)
+    return _propagate_packet(df, topology, starts, ('down', 'up'), COL_GPROP)
 
-    # repeat as long as the current row is not empty
-    try:
-        while True:
-            # select the next up or downstream
-            if direction == 'down':
-                id_selector = df[COL_MID] == start_row[COL_MID_DOWN].values[0]
-            else:  # direction == 'up':
-                id_selector = df[COL_MID_DOWN] == start_row[COL_MID].values[0]
 
-            # select the next row using the ID and Order selectors
-            start_row = df[np.logical_and(id_selector, select_same_order_streams)]
+def _map_prop_regulated_packet(df: pd.DataFrame, topology: Topology = None) -> pd.DataFrame:
+    """
+    Propagates regulatory structures downstream within a packet of basins and resolves the nearest structure of each row
+    """
+    starts = np.flatnonzero(df[COL_RID].notna().values)
+    return _propagate_packet(df, topology, starts, ('down', ), COL_RPROP, same_order=False)
 
-            # Break the loop if
-            # 1. next row is empty -> no upstream reach
-            # 2. next row stream order not a match -> not picked by select_same_order_streams -> empty start_row
-            if start_row.empty:
-                break
 
-            # copy the row, modify the assignment columns, and append to the list
-            new_row = start_row.copy()
-            new_row[[COL_ASN_MID, COL_ASN_GID, prop_col]] = [start_mid, start_gid, f'{direction}-{n_steps}-{start_mid}']
-            assigned_rows.append(new_row)
+def _merge_props(df: pd.DataFrame, df_prop: list) -> pd.DataFrame:
+    df_prop = [x for x in df_prop if not x.empty]
+    if not df_prop:
+        return df
+    df_prop = pd.concat(df_prop)
+    return pd.concat([df[~df[COL_MID].isin(df_prop[COL_MID])], df_prop]).reset_index(drop=True)
 
-            # increment the steps counter
-            n_steps = n_steps + 1
 
-            # Break the loop if
-            # 1. The next row is an outlet -> no downstream row -> cause error when selecting next row
-            # 2. we have reach the max number of steps (n_steps -1)
-            if int(start_row[COL_MID_DOWN].values[0]) == -1 or n_steps > max_steps:
-                break
-    except Exception as e:
-        logger.error(f'Error in map_propagate: {e}')
+def _propagate_packet(df: pd.DataFrame, topology: Topology or None, starts: np.ndarray, directions: tuple,
+                      prop_col: str, same_order: bool = True) -> pd.DataFrame:
+    """
+    Propagates from each start row of a packet in each direction and resolves the nearest source of each row
 
-    if len(assigned_rows):
-        return pd.concat(assigned_rows)
-    return pd.DataFrame(columns=df.columns)
+    Args:
+        df: the rows of the assignments table in a packet of basins
+        topology: the topology of the network or None to build the topology of the packet from its rows
+        starts: the row numbers in df of the streams to propagate from
+        directions: the directions to propagate in, 'down' and/or 'up'
+        prop_col: the column where the source model_id should be recorded
+        same_order: see _map_propagate
 
+    Returns:
+        pd.DataFrame of the propagated rows
+    """
+    positions = None
+    if topology is not None:
+        positions = topology.positions(df[COL_MID])
+        if np.any(positions < 0):
+            logger.warning('Streams missing from the topology, building the topology of the packet from its rows')
+            positions = None
+    if positions is None:
+        topology = Topology.from_table(df)
+        positions = np.arange(len(df))
+
+    rows, sources, codes, steps = [], [], [], []
+    for direction in directions:
+        for start in starts:
+            reached, n_steps = _map_propagate(topology, positions[start], direction, same_order)
+            rows.append(reached)
+            sources.append(np.full(len(reached), start))
+            codes.append(np.full(len(reached), _PROP_DIRECTIONS[direction]))
+            steps.append(n_steps)
+    if not rows:
+        return df.head(0)
+
+    # convert the positions in the topology back to rows of the packet
+    rows = pd.Index(positions).get_indexer(np.concatenate(rows))
+    keep = rows >= 0
+    rows, sources = rows[keep], np.concatenate(sources)[keep]
+    if not len(rows):
+        return df.head(0)
+
+    dir_col, steps_col = _PROP_COLS[prop_col]
+    df_prop = df.iloc[rows].copy()
+    df_prop[COL_ASN_MID] = df[COL_MID].values[sources]
+    df_prop[COL_ASN_GID] = df[COL_ASN_GID].values[sources]
+    df_prop[prop_col] = df[COL_MID].values[sources]
+    df_prop[dir_col] = np.concatenate(codes)[keep]
+    df_prop[steps_col] = np.concatenate(steps)[keep]
+    return _resolve_props(df_prop, prop_col)
+
+
+def _map_propagate(topology: Topology, start: int, direction: str, same_order: bool = True,
+                   max_steps: int = 15) -> tuple:
+    """
+    Follows the topology downstream or upstream from a stream
 
-def _map_resolve_props(df_props: pd.DataFrame, mid: str, prop_col: str) -> pd.DataFrame:
+    Args:
+        topology: the topology of the network
+        start: the position in the topology of the stream to start the propagation from
+        direction: either 'down' or 'up' to indicate the direction of propagation
+        same_order: when False, only propagate through streams of the same strahler order as the start stream
+        max_steps: the maximum number of steps to propagate
+
+    Returns:
+        tuple of np.ndarray of the positions of the streams reached and the number of steps to each
+    """
+    start_order = topology.strahler[start]
+    reached, n_steps = [], []
+    current = start
+    for step in range(1, max_steps + 1):
+        if direction == 'down':
+            candidates = np.array([topology.downstream[current]])
+            candidates = candidates[candidates >= 0]
+        else:  # direction == 'up': every stream draining into the current stream, continuing from the first
+            candidates = np.asarray(topology.upstream_of(current))
+        if not same_order:
+            candidates = candidates[topology.strahler[candidates] == start_order]
+        if not len(candidates):
+            break
+        reached.extend(candidates.tolist())
+        n_steps.extend([step, ] * len(candidates))
+        current = candidates[0]
+    return np.asarray(reached, dtype=np.int64), np.asarray(n_steps, dtype=np.int64)
+
+
+def _resolve_props(df_props: pd.DataFrame, prop_col: str) -> pd.DataFrame:
     """
-    Resolves the propagation assignments by choosing the assignment with the fewest steps
+    Resolves the propagation assignments by choosing the assignment with the fewest steps for each model_id
 
     Args:
         df_props: the combined upstream and downstream propagation assignments dataframe
-        mid: the model_id to resolve the propagation assignments for
-        prop_col: the column where the propagation information is recorded
+        prop_col: the column where the propagation source is recorded
 
     Returns:
-        pd.DataFrame
+        pd.DataFrame with one row per model_id
     """
-    df = df_props[df_props[COL_MID] == mid].copy()
-    # parse the reason statement into number of steps and prop up or downstream
-    df[['direction', 'n_steps']] = df[prop_col].apply(lambda x: x.split('-')[:2]).to_list()
-    df['n_steps'] = df['n_steps'].astype(int)
-    # sort by n_steps then by reason
-    df = df.sort_values(['n_steps', 'direction'], ascending=[True, True])
-    # return the first row which is the fewest steps and preferring downstream to upstream
-    return df.head(1).drop(columns=['direction', 'n_steps'])
+    dir_col, steps_col = _PROP_COLS[prop_col]
+    # the fewest steps first, preferring downstream to upstream, and otherwise the order the sources were propagated
+    return (
+        df_props
+        .sort_values([steps_col, dir_col], kind='stable')
+        .drop_duplicates(subset=[COL_MID], keep='first')
+    )
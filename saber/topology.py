@@ -0,0 +1,203 @@
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from .io import COL_MID
+from .io import COL_MID_DOWN
+from .io import COL_STRM_ORD
+from .io import _MappedArrays
+from .io import _get_table_path
+
+__all__ = ['Topology', 'read_topology', 'write_topology', ]
+
+logger = logging.getLogger(__name__)
+
+
+class Topology(_MappedArrays):
+    """
+    Compact array representation of a dendritic river network. Reaches are identified by their position (int32) in the
+    table the topology was built from. Written as a directory of .npy files which are memory mapped when read so every
+    run and worker process shares the same pages instead of rebuilding the network from the drain table.
+
+    Args:
+        model_id: int64 model id of each reach
+        downstream: int32 position of the downstream reach of each reach, -1 for outlets and reaches draining out of
+            the network
+        upstream_ptr: int32 offsets into upstream (length n + 1). The upstream reaches of reach i are
+            upstream[upstream_ptr[i]:upstream_ptr[i + 1]] in the order they appear in the table
+        upstream: int32 positions of the upstream reaches of every reach
+        order: int32 positions of every reach in topological order: each reach comes before the reach it drains to
+        outlet: int32 position of the terminal outlet of the basin of each reach
+        strahler: int32 strahler stream order of each reach, -1 if unknown
+        path: directory the arrays were read from, if any
+    """
+    ARRAYS = ('model_id', 'downstream', 'upstream_ptr', 'upstream', 'order', 'outlet', 'strahler')
+
+    def __init__(self, model_id: np.ndarray, downstream: np.ndarray, upstream_ptr: np.ndarray, upstream: np.ndarray,
+                 order: np.ndarray, outlet: np.ndarray, strahler: np.ndarray, path: str = None):
+        self.model_id = model_id
+        self.downstream = downstream
+        self.upstream_ptr = upstream_ptr
+        self.upstream = upstream
+        self.order = order
+        self.outlet = outlet
+        self.strahler = strahler
+        self.path = path
+        self._index = None
+
+    def __len__(self):
+        return len(self.model_id)
+
+    @classmethod
+    def from_table(cls, df: pd.DataFrame) -> 'Topology':
+        """
+        Builds the topology of the network in a table
+
+        Args:
+            df: a table with the model_id and downstream_model_id columns and optionally the strahler_order column
+
+        Returns:
+            Topology
+
+        Raises:
+            ValueError: if the network contains a cycle
+        """
+        model_id = pd.to_numeric(pd.Series(_id_strings(df[COL_MID]))).values.astype(np.int64)
+        down_ids = pd.to_numeric(pd.Series(_id_strings(df[COL_MID_DOWN])), errors='coerce')
+        downstream = pd.Index(model_id).get_indexer(down_ids.fillna(-1).values.astype(np.int64)).astype(np.int32)
+        n = len(model_id)
+
+        # compressed sparse rows of the upstream reaches: a stable sort keeps the table order within each list
+        has_down = np.flatnonzero(downstream >= 0)
+        upstream = has_down[np.argsort(downstream[has_down], kind='stable')].astype(np.int32)
+        upstream_ptr = np.zeros(n + 1, dtype=np.int32)
+        upstream_ptr[1:] = np.cumsum(np.bincount(downstream[has_down], minlength=n))
+
+        # pointer jumping: each pass doubles the distance followed downstream so finding the outlet and the number of
+        # steps to it only costs log2(depth) vectorized passes
+        parent = np.where(downstream >= 0, downstream, np.arange(n, dtype=np.int32))
+        steps = (downstream >= 0).astype(np.int64)
+        for _ in range(64):
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            steps = steps + steps[parent]
+            parent = grandparent
+        else:
+            raise ValueError('The drainage network contains a cycle')
+        # jumping around a cycle whose length is a power of two, or a reach draining into itself, also stops changing
+        # so every outlet found must be a reach which drains nowhere
+        in_cycle = downstream[parent] >= 0
+        if np.any(in_cycle):
+            cycle_ids = np.unique(model_id[parent[in_cycle]])[:10].tolist()
+            raise ValueError(f'The drainage network contains a cycle through model ids: {cycle_ids}')
+
+        if COL_STRM_ORD in df.columns:
+            strahler = pd.to_numeric(df[COL_STRM_ORD], errors='coerce').fillna(-1).values.astype(np.int32)
+        else:
+            strahler = np.full(n, -1, dtype=np.int32)
+
+        return cls(
+            model_id=model_id,
+            downstream=downstream,
+            upstream_ptr=upstream_ptr,
+            upstream=upstream,
+            order=np.argsort(-steps, kind='stable').astype(np.int32),
+            outlet=parent.astype(np.int32),
+            strahler=strahler,
+        )
+
+    def positions(self, model_ids) -> np.ndarray:
+        """
+        Finds the position of each model id in the topology
+
+        Args:
+            model_ids: iterable of model ids as strings or integers
+
+        Returns:
+            np.ndarray of int positions, -1 for model ids which are not in the topology
+        """
+        if self._index is None:
+            self._index = pd.Index(np.asarray(self.model_id))
+        ids = pd.to_numeric(pd.Series(_id_strings(pd.Series(model_ids))), errors='coerce').fillna(-1)
+        return self._index.get_indexer(ids.values.astype(np.int64))
+
+    def upstream_of(self, position: int) -> np.ndarray:
+        """
+        Positions of the reaches which drain directly into the reach at position
+        """
+        return self.upstream[self.upstream_ptr[position]:self.upstream_ptr[position + 1]]
+
+    def outlet_ids(self) -> np.ndarray:
+        """
+        Model id strings of the terminal outlet of each reach
+        """
+        return np.asarray(self.model_id)[np.asarray(self.outlet)].astype(str)
+
+    def watershed(self, model_id) -> np.ndarray:
+        """
+        Model ids of a reach and every reach upstream of it, for example to subset GIS datasets to one watershed
+
+        Args:
+            model_id: the model id of the most downstream reach of the watershed
+
+        Returns:
+            np.ndarray of model id strings
+        """
+        pending = [int(self.positions([model_id])[0])]
+        if pending[0] < 0:
+            raise ValueError(f'Model id not in topology: {model_id}')
+        found = []
+        while pending:
+            found.extend(pending)
+            pending = np.concatenate([self.upstream_of(p) for p in pending]).tolist()
+        return np.asarray(self.model_id)[found].astype(str)
+
+
+def write_topology(topology: Topology or pd.DataFrame, path: str = None) -> None:
+    """
+    Writes the arrays of a topology to a directory of .npy files
+
+    Args:
+        topology: a Topology or a table of the network to build one from
+        path: the directory to write to. Defaults to the topology directory in the workdir tables directory
+
+    Returns:
+        None
+    """
+    if isinstance(topology, pd.DataFrame):
+        topology = Topology.from_table(topology)
+    if path is None:
+        path = _get_table_path('topology')
+    topology._write(path)
+    return
+
+
+def read_topology(path: str = None, mmap: bool = True) -> Topology:
+    """
+    Reads a topology written by write_topology
+
+    Args:
+        path: the directory of the topology. Defaults to the topology directory in the workdir tables directory
+        mmap: memory map the arrays instead of reading them into memory
+
+    Returns:
+        Topology
+
+    Raises:
+        FileNotFoundError: if the topology has not been written
+    """
+    if path is None:
+        path = _get_table_path('topology')
+    if not os.path.isdir(path):
+        raise FileNotFoundError(f'Topology does not exist: {path}')
+    return Topology._read(path, mmap)
+
+
+def _id_strings(ids: pd.Series) -> np.ndarray:
+    """
+    Converts a column of ids to strings without the trailing '.0' left on integer ids read as floats
+    """
+    return ids.astype(str).str.replace(r'\.0$', '', regex=True).values
@@ -0,0 +1,139 @@
+import contextlib
+import glob
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from .io import DIR_TRACES
+from .io import TRACE_JSON
+from .io import get_state
+
+__all__ = ['span', 'counter', 'merge_traces', ]
+
+logger = logging.getLogger(__name__)
+
+# the file this process appends spans to. Reopened after a fork so every worker writes its own file
+_file = None
+_file_pid = None
+_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def span(name: str, cat: str = 'saber', **args):
+    """
+    Records the time spent in a block of code as a span of a Chrome trace when trace is enabled in the config. Does
+    nothing otherwise. Each process appends its spans to its own file in the traces directory of the workdir, which
+    merge_traces combines into one file to open in chrome://tracing or https://ui.perfetto.dev
+
+    Args:
+        name: name of the span, such as the function or file being processed
+        cat: category of the span, such as 'io', 'fdc', 'interp', or 'write'
+        **args: values shown with the span in the trace viewer, such as the model id
+
+    Yields:
+        None
+    """
+    if not get_state('trace'):
+        yield
+        return
+    start = time.time_ns() // 1000
+    try:
+        yield
+    finally:
+        _write({
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': start,
+            'dur': time.time_ns() // 1000 - start,
+            'pid': os.getpid(),
+            'tid': threading.get_native_id(),
+            'args': {k: str(v) for k, v in args.items()},
+        })
+
+
+def counter(name: str, cat: str = 'saber', **values) -> None:
+    """
+    Records the current values of some counters, such as the size of a cache, as a counter track of the Chrome trace
+    when trace is enabled in the config. Does nothing otherwise.
+
+    Args:
+        name: name of the counter track
+        cat: category of the counter
+        **values: the numeric value of each series of the counter track
+
+    Returns:
+        None
+    """
+    if not get_state('trace'):
+        return
+    _write({
+        'name': name,
+        'cat': cat,
+        'ph': 'C',
+        'ts': time.time_ns() // 1000,
+        'pid': os.getpid(),
+        'args': values,
+    })
+    return
+
+
+def merge_traces(remove: bool = True) -> str or None:
+    """
+    Combines the spans written by every process into a Chrome trace event JSON file in the workdir
+
+    Args:
+        remove: delete the files of each process after merging them
+
+    Returns:
+        str path to the merged trace, or None if no spans were recorded
+    """
+    parts = sorted(glob.glob(os.path.join(get_state('workdir'), DIR_TRACES, 'trace-*.jsonl')))
+    if not parts:
+        return None
+
+    _close()
+    events = []
+    for part in parts:
+        with open(part) as f:
+            events.extend(json.loads(line) for line in f if line.strip())
+    host_pids = {(os.path.basename(part).split('-')[1], int(part.rsplit('-', 1)[1].split('.')[0])) for part in parts}
+    events.extend({
+        'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': f'{host} {pid}'}
+    } for host, pid in sorted(host_pids))
+
+    path = os.path.join(get_state('workdir'), TRACE_JSON)
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    if remove:
+        for part in parts:
+            os.remove(part)
+    logger.info(f'Wrote {len(events)} trace events to {path}')
+    return path
+
+
+def _write(event: dict) -> None:
+    global _file, _file_pid
+    with _lock:
+        if _file is None or _file_pid != os.getpid():
+            directory = os.path.join(get_state('workdir'), DIR_TRACES)
+            os.makedirs(directory, exist_ok=True)
+            # the host name keeps the files of machines sharing the workdir apart
+            host = socket.gethostname().replace('-', '_')
+            _file = open(os.path.join(directory, f'trace-{host}-{os.getpid()}.jsonl'), 'a', buffering=1)
+            _file_pid = os.getpid()
+        _file.write(json.dumps(event) + '\n')
+    return
+
+
+def _close() -> None:
+    global _file, _file_pid
+    with _lock:
+        if _file is not None and _file_pid == os.getpid():
+            _file.close()
+        _file = None
+        _file_pid = None
+    return
@@ -11,6 +11,7 @@ VERSION = '0.9.0'
 PYTHON_REQUIRES = '>=3.10'
 INSTALL_REQUIRES = [
     'contextily',
+    'dask',
     'fastparquet',
     'geopandas',
     'hydrostats',
@@ -54,5 +55,8 @@ setup(
     license='BSD 3-Clause',
     classifiers=TROVE_CLASSIFIERS,
     python_requires=PYTHON_REQUIRES,
-    install_requires=INSTALL_REQUIRES
+    install_requires=INSTALL_REQUIRES,
+    entry_points={
+        'console_scripts': ['saber=saber.cli:main', ],
+    },
 )
@@ -0,0 +1,26 @@
+import pytest
+
+from saber.bs import parameter_sets
+from saber.saber import SFDC_PARAMS
+
+
+def test_parameter_sets_makes_every_combination():
+    sets = parameter_sets({'outlier_threshold': [2.5, 3], 'fit_range': [(5, 95), (10, 90)]})
+    assert len(sets) == 4
+    assert all(params['use_log'] == SFDC_PARAMS['use_log'] for params in sets)
+    assert {(params['outlier_threshold'], params['fit_range']) for params in sets} == {
+        (2.5, (5, 95)), (2.5, (10, 90)), (3, (5, 95)), (3, (10, 90)),
+    }
+
+
+def test_parameter_sets_rejects_unknown_parameters():
+    with pytest.raises(ValueError, match='Unknown'):
+        parameter_sets({'not_a_setting': [1, 2]})
+
+
+def test_parameter_sets_rejects_use_log_of_monthly_curves():
+    with pytest.raises(ValueError, match='fix_seasonally'):
+        parameter_sets({'use_log': [True, False]})
+    with pytest.raises(ValueError, match='fix_seasonally'):
+        parameter_sets([{'use_log': False, 'fix_seasonally': True}])
+    assert len(parameter_sets({'use_log': [True, False], 'fix_seasonally': [False]})) == 2
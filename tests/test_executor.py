@@ -0,0 +1,36 @@
+import time
+
+import pytest
+
+from saber import executor
+from saber.executor import Executor
+from saber.executor import parse_memory
+
+TASK_SECONDS = 0.01
+
+
+def _work(task):
+    time.sleep(TASK_SECONDS)
+    return task
+
+
+@pytest.mark.parametrize('kind', ['serial', 'thread'])
+def test_task_seconds_leave_out_the_time_between_results(kind):
+    executor._task_seconds.clear()
+    with Executor(kind, n_workers=2) as e:
+        results = []
+        for result in e.imap(_work, range(6)):
+            # a slow consumer must not make the tasks look slower and the chunks smaller
+            time.sleep(5 * TASK_SECONDS)
+            results.append(result)
+    assert results == list(range(6))
+    assert executor._task_seconds[executor._task_key(_work)] < 3 * TASK_SECONDS
+
+
+def test_parse_memory():
+    assert parse_memory('16GB') == 16 * 1024
+    assert parse_memory('512 MB') == 512
+    assert parse_memory(100) == 100
+    assert parse_memory(None) is None
+    with pytest.raises(ValueError):
+        parse_memory('lots')
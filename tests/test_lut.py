@@ -0,0 +1,38 @@
+import pickle
+
+import numpy as np
+
+from saber.lut import CorrectionTables
+from saber.lut import read_tables
+from saber.lut import write_tables
+
+
+def _tables() -> CorrectionTables:
+    return CorrectionTables(
+        model_id=np.array(['1']),
+        bounds=np.tile(np.arange(100, dtype=np.float32), (1, 12, 1)),
+        probs=np.tile(np.linspace(0, 100, 101, dtype=np.float32), (1, 12, 1)),
+        factors=np.full((1, 12, 101), 2, dtype=np.float32),
+        flows=np.full((1, 12, 101), np.nan, dtype=np.float32),
+        gumbel=np.full((1, 12, 2), np.nan, dtype=np.float32),
+        valid=np.ones((1, 12), dtype=bool),
+        settings={'use_log': False},
+    )
+
+
+def test_written_tables_keep_their_settings_and_are_pickled_as_their_path(tmp_path):
+    write_tables(_tables(), str(tmp_path))
+    mapped = read_tables(str(tmp_path))
+    assert isinstance(mapped.factors, np.memmap)
+    assert mapped.settings == {'use_log': False}
+    copied = pickle.loads(pickle.dumps(mapped))
+    assert copied.path == str(tmp_path)
+    assert copied.settings == {'use_log': False}
+
+
+def test_tables_in_memory_are_pickled_with_their_arrays():
+    copied = pickle.loads(pickle.dumps(_tables()))
+    assert copied.path is None
+    assert copied.settings == {'use_log': False}
+    times = np.array(['2000-01-01', '2000-07-01'], dtype='datetime64[ns]')
+    assert copied.correct(np.array([[1.5], [3.5]]), times).ravel().tolist() == [3.0, 7.0]
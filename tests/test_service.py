@@ -0,0 +1,60 @@
+import concurrent.futures
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from saber import service as service_module
+from saber.lut import CorrectionTables
+
+MODEL_IDS = ['1', '2']
+TIMES = pd.date_range('1990-01-01', periods=10, freq='D')
+
+
+def _tables() -> CorrectionTables:
+    rivers = len(MODEL_IDS)
+    return CorrectionTables(
+        model_id=np.array(MODEL_IDS),
+        bounds=np.tile(np.arange(100, dtype=np.float32), (rivers, 12, 1)),
+        probs=np.tile(np.linspace(0, 100, 101, dtype=np.float32), (rivers, 12, 1)),
+        factors=np.full((rivers, 12, 101), 2, dtype=np.float32),
+        flows=np.full((rivers, 12, 101), np.nan, dtype=np.float32),
+        gumbel=np.full((rivers, 12, 2), np.nan, dtype=np.float32),
+        valid=np.ones((rivers, 12), dtype=bool),
+    )
+
+
+@pytest.fixture
+def service(monkeypatch):
+    def read_hindcast(hindcast_zarr, model_ids):
+        return pd.DataFrame({mid: np.arange(len(TIMES), dtype=np.float32) for mid in model_ids}, index=TIMES)
+
+    monkeypatch.setattr(service_module, 'read_hindcast', read_hindcast)
+    return service_module.CorrectionService(_tables(), hindcast_zarr='hindcast.zarr', max_wait=0.5)
+
+
+def test_mixed_batch_fails_only_the_bad_request(service):
+    good = concurrent.futures.Future()
+    bad = concurrent.futures.Future()
+    # an aware date which got past submit fails in _frame after the good request of the batch was answered
+    service._queue.put((['1'], pd.Timestamp('1990-01-01'), None, good))
+    service._queue.put((['2'], pd.Timestamp('1990-01-01T00:00Z'), None, bad))
+
+    assert good.result(timeout=5)['1'].tolist() == (2 * np.arange(len(TIMES))).tolist()
+    with pytest.raises(TypeError):
+        bad.result(timeout=5)
+    assert service._thread.is_alive()
+    assert service.submit(['2'], '1990-01-05').result(timeout=5).index[0] == pd.Timestamp('1990-01-05')
+
+
+def test_submit_converts_aware_dates_to_naive_utc(service):
+    naive = service.submit(MODEL_IDS, '1990-01-01', '1990-01-03')
+    aware = service.submit(MODEL_IDS, '1990-01-01T00:00Z', '1990-01-03T00:00Z')
+    pd.testing.assert_frame_equal(naive.result(timeout=5), aware.result(timeout=5))
+
+
+def test_submit_rejects_bad_dates(service):
+    with pytest.raises(ValueError):
+        service.submit(MODEL_IDS, 'not a date')
+    with pytest.raises(ValueError):
+        service.submit(MODEL_IDS, None, ['1990-01-01'])
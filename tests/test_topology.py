@@ -0,0 +1,48 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from saber.io import COL_MID
+from saber.io import COL_MID_DOWN
+from saber.topology import Topology
+from saber.topology import read_topology
+from saber.topology import write_topology
+
+
+def _network(edges: dict) -> pd.DataFrame:
+    return pd.DataFrame({COL_MID: list(edges), COL_MID_DOWN: list(edges.values())})
+
+
+def test_from_table_finds_outlets_and_order():
+    topology = Topology.from_table(_network({'1': '3', '2': '3', '3': '-1', '4': '5', '5': '-1'}))
+    assert topology.outlet_ids().tolist() == ['3', '3', '3', '5', '5']
+    position = {mid: i for i, mid in enumerate(np.asarray(topology.model_id).astype(str))}
+    order = np.asarray(topology.order).tolist()
+    assert order.index(position['1']) < order.index(position['3'])
+    assert order.index(position['4']) < order.index(position['5'])
+    assert sorted(topology.watershed('3').tolist()) == ['1', '2', '3']
+
+
+@pytest.mark.parametrize('edges', [
+    {'1': '1'},
+    {'1': '2', '2': '1'},
+    {'1': '2', '2': '3', '3': '1'},
+    {'1': '2', '2': '3', '3': '4', '4': '1'},
+    {'0': '1', '1': '2', '2': '1', '3': '-1'},
+], ids=['1-cycle', '2-cycle', '3-cycle', '4-cycle', 'upstream-of-2-cycle'])
+def test_from_table_rejects_cycles(edges):
+    with pytest.raises(ValueError, match='cycle'):
+        Topology.from_table(_network(edges))
+
+
+def test_written_topology_is_memory_mapped_and_pickled_as_its_path(tmp_path):
+    topology = Topology.from_table(_network({'1': '2', '2': '-1'}))
+    write_topology(topology, str(tmp_path))
+    mapped = read_topology(str(tmp_path))
+    assert isinstance(mapped.outlet, np.memmap)
+    assert pickle.loads(pickle.dumps(mapped)).path == str(tmp_path)
+    copied = pickle.loads(pickle.dumps(topology))
+    assert copied.path is None
+    assert copied.outlet_ids().tolist() == ['2', '2']